@@ -1,16 +1,18 @@
 import os
 import json
+import asyncio
 import torch
 import numpy as np
-from fastapi import FastAPI, File, UploadFile, Form
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException
 from pydantic import BaseModel
 from typing import Optional
-from scipy.io import wavfile
 import whisper
-from utils import load_video_feats, add_noise  # Assuming these are available in your utils module
+from noise_bank import load_noise_bank, mix_noise, parse_noise_banks, noise_bank_path
+from utils import load_video_feats, load_wave_bytes  # Assuming these are available in your utils module
 import sys
 import uvicorn
 import gdown
+from worker_pool import WorkerPool, ServerBusyError
 
 # Force DBG = False by simulating an argument
 sys.argv.append("--start")
@@ -30,6 +32,7 @@ whisper_path = "models/"
 av_hubert_path = "av_hubert/avhubert/"
 av_hubert_ckpt = "models/large_noise_pt_noise_ft_433h_only_weights.pt"
 SAMPLE_RATE = 16000
+noise_banks = parse_noise_banks(os.environ.get("NOISE_BANKS", "babble=noise/babble/muavic/test.tsv"))  # name -> tsv
 
 # Model download logic
 WHISPER_MODEL_URL = "https://drive.google.com/uc?id=15HVr--vidDSE1AYs_VvlMSx4o77r6dvp"
@@ -87,29 +90,18 @@ class TranscriptionRequest(BaseModel):
     beam_size: int = 1
     fp16: int = 0
     checkpoint_path: Optional[str] = "models/whisper-flamingo_en-x_small.pt"
-    noise_fn: Optional[str] = "noise/babble/muavic/test.tsv"
-
-# Process media files
-def process_media(audio_file_path, video_file_path, language, noise_snr, task, modalities, beam_size, fp16, checkpoint_path=None, noise_fn=None):
-    global model, tokenizer  # Use the global instances
-    task_type = 'translate' if task == 'X-En' else 'transcribe'
-    options = whisper.DecodingOptions(
-        task=task_type,
-        language=language,
-        fp16=(device == "cuda" and fp16),
-        without_timestamps=True,
-        beam_size=None if beam_size == 1 else beam_size,
-    )
+    noise: Optional[str] = "babble"  # name of a noise in NOISE_BANKS
 
+# Load and preprocess media files, runs on the preprocessing threads
+def preprocess_media(audio_bytes, video_bytes, modalities, noise_snr, fp16, noise_fn=None):
     # Load and preprocess audio
-    if audio_file_path:
-        sample_rate, wav_data = wavfile.read(audio_file_path)
-        assert sample_rate == SAMPLE_RATE, f"Sample rate must be {SAMPLE_RATE} Hz"
+    if audio_bytes:
+        sample_rate, wav_data = load_wave_bytes(audio_bytes)
+        if sample_rate != SAMPLE_RATE:
+            raise ValueError(f"Sample rate must be {SAMPLE_RATE} Hz")
         audio = wav_data.flatten().astype(np.float32) / 32768.0
         if noise_snr < 100 and noise_fn and os.path.exists(noise_fn):
-            with open(noise_fn, 'r') as f:
-                noise_files = [ln.strip() for ln in f.readlines()]
-            audio = add_noise(wav_data, noise_files, noise_snr=noise_snr).flatten().astype(np.float32) / 32768.0
+            audio = mix_noise(audio, load_noise_bank(noise_fn), noise_snr)
         audio = whisper.pad_or_trim(audio, length=SAMPLE_RATE * 30)
         n_mels = 80 if model_type != 'large-v3' else 128
         mel = whisper.log_mel_spectrogram(audio, n_mels=n_mels)
@@ -122,8 +114,8 @@ def process_media(audio_file_path, video_file_path, language, noise_snr, task, m
         mel = None
 
     # Load and preprocess video
-    if video_file_path and modalities in ["avsr", "vsr"]:
-        video = load_video_feats(video_file_path, train=False)
+    if video_bytes and modalities in ["avsr", "vsr"]:
+        video = load_video_feats(video_bytes, train=False)
         video = torch.tensor(video, dtype=torch.float32).unsqueeze(0)
         video = video.permute(0, 4, 1, 2, 3)
         if device == "cuda" and fp16:
@@ -132,6 +124,19 @@ def process_media(audio_file_path, video_file_path, language, noise_snr, task, m
             video = video.cuda()
     else:
         video = None
+    return mel, video
+
+# Decode preprocessed inputs, runs on the dedicated inference thread
+def decode_media(mel, video, language, task, modalities, beam_size, fp16):
+    global model, tokenizer  # Use the global instances
+    task_type = 'translate' if task == 'X-En' else 'transcribe'
+    options = whisper.DecodingOptions(
+        task=task_type,
+        language=language,
+        fp16=(device == "cuda" and fp16),
+        without_timestamps=True,
+        beam_size=None if beam_size == 1 else beam_size,
+    )
 
     # Perform decoding
     with torch.no_grad():
@@ -147,6 +152,38 @@ def process_media(audio_file_path, video_file_path, language, noise_snr, task, m
     transcription = result[0].text
     return {"text": transcription}
 
+# Preprocessing thread pool, dedicated inference thread and admission control
+worker_pool = WorkerPool(
+    preprocess_workers=int(os.environ.get("PREPROCESS_WORKERS", 4)),
+    max_pending=int(os.environ.get("MAX_PENDING_REQUESTS", 32)),  # beyond this, 429
+    timeout_s=float(os.environ.get("REQUEST_TIMEOUT_S", 60)),  # beyond this, 503
+)
+
+async def handle_request(audio_file, video_file, params):
+    # Uploads are decoded in memory, nothing is written to disk
+    audio_bytes = await audio_file.read() if audio_file else None
+    video_bytes = await video_file.read() if video_file else None
+    mel, video = await worker_pool.preprocess(
+        preprocess_media,
+        audio_bytes,
+        video_bytes,
+        params.modalities,
+        params.noise_snr,
+        params.fp16,
+        noise_bank_path(noise_banks, params.noise)
+    )
+
+    return await worker_pool.infer(
+        decode_media,
+        mel,
+        video,
+        params.language,
+        params.task,
+        params.modalities,
+        params.beam_size,
+        params.fp16
+    )
+
 # API endpoint
 @app.post("/transcribe/")
 async def transcribe_file(
@@ -156,36 +193,20 @@ async def transcribe_file(
 ):
     params = TranscriptionRequest(**json.loads(params))
     
-    audio_file_path = video_file_path = None
-    if audio_file:
-        audio_file_path = f"temp_audio_{audio_file.filename}"
-        with open(audio_file_path, "wb") as f:
-            f.write(await audio_file.read())
-    if video_file:
-        video_file_path = f"temp_video_{video_file.filename}"
-        with open(video_file_path, "wb") as f:
-            f.write(await video_file.read())
-    
     try:
-        result = process_media(
-            audio_file_path,
-            video_file_path,
-            params.language,
-            params.noise_snr,
-            params.task,
-            params.modalities,
-            params.beam_size,
-            params.fp16,
-            params.checkpoint_path,
-            params.noise_fn
-        )
-    finally:
-        if audio_file_path and os.path.exists(audio_file_path):
-            os.remove(audio_file_path)
-        if video_file_path and os.path.exists(video_file_path):
-            os.remove(video_file_path)
-    
-    return result
+        async with worker_pool.admit():
+            return await worker_pool.run(handle_request(audio_file, video_file, params))
+    except ValueError as e: # undecodable media
+        raise HTTPException(status_code=400, detail=str(e))
+    except ServerBusyError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail=f"Request timed out after {worker_pool.timeout_s} s",
+                            headers={"Retry-After": "5"})
+
+@app.get("/health/")
+async def health_check():
+    return {"status": "ok", "device": device, **worker_pool.stats()}
 
 # Update port handling for Render
 if __name__ == "__main__":
@@ -33,6 +33,12 @@ if DBG:
 else:
     from . import utils as custom_utils
 
+try:
+    from noise_bank import load_noise_bank
+except ImportError: # noise_bank.py is at the root of the Whisper-Flamingo repo
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+    from noise_bank import load_noise_bank
+
 logger = logging.getLogger(__name__)
 
 
@@ -188,7 +194,7 @@ class AVHubertDataset(FairseqDataset):
         self.single_target = single_target
         self.store_labels = store_labels
         self.is_s2s = is_s2s
-        self.noise_wav, self.noise_prob, self.noise_snr, self.noise_num = [ln.strip() for ln in open(noise_fn).readlines()] if noise_fn is not None else [], noise_prob, noise_snr, noise_num
+        self.noise_bank, self.noise_prob, self.noise_snr, self.noise_num = load_noise_bank(noise_fn) if noise_fn is not None else [], noise_prob, noise_snr, noise_num
 
         assert self.single_target == (self.label_rates[0] == -1), f"single target should be equivalent to sequence label (label_rate==-1)"
         if store_labels:
@@ -231,7 +237,7 @@ class AVHubertDataset(FairseqDataset):
             f"normalize={normalize}, max_sample_size={self.max_sample_size}, "
             f"seqs2seq data={self.is_s2s},")
         logger.info(
-            f"Noise wav: {noise_fn}->{len(self.noise_wav)} wav, Prob: {self.noise_prob}, SNR: {self.noise_snr}, Number of mixture: {self.noise_num}"
+            f"Noise wav: {noise_fn}->{len(self.noise_bank)} wav, Prob: {self.noise_prob}, SNR: {self.noise_snr}, Number of mixture: {self.noise_num}"
         )
 
     def get_label(self, index, label_idx):
@@ -302,10 +308,10 @@ class AVHubertDataset(FairseqDataset):
         return feats
 
     def select_noise(self):
-        rand_indexes = np.random.randint(0, len(self.noise_wav), size=self.noise_num)
+        rand_indexes = np.random.randint(0, len(self.noise_bank), size=self.noise_num)
         noise_wav = []
         for x in rand_indexes:
-            noise_wav.append(wavfile.read(self.noise_wav[x])[1].astype(np.float32))
+            noise_wav.append(self.noise_bank.noise(x).astype(np.float32)) # memory-mapped, not read per sample
         if self.noise_num == 1:
             return noise_wav[0]
         else:
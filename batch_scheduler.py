@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+logger = logging.getLogger("whisper-flamingo-batching")
+
+
+def collate_inputs(audios, videos):
+    """
+    Pad a list of waveforms [T] and uint8 videos [T, H, W] (or None) into a batch,
+    the same way WhisperVideoCollatorWithPadding does: zero-pad both to the longest
+    item and return audio as [B, T] with its lengths, and video as uint8 [B, T, H, W]
+    with its padding mask [B, T] (True for padded frames), for utils.preprocess_video_batch
+    The videos must share their frame size H x W, callers put it in the batch key
+    """
+    audio_lengths = torch.tensor([len(audio) for audio in audios])
+    audio = torch.zeros((len(audios), int(audio_lengths.max())), dtype=torch.float32)
+    audio_np = audio.numpy() # written in place, as the BatchBuffers collators do
+    for i, a in enumerate(audios):
+        audio_np[i, :len(a)] = a
+
+    if any(vid is None for vid in videos):
+        return audio, audio_lengths, None, None
+    video_lengths = torch.tensor([len(vid) for vid in videos])
+    max_video_len = int(video_lengths.max())
+    video = torch.zeros((len(videos), max_video_len, *videos[0].shape[1:]), dtype=torch.uint8)
+    video_np = video.numpy()
+    for i, vid in enumerate(videos):
+        video_np[i, :len(vid)] = vid
+    padding_mask = torch.arange(max_video_len)[None, :] >= video_lengths[:, None]
+    return audio, audio_lengths, video, padding_mask
+
+
+class BatchScheduler:
+    """
+    Queues decode requests and runs them in batches.
+
+    Requests are grouped by `key` (everything that must be identical within one
+    `model.decode` call: checkpoint, modality, language, task, beam size, ...).
+    A group is flushed as soon as it holds `max_batch_size` requests or its oldest
+    request has waited `max_wait_ms`. `decode_batch(key, items)` must return one
+    result per item; it runs on a single worker thread so decodes never block the
+    event loop and never compete with each other for the GPU. Pass a
+    worker_pool.WorkerPool to share its inference thread and in-flight counts.
+    """
+    def __init__(self, decode_batch, max_batch_size=8, max_wait_ms=20.0, worker_pool=None):
+        self.decode_batch = decode_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.worker_pool = worker_pool
+        self.pending = {}  # key -> list of (item, future)
+        self.flush_events = {}  # key -> asyncio.Event set when the group is full
+        if worker_pool is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="decode")
+
+    @property
+    def queued(self):
+        """Requests waiting for their group to be flushed"""
+        return sum(len(requests) for requests in self.pending.values())
+
+    async def submit(self, key, item):
+        """Queue one request and wait for its result"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if key not in self.pending:
+            self.pending[key] = []
+            self.flush_events[key] = asyncio.Event()
+            loop.create_task(self._flush_after_deadline(key))
+        self.pending[key].append((item, future))
+        if len(self.pending[key]) >= self.max_batch_size:
+            self.flush_events[key].set()
+        return await future
+
+    async def _flush_after_deadline(self, key):
+        try:
+            await asyncio.wait_for(self.flush_events[key].wait(), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        # later arrivals for this key start a new group
+        requests = self.pending.pop(key)
+        del self.flush_events[key]
+        for start in range(0, len(requests), self.max_batch_size):
+            await self._run(key, requests[start:start + self.max_batch_size])
+
+    async def _run(self, key, requests):
+        # skip requests that timed out or were cancelled while queued
+        requests = [(item, future) for item, future in requests if not future.done()]
+        if not requests:
+            return
+        items = [item for item, _ in requests]
+        start = time.perf_counter()
+        try:
+            if self.worker_pool is not None:
+                results = await self.worker_pool.infer(self.decode_batch, key, items, n_requests=len(items))
+            else:
+                results = await asyncio.get_running_loop().run_in_executor(self.executor, self.decode_batch, key, items)
+        except Exception as e:
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        logger.info(f"Decoded batch of {len(items)} in {1000 * (time.perf_counter() - start):.1f} ms")
+        for (_, future), result in zip(requests, results):
+            if not future.done(): # the client may have gone away
+                future.set_result(result)
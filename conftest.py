@@ -0,0 +1,38 @@
+import pytest
+import torch
+
+from whisper.model import ModelDimensions, Whisper
+
+TINY_DIMS = ModelDimensions(
+    n_mels=80,
+    n_audio_ctx=24,
+    n_audio_state=32,
+    n_audio_head=4,
+    n_audio_layer=2,
+    n_vocab=51865, # multilingual tokenizer
+    n_text_ctx=48,
+    n_text_state=32,
+    n_text_head=4,
+    n_text_layer=2,
+)
+
+
+@pytest.fixture
+def tiny_whisper():
+    """
+    Factory of tiny, randomly initialized Whisper(-Flamingo) models in eval mode. With `video`, the
+    video branch is a random ResEncoder, so the tests feed it cached 512-d features (batch, frames, 512);
+    with av_fusion="separate" the gated cross-attentions are opened so the video changes the logits
+    """
+    def create(video=False, av_fusion="separate", seed=0):
+        torch.manual_seed(seed)
+        model = Whisper(TINY_DIMS, 0.0, video, "", "", 1.0, 0.0, 0, av_fusion if video else "None",
+                        False, 256, int(video and av_fusion == "separate"))
+        with torch.no_grad():
+            model.decoder.positional_embedding.normal_(0, 0.02) # torch.empty in the model
+            for block in model.decoder.blocks:
+                if block.add_gated_x_attn != 0:
+                    block.attn_gate.fill_(0.5)
+                    block.ff_gate.fill_(0.5)
+        return model.eval()
+    return create
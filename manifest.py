@@ -0,0 +1,128 @@
+import os
+import uuid
+
+import numpy as np
+
+
+class Manifest:
+    """
+    Columnar index of a MuAViC TSV and its transcripts: audio paths and texts are utf-8 bytes in one
+    uint8 array each (string i is [offsets[i], offsets[i + 1])), audio / video lengths and text
+    lengths (characters) are int64 arrays. Parsed once and cached next to the transcripts
+    ({txt_fn}.manifest.npz), so load_data filters with array ops and the DataLoader workers share a
+    few arrays instead of touching (and copying on write) one Python tuple per utterance.
+    """
+    def __init__(self, tsv_fn, txt_fn):
+        self.tsv_fn, self.txt_fn = tsv_fn, txt_fn
+        cache_fn = txt_fn + '.manifest.npz'
+        if os.path.exists(cache_fn) and all(os.path.getmtime(cache_fn) >= os.path.getmtime(fn) for fn in [tsv_fn, txt_fn]):
+            with np.load(cache_fn) as columns:
+                columns = dict(columns)
+        else:
+            columns = self._read(tsv_fn, txt_fn)
+            try:
+                # other ranks and workers may be reading or building it too: each one writes its own
+                # file and renames it over the cache, readers never see a partial one
+                tmp_fn = '{}.{}.tmp.npz'.format(cache_fn, uuid.uuid4().hex)
+                try:
+                    np.savez(tmp_fn, **columns)
+                    os.replace(tmp_fn, cache_fn)
+                finally:
+                    if os.path.exists(tmp_fn):
+                        os.remove(tmp_fn)
+            except OSError as e:
+                print("Unable to cache the manifest of {} ({})".format(txt_fn, e))
+        for name, column in columns.items():
+            setattr(self, name, column)
+
+    @staticmethod
+    def _read(tsv_fn, txt_fn):
+        with open(tsv_fn) as tsv, open(txt_fn) as txt:
+            audio_lns = tsv.readlines()[1:] # first line is the root directory
+            txt_lns = txt.readlines()
+        # id, video path, audio path, video length, audio length
+        paths, texts, audio_lens, video_lens = [], [], [], []
+        for audio, text in zip(audio_lns, txt_lns):
+            fields = audio.strip().split('\t')
+            paths.append(fields[2])
+            audio_lens.append(int(fields[-1]))
+            video_lens.append(int(fields[-2]))
+            texts.append(text.strip())
+        columns = {'audio_lens': np.array(audio_lens, dtype=np.int64),
+                   'video_lens': np.array(video_lens, dtype=np.int64),
+                   'text_lens': np.array([len(text) for text in texts], dtype=np.int64)}
+        for name, strings in [('paths', paths), ('texts', texts)]:
+            encoded = [s.encode('utf-8') for s in strings]
+            columns[name] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+            columns[name + '_offsets'] = np.cumsum([0] + [len(e) for e in encoded], dtype=np.int64)
+        return columns
+
+    def __len__(self):
+        return len(self.audio_lens)
+
+    @staticmethod
+    def _string(data, offsets, row):
+        return data[offsets[row]:offsets[row + 1]].tobytes().decode('utf-8')
+
+    def path(self, row):
+        return self._string(self.paths, self.paths_offsets, row)
+
+    def text(self, row):
+        return self._string(self.texts, self.texts_offsets, row)
+
+
+class ManifestList:
+    """
+    The rows `rows` of one or more Manifests, seen as load_data's list of (lang, audio path, text)
+    tuples, or (lang, audio path, text, audio length) with include_audio_lens. Tuples are built on
+    access; extend with +=.
+    """
+    def __init__(self, parts=(), include_audio_lens=False):
+        self.parts = list(parts) # (lang, manifest, rows)
+        self.include_audio_lens = include_audio_lens
+        self._index()
+
+    def _index(self):
+        # first item of every part, items of part p are starts[p]:starts[p + 1]
+        self.starts = np.cumsum([0] + [len(rows) for _, _, rows in self.parts])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, id):
+        if id < 0:
+            id += len(self)
+        if not 0 <= id < len(self):
+            raise IndexError(id)
+        part = int(np.searchsorted(self.starts, id, side='right')) - 1
+        lang, manifest, rows = self.parts[part]
+        row = rows[id - self.starts[part]]
+        item = (lang, manifest.path(row), manifest.text(row))
+        return item + (int(manifest.audio_lens[row]),) if self.include_audio_lens else item
+
+    def __iter__(self):
+        for id in range(len(self)):
+            yield self[id]
+
+    def __iadd__(self, other):
+        self.parts += other.parts
+        self._index()
+        return self
+
+    def _column(self, name):
+        return np.concatenate([getattr(manifest, name)[rows] for _, manifest, rows in self.parts] + [np.zeros(0, dtype=np.int64)])
+
+    @property
+    def audio_lens(self):
+        """Audio lengths in samples of all items, without building the tuples"""
+        return self._column('audio_lens')
+
+    @property
+    def video_lens(self):
+        """Video lengths in frames of all items"""
+        return self._column('video_lens')
+
+    @property
+    def text_lens(self):
+        """Transcript lengths in characters of all items"""
+        return self._column('text_lens')
@@ -0,0 +1,231 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import NamedTuple, Optional
+
+import torch
+import whisper
+
+logger = logging.getLogger("whisper-flamingo-registry")
+
+
+class ModelKey(NamedTuple):
+    model_type: str
+    checkpoint_path: Optional[str]
+    modality: str  # "av" for avsr / vsr (same weights, video branch loaded), "a" for asr
+    fp16: bool
+
+    @classmethod
+    def create(cls, model_type, checkpoint_path, modalities, fp16):
+        return cls(model_type, checkpoint_path, "a" if modalities == "asr" else "av", bool(fp16))
+
+
+class ResidentModel(NamedTuple):
+    model: torch.nn.Module
+    tokenizer: object
+    nbytes: int  # excluding the shared AV-HuBERT encoder
+    video_key: Optional[tuple]  # key into ModelRegistry.video_models, None if not shared
+
+
+def module_nbytes(module, exclude=None):
+    """Bytes held by the parameters and buffers of `module`, skipping the tensors of `exclude`"""
+    skip = set()
+    if exclude is not None:
+        skip = {t.data_ptr() for t in list(exclude.parameters()) + list(exclude.buffers())}
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors if t.data_ptr() not in skip)
+
+
+def weights_fingerprint(module):
+    """Digest of the names, dtypes, shapes and values of the weights of `module`, compared instead of the weights"""
+    digest = hashlib.blake2b(digest_size=16)
+    for name, tensor in module.state_dict().items():
+        tensor = tensor.detach().cpu().contiguous()
+        digest.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+        digest.update(tensor.reshape(-1).numpy().data)
+    return digest.hexdigest()
+
+
+def half_video_parameters(model):
+    """
+    Convert the parameters that are not cast by Whisper's dtype-following layers to fp16,
+    as done in whisper_decode_video.py
+    """
+    if not model.encoder.video:
+        return
+    model.encoder.video_model.half()
+    for block in model.decoder.blocks:
+        if block.add_gated_x_attn != 0:
+            block.attn_gate.data = block.attn_gate.data.half()
+            block.ff_gate.data = block.ff_gate.data.half()
+
+
+class ModelRegistry:
+    """
+    Keeps several Whisper-Flamingo checkpoints resident at once, keyed by
+    (model_type, checkpoint, modality, fp16), and evicts the least recently used
+    ones once the summed weight size exceeds `budget_gb`.
+
+    The frozen AV-HuBERT encoder is shared by all resident Flamingo checkpoints
+    built on the same `av_hubert_ckpt` (and whose video weights were not changed
+    by fine-tuning), so it only counts once against the budget.
+    """
+    def __init__(self, whisper_path, av_hubert_path, av_hubert_ckpt, use_av_hubert_encoder=1,
+                 av_fusion="separate", device=None, budget_gb=None, warm_workers=1):
+        self.whisper_path = whisper_path
+        self.av_hubert_path = av_hubert_path
+        self.av_hubert_ckpt = av_hubert_ckpt
+        self.use_av_hubert_encoder = use_av_hubert_encoder
+        self.av_fusion = av_fusion
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.budget_bytes = None if budget_gb is None else int(budget_gb * 1024 ** 3)
+
+        self.models = OrderedDict()  # ModelKey -> ResidentModel, least recently used first
+        self.loading = {}  # ModelKey -> Future of a load in progress
+        self.reserved = {}  # ModelKey -> bytes of a load in progress, counted before it reaches the device
+        self.video_models = {}  # (av_hubert_ckpt, fp16) -> [video_model, nbytes, n_users, fingerprint]
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=warm_workers, thread_name_prefix="model-warmup")
+
+    def get(self, model_type, checkpoint_path, modalities, fp16):
+        """Return (model, tokenizer), loading the checkpoint in the calling thread if it is not resident"""
+        key = ModelKey.create(model_type, checkpoint_path, modalities, fp16)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key].model, self.models[key].tokenizer
+            future = self.loading.get(key)
+            owner = future is None
+            if owner:
+                future = self.loading[key] = Future()
+        if owner: # concurrent requests for the same key wait on the first load
+            self._load(key, future)
+        return future.result()
+
+    def warm(self, model_type, checkpoint_path, modalities, fp16):
+        """Start loading a checkpoint in the background, returns a Future of (model, tokenizer)"""
+        future = self.executor.submit(self.get, model_type, checkpoint_path, modalities, fp16)
+        future.add_done_callback(lambda f: f.exception() and logger.error(
+            f"Failed to warm {checkpoint_path}: {f.exception()}"))
+        return future
+
+    @property
+    def resident_bytes(self):
+        return (sum(m.nbytes for m in self.models.values()) + sum(v[1] for v in self.video_models.values())
+                + sum(self.reserved.values()))
+
+    def status(self):
+        with self.lock:
+            return {
+                "resident": [key._asdict() for key in self.models],
+                "loading": [key._asdict() for key in self.loading],
+                "resident_gb": round(self.resident_bytes / 1024 ** 3, 3),
+                "budget_gb": None if self.budget_bytes is None else round(self.budget_bytes / 1024 ** 3, 3),
+            }
+
+    def _load(self, key, future):
+        video_key = None
+        try:
+            model, tokenizer = self._load_model(key)
+            if key.fp16 and self.device == "cuda":
+                half_video_parameters(model)
+            # hashed before taking the lock, lookups of resident models don't wait for it
+            fingerprint = self._video_fingerprint(key, model)
+            with self.lock:
+                video_key = self._share_video_model(key, model, fingerprint)
+                # sized on the CPU, and room made for it before anything is moved to the device
+                exclude = model.encoder.video_model if video_key is not None else None
+                self.reserved[key] = module_nbytes(model, exclude)
+                self._evict(keep=key)
+            # a shared encoder already resident is not moved again, only this checkpoint's own weights
+            model.to(self.device)
+            model.eval()
+            with self.lock:
+                self.models[key] = ResidentModel(model, tokenizer, self.reserved.pop(key), video_key)
+                del self.loading[key]
+            logger.info(f"Loaded {key}, resident {self.resident_bytes / 1024 ** 3:.2f} GB")
+            future.set_result((model, tokenizer))
+        except BaseException as e:
+            with self.lock:
+                self.loading.pop(key, None)
+                self.reserved.pop(key, None)
+                if video_key is not None and key not in self.models:
+                    self._release_video_model(video_key)
+            future.set_exception(e)
+
+    def _load_model(self, key):
+        logger.info(f"Loading Whisper model {key.model_type} with checkpoint {key.checkpoint_path}")
+        video = key.modality == "av"
+        multilingual = True if 'large' in key.model_type or 'en' not in key.model_type else False
+        tokenizer = whisper.tokenizer.get_tokenizer(multilingual=multilingual, task='transcribe')
+        model = whisper.load_model(
+            key.model_type,
+            device='cpu', # moved once the checkpoint is loaded and the video encoder shared
+            download_root=self.whisper_path,
+            video=video,
+            video_model_path=self.av_hubert_ckpt if video else None,
+            av_hubert_path=self.av_hubert_path if video else None,
+            av_hubert_encoder=self.use_av_hubert_encoder if video else 0,
+            av_fusion=self.av_fusion if video else "None",
+            add_gated_x_attn=1 if self.av_fusion == 'separate' and video else 0
+        )
+        if key.checkpoint_path:
+            state_dict = torch.load(key.checkpoint_path, map_location=torch.device('cpu'))
+            if 'state_dict' in state_dict:
+                state_dict = {k[6:]: v for k, v in state_dict['state_dict'].items()} # remove 'model.'
+            try:
+                model.load_state_dict(state_dict)
+            except RuntimeError as e:
+                logger.warning(f"Loading with strict=False due to: {str(e)}")
+                model.load_state_dict(state_dict, strict=False)
+        return model, tokenizer
+
+    @staticmethod
+    def _video_fingerprint(key, model):
+        """Fingerprint of the AV-HuBERT weights of a model still on the CPU, None if it has no video encoder"""
+        if key.modality != "av" or not model.encoder.video:
+            return None
+        return weights_fingerprint(model.encoder.video_model)
+
+    def _share_video_model(self, key, model, fingerprint):
+        """
+        Point the model at the shared AV-HuBERT encoder, returns its key or None if not shared.
+        Called with the lock held, the encoders are told apart by their fingerprints
+        """
+        if fingerprint is None:
+            return None
+        video_key = (self.av_hubert_ckpt, key.fp16)
+        video_model = model.encoder.video_model
+        if video_key not in self.video_models:
+            self.video_models[video_key] = [video_model, module_nbytes(video_model), 0, fingerprint]
+        shared = self.video_models[video_key]
+        if shared[0] is not video_model:
+            if shared[3] != fingerprint:
+                logger.info(f"{key.checkpoint_path} fine-tuned the video encoder, not sharing it")
+                return None
+            model.encoder.video_model = shared[0]
+        shared[2] += 1
+        return video_key
+
+    def _evict(self, keep):
+        if self.budget_bytes is None:
+            return
+        while self.resident_bytes > self.budget_bytes:
+            victim = next((k for k in self.models if k != keep), None)
+            if victim is None:
+                logger.warning(f"{keep} alone exceeds the model memory budget")
+                break
+            resident = self.models.pop(victim)
+            if resident.video_key is not None:
+                self._release_video_model(resident.video_key)
+            logger.info(f"Evicted {victim}")
+        if self.device == "cuda":
+            torch.cuda.empty_cache()
+
+    def _release_video_model(self, video_key):
+        shared = self.video_models[video_key]
+        shared[2] -= 1
+        if shared[2] == 0:
+            del self.video_models[video_key]
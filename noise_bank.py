@@ -0,0 +1,137 @@
+import os
+import uuid
+from functools import lru_cache
+
+import numpy as np
+from scipy.io import wavfile
+
+
+class NoiseBank:
+    """
+    All noise wavs listed in a `noise_fn` TSV (one path per line), read once and concatenated into
+    one int16 array. The array is cached next to the TSV ({noise_fn}.bank.npy and .offsets.npy) and
+    memory-mapped, so the DataLoader workers share its pages instead of reading a random wav for every
+    sample. Falls back to memory when the cache can't be written.
+    """
+    def __init__(self, noise_fn):
+        self.noise_fn = noise_fn
+        bank_fn, offsets_fn = noise_fn + '.bank.npy', noise_fn + '.offsets.npy'
+        if not self._cached(bank_fn, offsets_fn):
+            bank, offsets = self._read(noise_fn)
+            try:
+                # other ranks and workers may be reading or building it too: each one writes its own files
+                # and renames them into place, the offsets last, so fresh offsets (see _cached) always
+                # come with the bank they index
+                for fn, array in [(bank_fn, bank), (offsets_fn, offsets)]:
+                    tmp_fn = '{}.{}.tmp.npy'.format(fn, uuid.uuid4().hex)
+                    try:
+                        np.save(tmp_fn, array)
+                        os.replace(tmp_fn, fn)
+                    finally:
+                        if os.path.exists(tmp_fn):
+                            os.remove(tmp_fn)
+            except OSError as e:
+                print("Unable to cache the noise bank of {} ({}), keeping it in memory".format(noise_fn, e))
+                self.bank, self.offsets = bank, offsets
+                return
+        self.bank = np.load(bank_fn, mmap_mode='r')
+        self.offsets = np.load(offsets_fn)
+        print("Loaded {} noise wavs ({:.1f} h) from {}".format(len(self), len(self.bank) / 16000 / 3600, noise_fn))
+
+    def _cached(self, *fns):
+        return all(os.path.exists(fn) and os.path.getmtime(fn) >= os.path.getmtime(self.noise_fn) for fn in fns)
+
+    @staticmethod
+    def _read(noise_fn):
+        noise_wavs = [ln.strip() for ln in open(noise_fn).readlines() if ln.strip()]
+        wavs = [wavfile.read(fn)[1].flatten().astype(np.int16) for fn in noise_wavs]
+        offsets = np.cumsum([0] + [len(wav) for wav in wavs]) # wav i is bank[offsets[i]:offsets[i + 1]]
+        return np.concatenate(wavs), offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def noise(self, index):
+        """int16 samples of noise wav `index`, zero-copy"""
+        return self.bank[self.offsets[index]:self.offsets[index + 1]]
+
+    def mix(self, audio, lengths, noise_ids, snrs):
+        """
+        Add noise to a batch of zero-padded waveforms in one vectorized operation, as utils.add_noise does
+        for one: noise wav `noise_ids[b]` is tiled from its start over the first `lengths[b]` samples of
+        `audio[b]` and scaled to `snrs[b]` dB, then utterances which would clip are scaled down.
+        audio: float (batch, n_samples) in [-1, 1], rows with a negative noise id are left clean
+        """
+        audio = np.array(audio, dtype=np.float32)
+        rows = np.flatnonzero(np.asarray(noise_ids) >= 0)
+        if len(rows) == 0:
+            return audio
+        noise_ids = np.asarray(noise_ids)[rows]
+        lengths = np.asarray(lengths)[rows][:, None]
+        snrs = np.asarray(snrs, dtype=np.float32)[rows][:, None]
+        clean = audio[rows]
+
+        t = np.arange(clean.shape[1])[None]
+        valid = t < lengths
+        starts, noise_lens = self.offsets[noise_ids][:, None], np.diff(self.offsets)[noise_ids][:, None]
+        noise = np.take(self.bank, starts + t % noise_lens).astype(np.float32) / 32768.0
+        noise *= valid
+
+        clean_rms = np.sqrt(np.sum(np.square(clean), axis=-1, keepdims=True) / lengths)
+        noise_rms = np.sqrt(np.sum(np.square(noise), axis=-1, keepdims=True) / lengths)
+        adjusted_noise_rms = clean_rms / (10**(snrs/20))
+        mixed = clean + noise * (adjusted_noise_rms / np.maximum(noise_rms, 1e-8))
+
+        # Avoid clipping noise, int16 range
+        peak = np.maximum(mixed.max(axis=-1, keepdims=True) / (32767 / 32768), -mixed.min(axis=-1, keepdims=True))
+        mixed /= np.maximum(peak, 1.0)
+        audio[rows] = mixed
+        return audio
+
+
+@lru_cache(maxsize=None)
+def load_noise_bank(noise_fn):
+    """One NoiseBank per TSV and process, shared by the datasets using it"""
+    return NoiseBank(noise_fn)
+
+
+def sample_noise(rng, noise_bank, noise_prob, noise_snr):
+    """
+    Draw the noise of one utterance: returns (noise id, snr), with noise id -1 for clean audio.
+    noise_snr is a fixed SNR or an inclusive (low, high) range of integer SNRs
+    """
+    if noise_bank is None or rng.random() > noise_prob:
+        return -1, 0
+    if isinstance(noise_snr, (tuple, list)):
+        snr = int(rng.integers(noise_snr[0], noise_snr[1] + 1))
+    else:
+        snr = noise_snr
+    return int(rng.integers(len(noise_bank))), snr
+
+
+def mix_noise(audio, noise_bank, noise_snr):
+    """Mix a random noise wav of the bank into one float waveform at `noise_snr` dB"""
+    noise_id = np.random.randint(len(noise_bank))
+    return noise_bank.mix(audio[None], [len(audio)], [noise_id], [noise_snr])[0]
+
+
+def parse_noise_banks(spec):
+    """
+    Server-side allowlist of the noises API clients may ask for, from "name=noise.tsv,name2=other.tsv"
+    (the NOISE_BANKS environment variable). Clients only ever send a name, never a path.
+    """
+    noise_banks = {}
+    for entry in spec.split(','):
+        if entry.strip():
+            name, noise_fn = entry.split('=', 1)
+            noise_banks[name.strip()] = noise_fn.strip()
+    return noise_banks
+
+
+def noise_bank_path(noise_banks, name):
+    """TSV of the allowlisted noise `name`, None for clean audio; raises ValueError for unknown names"""
+    if name is None:
+        return None
+    if name not in noise_banks:
+        raise ValueError(f"Unknown noise: {name}. Available noises: {sorted(noise_banks)}")
+    return noise_banks[name]
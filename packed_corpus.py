@@ -0,0 +1,138 @@
+import os
+import json
+import numpy as np
+
+# One row per utterance of a shard, offsets and lengths in samples / frames / tokens
+INDEX_DTYPE = np.dtype([
+    ('audio_offset', np.int64), ('audio_len', np.int64),
+    ('video_offset', np.int64), ('video_len', np.int64),
+    ('tokens_offset', np.int64), ('tokens_len', np.int64),
+])
+
+
+def shard_prefix(corpus_dir, shard):
+    return os.path.join(corpus_dir, 'shard_{:05d}'.format(shard))
+
+
+class PackedCorpusWriter:
+    """
+    Pack utterances into shards of at most `shard_bytes`, each made of
+    shard_XXXXX.audio (int16 PCM), .video (uint8 T x H x W mouth ROIs), .tokens (int32 text tokens,
+    without the sot / language / task prefix), .index.npy (INDEX_DTYPE) and .utts.tsv (key, lang),
+    plus a meta.json for the whole corpus. `encoding` is the name of the tokenizer encoding
+    the tokens come from. Read with PackedCorpus.
+    """
+    def __init__(self, out_dir, encoding, video_size=(96, 96), shard_bytes=2 * 1024 ** 3):
+        self.out_dir = out_dir
+        self.encoding = encoding
+        self.video_size = tuple(video_size)
+        self.shard_bytes = shard_bytes
+        self.shard, self.n_samples = -1, 0
+        os.makedirs(out_dir, exist_ok=True)
+        self._open_shard()
+
+    def _open_shard(self):
+        self.shard += 1
+        prefix = shard_prefix(self.out_dir, self.shard)
+        self.files = {name: open('{}.{}'.format(prefix, name), 'wb') for name in ['audio', 'video', 'tokens']}
+        self.utts = open('{}.utts.tsv'.format(prefix), 'w')
+        self.index = []
+        self.offsets = {'audio': 0, 'video': 0, 'tokens': 0}
+        self.bytes = 0
+
+    def _close_shard(self):
+        for f in self.files.values():
+            f.close()
+        self.utts.close()
+        np.save('{}.index.npy'.format(shard_prefix(self.out_dir, self.shard)), np.array(self.index, dtype=INDEX_DTYPE))
+
+    def add(self, key, lang, audio, video, tokens):
+        audio = np.ascontiguousarray(audio, dtype=np.int16).flatten()
+        video = np.ascontiguousarray(video, dtype=np.uint8)
+        tokens = np.ascontiguousarray(tokens, dtype=np.int32)
+        assert video.shape[1:] == self.video_size, "expected {} frames, got {}".format(self.video_size, video.shape)
+        size = audio.nbytes + video.nbytes + tokens.nbytes
+        if self.index and self.bytes + size > self.shard_bytes:
+            self._close_shard()
+            self._open_shard()
+
+        row = []
+        for name, data, length in [('audio', audio, len(audio)), ('video', video, len(video)), ('tokens', tokens, len(tokens))]:
+            self.files[name].write(data.tobytes())
+            row += [self.offsets[name], length]
+            self.offsets[name] += length
+        self.index.append(tuple(row))
+        self.utts.write('{}\t{}\n'.format(key, lang))
+        self.bytes += size
+        self.n_samples += 1
+
+    def close(self):
+        self._close_shard()
+        with open(os.path.join(self.out_dir, 'meta.json'), 'w') as f:
+            json.dump({'n_shards': self.shard + 1, 'n_samples': self.n_samples,
+                       'video_size': self.video_size, 'encoding': self.encoding}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PackedCorpus:
+    """
+    Random access to a corpus written by PackedCorpusWriter. Only the small per-shard indices are
+    read up front; `corpus[i]` returns memory-mapped (zero-copy) audio, video and tokens. Shards are
+    mapped lazily, so every DataLoader worker maps them itself after the fork.
+    """
+    def __init__(self, corpus_dir):
+        self.corpus_dir = corpus_dir
+        with open(os.path.join(corpus_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.video_size = tuple(meta['video_size'])
+        self.encoding = meta['encoding']
+
+        indices, self.keys, self.langs = [], [], []
+        for shard in range(meta['n_shards']):
+            prefix = shard_prefix(corpus_dir, shard)
+            indices.append(np.load('{}.index.npy'.format(prefix)))
+            with open('{}.utts.tsv'.format(prefix)) as f:
+                for ln in f:
+                    key, lang = ln.rstrip('\n').split('\t')
+                    self.keys.append(key)
+                    self.langs.append(lang)
+        self.index = np.concatenate(indices)
+        self.shard_of = np.concatenate([np.full(len(index), shard) for shard, index in enumerate(indices)])
+        # first sample of every shard, sample ids of shard s are shard_starts[s]:shard_starts[s + 1]
+        self.shard_starts = np.cumsum([0] + [len(index) for index in indices])
+        self.maps = {}
+        print("Loaded packed corpus {} with {} samples in {} shards".format(corpus_dir, len(self), meta['n_shards']))
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def n_shards(self):
+        return len(self.shard_starts) - 1
+
+    @property
+    def audio_lengths(self):
+        return self.index['audio_len']
+
+    def shard_samples(self, shard):
+        return np.arange(self.shard_starts[shard], self.shard_starts[shard + 1])
+
+    def _map(self, shard, name):
+        if (shard, name) not in self.maps:
+            dtype = {'audio': np.int16, 'video': np.uint8, 'tokens': np.int32}[name]
+            data = np.memmap('{}.{}'.format(shard_prefix(self.corpus_dir, shard), name), dtype=dtype, mode='r')
+            self.maps[(shard, name)] = data.reshape(-1, *self.video_size) if name == 'video' else data
+        return self.maps[(shard, name)]
+
+    def __getitem__(self, id):
+        shard, row = int(self.shard_of[id]), self.index[id]
+        sample = {'key': self.keys[id], 'lang': self.langs[id]}
+        for name in ['audio', 'video', 'tokens']:
+            offset, length = row['{}_offset'.format(name)], row['{}_len'.format(name)]
+            sample[name] = self._map(shard, name)[offset:offset + length]
+        return sample
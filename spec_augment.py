@@ -2,6 +2,7 @@
 # Modified from ESPnet, takes into account max audio time
 import random
 import numpy
+import torch
 
 def freq_mask(x, audio_frames, F=30, n_mask=2, replace_with_zero=True, inplace=False):
     """freq mask for spec agument
@@ -114,3 +115,54 @@ def spec_augment(
         replace_with_zero=replace_with_zero,
     )
     return x
+
+def freq_mask_batch(mel, mel_lengths, F=30, n_mask=2):
+    """freq mask for batched spec agument, same sampling as freq_mask
+
+    :param torch.Tensor mel: (batch, freq, time), masked in place
+    :param torch.Tensor mel_lengths: (batch,) frames of every utterance (audio_frames)
+    :param int n_mask: the number of masks
+    """
+    B, num_mel_channels, T = mel.shape
+    f = torch.randint(0, F, (B, n_mask, 1), device=mel.device)
+    width = torch.randint(0, F, (B, n_mask, 1), device=mel.device)
+    f_zero = (torch.rand(B, n_mask, 1, device=mel.device) * (num_mel_channels - f)).long()
+    channels = torch.arange(num_mel_channels, device=mel.device)
+    # f == 0 means an empty range for f_zero in freq_mask, which skips the mask
+    mask = ((f > 0) & (channels >= f_zero) & (channels < f_zero + width)).any(dim=1) # batch, freq
+    frames = torch.arange(T, device=mel.device) < mel_lengths.to(mel.device)[:, None] # batch, time
+    return mel.masked_fill_(mask[:, :, None] & frames[:, None, :], 0)
+
+def time_mask_batch(mel, mel_lengths, T=40, n_mask=2):
+    """time mask for batched spec agument, same sampling as time_mask
+
+    :param torch.Tensor mel: (batch, freq, time), masked in place
+    :param torch.Tensor mel_lengths: (batch,) frames of every utterance (audio_frames)
+    :param int n_mask: the number of masks
+    """
+    B = mel.shape[0]
+    len_spectro = mel_lengths.to(mel.device)[:, None, None]
+    t = torch.randint(0, T, (B, n_mask, 1), device=mel.device)
+    width = torch.randint(0, T, (B, n_mask, 1), device=mel.device)
+    t_zero = (torch.rand(B, n_mask, 1, device=mel.device) * (len_spectro - t).clamp(min=0)).long()
+    frames = torch.arange(mel.shape[-1], device=mel.device)
+    # masks skipped by time_mask: no room for t, or t == 0
+    mask = ((len_spectro - t > 0) & (t > 0) & (frames >= t_zero) & (frames < t_zero + width)).any(dim=1) # batch, time
+    return mel.masked_fill_(mask[:, None, :], 0)
+
+def spec_augment_batch(mel, mel_lengths, policy):
+    """spec augment a batch of log-mels in place, on the device of the batch
+
+    :param torch.Tensor mel: (batch, freq, time), padded
+    :param torch.Tensor mel_lengths: (batch,) frames of every utterance, masks stay within them
+    :param str policy: "ls-double" (defaults of spec_augment) or "ls-basic" (one freq and one time mask)
+    """
+    if policy == "ls-double":
+        n_freq_mask, n_time_mask = 2, 2
+    elif policy == "ls-basic":
+        n_freq_mask, n_time_mask = 1, 1
+    else:
+        raise NotImplementedError
+    freq_mask_batch(mel, mel_lengths, F=27, n_mask=n_freq_mask)
+    time_mask_batch(mel, mel_lengths, T=100, n_mask=n_time_mask)
+    return mel
@@ -0,0 +1,227 @@
+import time
+from dataclasses import replace
+from typing import List, Optional
+
+import numpy as np
+import torch
+import whisper
+from whisper.audio import N_SAMPLES, SAMPLE_RATE, VIDEO_FRAMES_PER_SECOND
+
+from utils import preprocess_video_batch
+
+SAMPLES_PER_VIDEO_FRAME = SAMPLE_RATE // VIDEO_FRAMES_PER_SECOND  # 640
+
+
+def common_prefix(a: List[int], b: List[int]) -> List[int]:
+    n = 0
+    while n < min(len(a), len(b)) and a[n] == b[n]:
+        n += 1
+    return a[:n]
+
+
+def percentiles(values):
+    if not values:
+        return None
+    return {
+        "p50": round(float(np.percentile(values, 50)), 2),
+        "p90": round(float(np.percentile(values, 90)), 2),
+        "max": round(float(np.max(values)), 2),
+    }
+
+
+class StreamingSession:
+    """
+    Incremental AVSR over a rolling window of at most `max_window_s` seconds.
+
+    Audio (16 kHz int16 PCM) and 25 fps grayscale video frames are appended as they
+    arrive, media of a modality the session does not use is dropped. A modality may run
+    ahead of the other by at most the window and one step, beyond that add_audio and
+    add_video_frame raise ValueError instead of buffering without bound. Every `step_s` seconds of new media the whole window is decoded again,
+    with the text finalized in earlier windows as `prompt` and the tokens committed
+    in the current window as `prefix`, so only the uncommitted tail is re-decoded.
+    Tokens on which two successive decodes agree are committed (local agreement).
+    Once the window is full it is cut at the quietest 100 ms of its last
+    `cut_search_s` seconds: the part before the cut is decoded a last time and
+    emitted as final, the rest starts the next window.
+    """
+    def __init__(self, model, options: whisper.DecodingOptions, modalities="avsr", step_s=1.0,
+                 max_window_s=20.0, cut_search_s=3.0, video_height=96, video_width=96):
+        assert max_window_s * SAMPLE_RATE <= N_SAMPLES, "the window must fit in the 30 s encoder context"
+        self.model = model
+        self.options = options
+        self.modalities = modalities
+        self.step = int(step_s * SAMPLE_RATE)
+        self.max_window = int(max_window_s * SAMPLE_RATE)
+        self.cut_search = int(cut_search_s * SAMPLE_RATE)
+        self.video_shape = (video_height, video_width)
+        self.dtype = torch.float16 if options.fp16 else torch.float32
+        self.tokenizer = whisper.tokenizer.get_tokenizer(
+            model.is_multilingual, num_languages=model.num_languages,
+            language=options.language, task=options.task,
+        )
+
+        self.audio = np.zeros(0, dtype=np.float32)  # samples of the current window
+        self.frames = []  # uint8 video frames of the current window
+        self.window_start = 0  # in samples since the start of the stream
+        self.decoded_until = 0  # window length at the last decode
+        self.context: List[int] = []  # tokens finalized in previous windows
+        self.committed: List[int] = []  # tokens committed in the current window
+        self.hypothesis: List[int] = []  # uncommitted tail of the last decode
+
+        self.started = None
+        self.first_token_ms = None
+        self.chunk_latencies_ms = []
+        self.decode_ms = []
+
+    @property
+    def uses_audio(self):
+        return self.modalities != "vsr"
+
+    @property
+    def uses_video(self):
+        return self.modalities != "asr"
+
+    @property
+    def window_len(self):
+        """Samples of media in the current window, audio and video both need to be there"""
+        lengths = []
+        if self.uses_audio:
+            lengths.append(len(self.audio))
+        if self.uses_video:
+            lengths.append(len(self.frames) * SAMPLES_PER_VIDEO_FRAME)
+        return min(lengths)
+
+    def add_audio(self, pcm: bytes):
+        if not self.uses_audio:
+            return
+        self._check_buffered("audio", len(self.audio))
+        self.started = self.started or time.perf_counter()
+        chunk = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+        self.audio = np.concatenate([self.audio, chunk])
+
+    def add_video_frame(self, frame: bytes):
+        if not self.uses_video:
+            return
+        self._check_buffered("video", len(self.frames) * SAMPLES_PER_VIDEO_FRAME)
+        self.started = self.started or time.perf_counter()
+        self.frames.append(np.frombuffer(frame, dtype=np.uint8).reshape(self.video_shape))
+
+    def _check_buffered(self, modality, buffered):
+        # the window is decoded every step and cut beyond max_window, so only a lagging
+        # other modality lets a buffer grow past both
+        if buffered > self.max_window + self.step:
+            raise ValueError(f"{modality} is {(buffered - self.window_len) / SAMPLE_RATE:.1f} s ahead of the "
+                             f"other modality, more than the {self.max_window / SAMPLE_RATE:.0f} s window")
+
+    def ready(self):
+        return self.window_len - self.decoded_until >= self.step
+
+    def update(self, received: float) -> List[dict]:
+        """
+        Decode the window and return the events to send: "final" when the window was cut,
+        "commit" for newly agreed text and a "partial" with the current full hypothesis.
+        `received` is the perf_counter time the chunk triggering this update arrived.
+        """
+        events = []
+        if self.window_len > self.max_window:
+            events.append(self._finalize(self._quietest_cut()))
+
+        end = self.window_len
+        tokens = self._decode(end, prefix=self.committed)
+        self.decoded_until = end
+        agreed = common_prefix(tokens, self.hypothesis)
+        if agreed:
+            self.committed += agreed
+            events.append({"type": "commit", "text": self.tokenizer.decode(agreed)})
+        self.hypothesis = tokens[len(agreed):]
+        events.append({
+            "type": "partial",
+            "text": self.tokenizer.decode(self.committed + self.hypothesis),
+            "committed": self.tokenizer.decode(self.committed),
+        })
+        return self._add_latency(events, received)
+
+    def finish(self, received: float) -> List[dict]:
+        """Decode what is left of the window as final"""
+        events = []
+        if self.window_len > 0:
+            events.append(self._finalize(self.window_len))
+        events = self._add_latency(events, received)
+        events.append(self.summary())
+        return events
+
+    def summary(self):
+        return {
+            "type": "summary",
+            "time_to_first_token_ms": self.first_token_ms,
+            "chunk_latency_ms": percentiles(self.chunk_latencies_ms),
+            "decode_ms": percentiles(self.decode_ms),
+        }
+
+    def _finalize(self, cut):
+        tokens = self.committed + self._decode(cut, prefix=self.committed)
+        event = {
+            "type": "final",
+            "text": self.tokenizer.decode(tokens),
+            "start": round(self.window_start / SAMPLE_RATE, 2),
+            "end": round((self.window_start + cut) / SAMPLE_RATE, 2),
+        }
+        self.context += tokens
+        self.committed, self.hypothesis = [], []
+        self.window_start += cut
+        self.audio = self.audio[cut:]
+        self.frames = self.frames[cut // SAMPLES_PER_VIDEO_FRAME:]
+        self.decoded_until = 0
+        return event
+
+    def _quietest_cut(self):
+        """End of the quietest 100 ms in the last `cut_search` samples of the window"""
+        end = self.window_len
+        if not self.uses_audio:
+            return end
+        hop = SAMPLE_RATE // 10
+        start = max(0, end - self.cut_search)
+        frames = self.audio[start:end][: (end - start) // hop * hop].reshape(-1, hop)
+        if len(frames) == 0:
+            return end
+        quietest = int(np.argmin((frames ** 2).mean(axis=1)))
+        # cut on a video frame boundary so both modalities stay aligned
+        cut = start + (quietest + 1) * hop
+        return max(SAMPLES_PER_VIDEO_FRAME, cut // SAMPLES_PER_VIDEO_FRAME * SAMPLES_PER_VIDEO_FRAME)
+
+    @torch.no_grad()
+    def _decode(self, end, prefix: Optional[List[int]] = None) -> List[int]:
+        start = time.perf_counter()
+        device = self.model.device
+        if self.uses_audio:
+            audio = self.audio[:end]
+        else: # video-only: the encoder drops the audio features, silence only sets the duration
+            audio = np.zeros(end, dtype=np.float32)
+        mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(audio, N_SAMPLES), n_mels=self.model.dims.n_mels)
+        mel = mel.unsqueeze(0).to(device=device, dtype=self.dtype)
+
+        video = None
+        if self.uses_video:
+            frames = np.stack(self.frames[: end // SAMPLES_PER_VIDEO_FRAME])
+            video = torch.from_numpy(frames).unsqueeze(0).to(device)
+            video = preprocess_video_batch(video, dtype=self.dtype) # [B, C, T, H, W]
+
+        options = replace(self.options, prompt=self.context or None, prefix=prefix or None)
+        if self.modalities == "avsr":
+            result = self.model.decode(mel, options, video)
+        elif self.modalities == "asr":
+            result = self.model.decode(mel, options, test_a=True)
+        else:
+            result = self.model.decode(mel, options, video, test_v=True)
+        self.decode_ms.append(1000 * (time.perf_counter() - start))
+        return [t for t in result[0].tokens if t < self.tokenizer.eot]
+
+    def _add_latency(self, events, received):
+        now = time.perf_counter()
+        latency_ms = round(1000 * (now - received), 2)
+        self.chunk_latencies_ms.append(latency_ms)
+        if self.first_token_ms is None and any(e.get("text", "").strip() for e in events):
+            self.first_token_ms = round(1000 * (now - self.started), 2)
+        for event in events:
+            event["latency_ms"] = latency_ms
+        return events
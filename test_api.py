@@ -21,7 +21,7 @@ params_dict = {
     "beam_size": 1,  # Use integer if the server expects it; otherwise, keep as "1"
     "fp16": 0,  # Use integer if the server expects it; otherwise, keep as "0"
     "checkpoint_path": "models/whisper-flamingo_en-x_small.pt",
-    "noise_fn": "noise/babble/muavic/test.tsv"
+    "noise": "babble"  # one of the server's NOISE_BANKS
 }
 
 # Convert the parameters dictionary to a JSON string
@@ -0,0 +1,144 @@
+import random
+
+import numpy as np
+import pytest
+import torch
+from scipy.io import wavfile
+
+import whisper
+from noise_bank import NoiseBank, mix_noise
+from spec_augment import spec_augment, spec_augment_batch, time_mask, time_mask_batch
+from utils import add_noise
+from whisper.audio import HOP_LENGTH, SAMPLE_RATE
+
+N_ROWS = 2000  # draws compared between the per-sample and the batched masks
+
+
+def seed(value=3407):
+    random.seed(value)
+    np.random.seed(value)
+    torch.manual_seed(value)
+
+
+def masked_frames(mel):
+    """(batch, freq, time) -> (batch, time) frames zeroed over all the frequencies"""
+    return (mel == 0).all(dim=1)
+
+
+def test_time_mask_batch_starts_within_lengths():
+    seed()
+    lengths = torch.randint(1, 300, (N_ROWS,))
+    mel = time_mask_batch(torch.ones(N_ROWS, 80, 340), lengths, T=40, n_mask=2)
+    zeroed = mel == 0
+    assert (zeroed == zeroed[:, :1]).all()  # whole frames, every frequency
+    frames = masked_frames(mel)
+    # at most two runs of masked frames, starting within the utterance (as in time_mask, a mask
+    # may run past its end), each shorter than T
+    starts = frames.int().diff(dim=1, prepend=torch.zeros(N_ROWS, 1, dtype=torch.int)) == 1
+    assert starts.sum(dim=1).max().item() <= 2
+    assert not (starts & (torch.arange(340) >= lengths[:, None])).any()
+    assert frames.sum(dim=1).max().item() < 2 * 40
+
+
+def test_time_mask_batch_matches_time_mask():
+    length = 300
+    seed()
+    reference = np.stack([time_mask(np.ones((length, 80), dtype=np.float32), length, T=40, n_mask=2)
+                          for _ in range(N_ROWS)])
+    reference = masked_frames(torch.from_numpy(reference).transpose(1, 2))
+    seed()
+    batched = masked_frames(time_mask_batch(torch.ones(N_ROWS, 80, length), torch.full((N_ROWS,), length), T=40, n_mask=2))
+
+    # same distribution of masks: number of masked frames, and where they fall
+    assert batched.sum(dim=1).float().mean().item() == pytest.approx(reference.sum(dim=1).float().mean().item(), abs=2)
+    assert (batched.float().mean(dim=0).view(-1, 30).mean(dim=1).tolist()
+            == pytest.approx(reference.float().mean(dim=0).view(-1, 30).mean(dim=1).tolist(), abs=0.03))
+
+
+@pytest.mark.parametrize("policy, n_masks", [("ls-double", 2), ("ls-basic", 1)])
+def test_spec_augment_batch_matches_spec_augment(policy, n_masks):
+    length, padded = 250, 400
+    seed()
+    reference = np.stack([spec_augment(np.ones((padded, 80), dtype=np.float32), length,
+                                       n_freq_mask=n_masks, n_time_mask=n_masks) for _ in range(N_ROWS)])
+    reference = torch.from_numpy(reference).transpose(1, 2)
+    seed()
+    batched = spec_augment_batch(torch.ones(N_ROWS, 80, padded), torch.full((N_ROWS,), length), policy)
+
+    # the frequency masks stay within the utterance, time masks may run a little past it
+    assert (batched[:, :, length + 100:] == 1).all() and (reference[:, :, length + 100:] == 1).all()
+    assert (batched == 0).float().mean().item() == pytest.approx((reference == 0).float().mean().item(), abs=0.01)
+    assert (masked_frames(batched).float().mean().item()
+            == pytest.approx(masked_frames(reference).float().mean().item(), abs=0.01))
+
+
+@pytest.fixture
+def noise_tsv(tmp_path):
+    """A TSV of two noise wavs, one shorter (tiled) and one longer (cut) than the clean audio"""
+    rng = np.random.default_rng(0)
+    fns = []
+    for i, length in enumerate([3000, 20000]):
+        fn = str(tmp_path / f"noise_{i}.wav")
+        wavfile.write(fn, SAMPLE_RATE, (rng.standard_normal(length) * 3000).astype(np.int16))
+        fns.append(fn)
+    tsv = tmp_path / "noise.tsv"
+    tsv.write_text("\n".join(fns) + "\n")
+    return str(tsv), fns
+
+
+@pytest.mark.parametrize("noise_id", [0, 1])
+@pytest.mark.parametrize("snr, scale", [(0, 0.1), (10, 0.1), (-5, 0.9)])  # the last one clips
+def test_noise_bank_mix_matches_add_noise(noise_tsv, noise_id, snr, scale):
+    tsv, fns = noise_tsv
+    bank = NoiseBank(tsv)
+    clean = (np.random.default_rng(1).uniform(-1, 1, 8000) * scale).astype(np.float32)
+    clean_int16 = (clean * 32768).astype(np.int16)
+
+    expected = add_noise(clean_int16, [fns[noise_id]], snr).astype(np.float32) / 32768
+    mixed = bank.mix(clean_int16[None] / 32768, [len(clean)], [noise_id], [snr])[0]
+    np.testing.assert_allclose(mixed, expected, atol=2 / 32768)  # add_noise truncates to int16
+
+
+def test_noise_bank_mix_batch_matches_rows(noise_tsv):
+    tsv, _ = noise_tsv
+    bank = NoiseBank(tsv)
+    lengths = [8000, 5000, 6000]
+    audio = np.zeros((3, 8000), dtype=np.float32)
+    for i, length in enumerate(lengths):
+        audio[i, :length] = np.random.default_rng(i).uniform(-0.1, 0.1, length)
+    noise_ids, snrs = [1, -1, 0], [0, 0, 5]
+
+    mixed = bank.mix(audio, lengths, noise_ids, snrs)
+    np.testing.assert_array_equal(mixed[1], audio[1])  # negative id, clean
+    for i in [0, 2]:
+        alone = bank.mix(audio[i:i + 1, :lengths[i]], [lengths[i]], [noise_ids[i]], [snrs[i]])[0]
+        np.testing.assert_allclose(mixed[i, :lengths[i]], alone, rtol=1e-5, atol=1e-7)
+        assert (mixed[i, lengths[i]:] == 0).all()  # padding stays zero
+
+
+def test_mix_noise_matches_add_noise(noise_tsv):
+    tsv, fns = noise_tsv
+    bank = NoiseBank(tsv)
+    clean_int16 = (np.random.default_rng(2).uniform(-0.1, 0.1, 8000) * 32768).astype(np.int16)
+    for value in range(5):  # the same noise wav is drawn from the same seed
+        np.random.seed(value)
+        expected = add_noise(clean_int16, fns, 0).astype(np.float32) / 32768
+        np.random.seed(value)
+        mixed = mix_noise(clean_int16 / 32768, bank, 0)
+        np.testing.assert_allclose(mixed, expected, atol=2 / 32768)
+
+
+def test_log_mel_spectrogram_batch_matches_log_mel_spectrogram():
+    lengths = [SAMPLE_RATE * 2, SAMPLE_RATE + 123, 7 * HOP_LENGTH]
+    rng = np.random.default_rng(3)
+    audio = np.zeros((len(lengths), max(lengths)), dtype=np.float32)
+    for i, length in enumerate(lengths):
+        audio[i, :length] = rng.uniform(-0.5, 0.5, length)
+
+    mel, n_frames = whisper.log_mel_spectrogram_batch(torch.from_numpy(audio), torch.tensor(lengths))
+    assert n_frames.tolist() == [length // HOP_LENGTH for length in lengths]
+    for i, n in enumerate(n_frames.tolist()):
+        # the datasets computed the log-mel of each zero-padded utterance
+        expected = whisper.log_mel_spectrogram(audio[i])
+        torch.testing.assert_close(mel[i, :, :n], expected[:, :n], rtol=1e-4, atol=1e-4)
+        assert (mel[i, :, n:] == 0).all()
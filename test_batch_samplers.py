@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from utils_batch_samplers import CostBatchSampler
+
+COSTS = np.random.default_rng(0).integers(10, 300, size=203)
+BATCH_COST = 1000
+
+
+def samplers(num_replicas, **kwargs):
+    return [CostBatchSampler(COSTS, BATCH_COST, num_replicas=num_replicas, rank=rank, seed=3407, **kwargs)
+            for rank in range(num_replicas)]
+
+
+def test_batches_stay_within_the_cost():
+    sampler, = samplers(1)
+    batches = list(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(COSTS)))
+    for batch in batches:
+        costs = COSTS[list(batch)]
+        assert len(batch) * costs.max() <= BATCH_COST
+        assert list(costs) == sorted(costs, reverse=True)  # sort_in_batch="descending"
+
+
+def test_sample_above_the_cost_gets_its_own_batch():
+    sampler = CostBatchSampler([5, 2000, 5], BATCH_COST)
+    assert sorted(list(sampler), key=len) == [(1,), (2, 0)]
+
+
+@pytest.mark.parametrize("drop_last", [True, False])
+@pytest.mark.parametrize("num_replicas", [2, 3, 4])
+def test_ranks_get_the_same_number_of_batches(num_replicas, drop_last):
+    ranks = samplers(num_replicas, drop_last=drop_last)
+    per_rank = [list(sampler) for sampler in ranks]
+    assert len({len(batches) for batches in per_rank}) == 1
+    assert all(len(sampler) == len(per_rank[0]) for sampler in ranks)
+
+    seen = [i for batches in per_rank for batch in batches for i in batch]
+    if drop_last: # the cheapest remainder is dropped, nothing is repeated
+        assert len(seen) == len(set(seen))
+    else: # the cheapest batches are repeated, nothing is dropped
+        assert set(seen) == set(range(len(COSTS)))
+
+    # at every step the ranks run batches of about the same cost: neighbours in the cost order
+    batch_list = ranks[0].batch_list
+    batch_costs = [len(batch) * COSTS[list(batch)].max() for batch in batch_list]
+    cost_rank = np.argsort(np.argsort(batch_costs, kind="stable"), kind="stable")
+    for step in zip(*per_rank):
+        ranks_in_step = [cost_rank[batch_list.index(batch)] for batch in step]
+        assert max(ranks_in_step) - min(ranks_in_step) <= num_replicas
+
+
+def test_epochs_are_deterministic():
+    first, second = samplers(2), samplers(2)
+    for sampler in second:
+        sampler.set_epoch(0)
+    assert [list(s) for s in first] == [list(s) for s in second]
+
+    for sampler in second:
+        sampler.set_epoch(1)
+    epoch_1 = [list(s) for s in second]
+    assert epoch_1 != [list(s) for s in first]
+    # same batches, shuffled
+    assert sorted(b for batches in epoch_1 for b in batches) == sorted(b for s in first for b in s)
+    for sampler in second:
+        sampler.set_epoch(1)
+    assert [list(s) for s in second] == epoch_1
+
+
+@pytest.mark.parametrize("batches_done", [0, 1, 5])
+def test_resume_mid_epoch(batches_done):
+    for rank, sampler in enumerate(samplers(2, epoch=3)):
+        expected = list(sampler)
+        state = sampler.state_dict(batches_done)
+
+        resumed = CostBatchSampler(COSTS, BATCH_COST, num_replicas=2, rank=rank, seed=3407)
+        resumed.load_state_dict(state)
+        assert resumed.epoch == 3
+        assert len(resumed) == len(expected) - batches_done
+        assert list(resumed) == expected[batches_done:]
+
+        # only the resumed epoch is shortened
+        assert len(resumed) == len(expected)
+        assert list(resumed) == expected
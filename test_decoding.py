@@ -0,0 +1,100 @@
+import pytest
+import torch
+
+import whisper
+from whisper.decoding import DecodingTask, Inference
+from whisper.model import disable_sdpa
+
+
+class FullSequenceInference(Inference):
+    """Decoder forward over all the tokens at every step, without any kv cache"""
+    def __init__(self, model):
+        self.model = model
+
+    def logits(self, tokens, audio_features, x_v, xa_padding_mask=None, xv_padding_mask=None):
+        return self.model.decoder(tokens, audio_features, xv=x_v, xa_padding_mask=xa_padding_mask,
+                                  xv_padding_mask=xv_padding_mask)
+
+    def rearrange_kv_cache(self, source_indices):
+        pass  # the tokens are reordered by the decoder, nothing is cached
+
+
+class RecordingInference(Inference):
+    """Keeps the logits of the last token of every step"""
+    def __init__(self, inference):
+        self.inference = inference
+        self.steps = []
+
+    def logits(self, *args, **kwargs):
+        logits = self.inference.logits(*args, **kwargs)
+        self.steps.append(logits[:, -1].clone())
+        return logits
+
+    def rearrange_kv_cache(self, source_indices):
+        self.inference.rearrange_kv_cache(source_indices)
+
+    def cleanup_caching(self):
+        self.inference.cleanup_caching()
+
+
+def run_task(model, options, mel, x_v=None, cached=True):
+    task = DecodingTask(model, options)
+    inference = RecordingInference(task.inference if cached else FullSequenceInference(model))
+    task.inference = inference
+    if hasattr(task.decoder, "inference"): # beam search reorders the cache
+        task.decoder.inference = inference
+    results = task.run(mel, x_v)
+    return [result.tokens for result in results], torch.stack(inference.steps)
+
+
+def inputs(video, batch_size=2, n_frames=12):
+    generator = torch.Generator().manual_seed(1)
+    mel = torch.randn(batch_size, 80, 48, generator=generator)
+    x_v = torch.randn(batch_size, n_frames, 512, generator=generator) if video else None
+    return mel, x_v
+
+
+@pytest.mark.parametrize("video", [False, True])
+@pytest.mark.parametrize("beam_size", [None, 3])
+def test_kv_cache_matches_full_decoding(tiny_whisper, video, beam_size):
+    model = tiny_whisper(video=video)
+    mel, x_v = inputs(video)
+    options = whisper.DecodingOptions(language="en", fp16=False, without_timestamps=True,
+                                      beam_size=beam_size, sample_len=16)
+
+    cached_tokens, cached_logits = run_task(model, options, mel, x_v, cached=True)
+    full_tokens, full_logits = run_task(model, options, mel, x_v, cached=False)
+
+    assert cached_tokens == full_tokens
+    assert cached_logits.shape == full_logits.shape
+    torch.testing.assert_close(cached_logits, full_logits, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("video", [False, True])
+@pytest.mark.parametrize("beam_size", [None, 3])
+def test_sdpa_matches_explicit_attention(tiny_whisper, video, beam_size):
+    model = tiny_whisper(video=video)
+    mel, x_v = inputs(video)
+    options = whisper.DecodingOptions(language="en", fp16=False, without_timestamps=True,
+                                      beam_size=beam_size, sample_len=16)
+
+    sdpa_tokens, sdpa_logits = run_task(model, options, mel, x_v)
+    with disable_sdpa():
+        explicit_tokens, explicit_logits = run_task(model, options, mel, x_v)
+        full_tokens, full_logits = run_task(model, options, mel, x_v, cached=False)
+
+    assert sdpa_tokens == explicit_tokens == full_tokens
+    torch.testing.assert_close(sdpa_logits, explicit_logits, rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(explicit_logits, full_logits, rtol=1e-4, atol=1e-4)
+
+
+def test_kv_cache_is_reused_across_sequences(tiny_whisper):
+    model = tiny_whisper(video=True)
+    mel, x_v = inputs(True)
+    options = whisper.DecodingOptions(language="en", fp16=False, without_timestamps=True,
+                                      beam_size=3, sample_len=16)
+    task = DecodingTask(model, options)
+    first = [result.tokens for result in task.run(mel, x_v)]
+    # the preallocated buffers of the first run are reset, not carried over
+    second = [result.tokens for result in task.run(mel, x_v)]
+    assert first == second == run_task(model, options, mel, x_v, cached=False)[0]
@@ -0,0 +1,73 @@
+import torch
+
+from utils import pack_segments
+from whisper import pack_mel
+from whisper.audio import HOP_LENGTH
+from whisper.model import AudioEncoder
+
+ENCODER_FRAMES = [24, 11, 7, 5, 3]  # the tiny model's windows hold 24 encoder frames
+PACK_FRAMES = 24
+# first-fit decreasing, one free frame after every utterance; window 0 is filled to its last frame
+EXPECTED_SEGMENTS = [[0, 0, 24], [1, 0, 11], [1, 12, 7], [2, 0, 5], [1, 20, 3]]
+
+
+def segments():
+    audio_lengths = [2 * n * HOP_LENGTH for n in ENCODER_FRAMES]  # 2 mel frames per encoder frame
+    return pack_segments(audio_lengths, PACK_FRAMES)
+
+
+def padded_mel():
+    generator = torch.Generator().manual_seed(1)
+    mel = torch.zeros(len(ENCODER_FRAMES), 80, 2 * max(ENCODER_FRAMES))
+    for i, n in enumerate(ENCODER_FRAMES):
+        mel[i, :, :2 * n] = torch.randn(80, 2 * n, generator=generator)
+    return mel
+
+
+def test_pack_segments():
+    assert segments().tolist() == EXPECTED_SEGMENTS
+    # an odd number of mel frames rounds up, as the stride 2 conv does
+    assert pack_segments([5 * HOP_LENGTH, 4 * HOP_LENGTH], 10).tolist() == [[0, 0, 3], [0, 4, 2]]
+
+
+def test_pack_mel():
+    mel, segs = padded_mel(), segments()
+    packed, window_lengths = pack_mel(mel, segs)
+    assert packed.shape == (3, 80, 2 * PACK_FRAMES)
+    assert window_lengths.tolist() == [48, 46, 10]
+    filled = torch.zeros(packed.shape[0], packed.shape[-1], dtype=torch.bool)
+    for i, (window, start, length) in enumerate(segs.tolist()):
+        frames = slice(2 * start, 2 * (start + length))
+        torch.testing.assert_close(packed[window, :, frames], mel[i, :, :2 * length], rtol=0, atol=0)
+        filled[window, frames] = True
+    assert (packed.transpose(1, 2)[~filled] == 0).all()  # gaps and window ends are zero
+
+
+def test_packed_positions_and_unpack():
+    segs = segments()
+    segment_ids, positions = AudioEncoder.packed_positions(segs, 3, PACK_FRAMES)
+    assert segment_ids[1].tolist() == [1] * 11 + [-1] + [2] * 7 + [-1] + [4] * 3 + [-1]
+    assert positions[1].tolist() == list(range(11)) + [0] + list(range(7)) + [0] + list(range(3)) + [0]
+    assert segment_ids[0].tolist() == [0] * 24
+    assert positions[0].tolist() == list(range(24))
+    assert (segment_ids[2, 5:] == -1).all()
+
+    # every encoder frame holds (window, frame), unpack returns each utterance's frames in order
+    x = torch.stack(torch.meshgrid(torch.arange(3.), torch.arange(float(PACK_FRAMES)), indexing="ij"), dim=-1)
+    unpacked = AudioEncoder.unpack(x, segs)
+    assert unpacked.shape == (len(ENCODER_FRAMES), max(ENCODER_FRAMES), 2)
+    for i, (window, start, length) in enumerate(segs.tolist()):
+        assert unpacked[i, :length, 0].eq(window).all()
+        assert unpacked[i, :length, 1].tolist() == list(range(start, start + length))
+
+
+@torch.no_grad()
+def test_packed_encoding_matches_utterances_alone(tiny_whisper):
+    model = tiny_whisper()
+    mel, segs = padded_mel(), segments()
+    packed, window_lengths = pack_mel(mel, segs)
+    features, _ = model.encoder(packed, x_lengths=window_lengths, segments=segs)
+    assert features.shape[:2] == (len(ENCODER_FRAMES), max(ENCODER_FRAMES))
+    for i, n in enumerate(ENCODER_FRAMES):
+        alone, _ = model.encoder(mel[i:i + 1, :, :2 * n])
+        torch.testing.assert_close(features[i, :n], alone[0], rtol=1e-5, atol=1e-5)
@@ -0,0 +1,77 @@
+import pytest
+import torch
+
+import whisper
+from whisper.model import encoder_padding_mask
+
+MEL_LENGTHS = [48, 35, 20]  # 4 mel frames per 25 fps video frame, one odd: conv2 reads a conv1 frame past it
+VIDEO_LENGTHS = [(n + 1) // 4 for n in MEL_LENGTHS]
+
+
+def padded_batch():
+    """Zero-padded log-mels, cached video features (batch, frames, 512) and their masks"""
+    generator = torch.Generator().manual_seed(1)
+    mel = torch.zeros(len(MEL_LENGTHS), 80, max(MEL_LENGTHS))
+    x_v = torch.zeros(len(VIDEO_LENGTHS), max(VIDEO_LENGTHS), 512)
+    for i, (n_mel, n_video) in enumerate(zip(MEL_LENGTHS, VIDEO_LENGTHS)):
+        mel[i, :, :n_mel] = torch.randn(80, n_mel, generator=generator)
+        x_v[i, :n_video] = torch.randn(n_video, 512, generator=generator)
+    mel_lengths = torch.tensor(MEL_LENGTHS)
+    video_padding_mask = torch.arange(x_v.shape[1])[None] >= torch.tensor(VIDEO_LENGTHS)[:, None]
+    return mel, x_v, mel_lengths, video_padding_mask
+
+
+def alone(mel, x_v, i):
+    """Utterance i of the batch without any padding"""
+    return mel[i:i + 1, :, :MEL_LENGTHS[i]], x_v[i:i + 1, :VIDEO_LENGTHS[i]]
+
+
+def tokens(batch_size, n_tokens=6):
+    return torch.randint(0, 50000, (batch_size, n_tokens), generator=torch.Generator().manual_seed(2))
+
+
+@pytest.mark.parametrize("video, av_fusion", [(False, None), (True, "separate"), (True, "lip-reader")])
+@torch.no_grad()
+def test_padded_batch_matches_utterances_alone(tiny_whisper, video, av_fusion):
+    model = tiny_whisper(video=video, av_fusion=av_fusion)
+    mel, x_v, mel_lengths, video_padding_mask = padded_batch()
+    text = tokens(len(MEL_LENGTHS))
+
+    if video:
+        features, features_v = model.encoder(mel, x_v, padding_mask=video_padding_mask, x_lengths=mel_lengths)
+    else:
+        features, features_v = model.encoder(mel, x_lengths=mel_lengths)
+    xa_padding_mask = encoder_padding_mask(mel_lengths, features.shape[1])
+    xv_padding_mask = video_padding_mask if av_fusion == "separate" else None
+    logits = model.decoder(text, features, xv=features_v, xa_padding_mask=xa_padding_mask,
+                           xv_padding_mask=xv_padding_mask)
+
+    for i in range(len(MEL_LENGTHS)):
+        mel_i, x_v_i = alone(mel, x_v, i)
+        if video:
+            features_i, features_v_i = model.encoder(mel_i, x_v_i)
+        else:
+            features_i, features_v_i = model.encoder(mel_i)
+        n_features = (MEL_LENGTHS[i] + 1) // 2  # 50 Hz, for the lip-reader too (25 Hz video repeated)
+        assert features_i.shape[1] == n_features
+        torch.testing.assert_close(features[i, :n_features], features_i[0], rtol=1e-5, atol=1e-5)
+        if av_fusion == "separate":
+            torch.testing.assert_close(features_v[i, :VIDEO_LENGTHS[i]], features_v_i[0], rtol=1e-5, atol=1e-5)
+
+        logits_i = model.decoder(text[i:i + 1], features_i, xv=features_v_i)
+        torch.testing.assert_close(logits[i], logits_i[0], rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("video", [False, True])
+def test_padded_decoding_matches_utterances_alone(tiny_whisper, video):
+    model = tiny_whisper(video=video)
+    mel, x_v, mel_lengths, video_padding_mask = padded_batch()
+    options = whisper.DecodingOptions(language="en", fp16=False, without_timestamps=True, sample_len=16)
+
+    results = model.decode(mel, options, x_v if video else None, mel_lengths=mel_lengths,
+                           video_padding_mask=video_padding_mask if video else None)
+    for i, result in enumerate(results):
+        mel_i, x_v_i = alone(mel, x_v, i)
+        result_i = model.decode(mel_i, options, x_v_i if video else None)[0]
+        assert result.tokens == result_i.tokens
+        assert result.avg_logprob == pytest.approx(result_i.avg_logprob, abs=1e-4)
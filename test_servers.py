@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+import whisper_api
+import whisper_service
+
+AUDIO_LENGTHS = [7680, 5440, 3360]  # 48, 34 and 21 mel frames, the tiny model's windows hold 48
+VIDEO_LENGTHS = [12, 9, 5]  # 25 fps, 640 samples per frame
+FRAME_SHAPE = (96, 96)  # center cropped to 88 x 88
+
+
+def requests():
+    """(audio, uint8 video) of requests of different lengths, as returned by preprocess_media"""
+    rng = np.random.default_rng(0)
+    return [(rng.uniform(-0.5, 0.5, n_audio).astype(np.float32),
+             rng.integers(0, 256, (n_video, *FRAME_SHAPE), dtype=np.uint8))
+            for n_audio, n_video in zip(AUDIO_LENGTHS, VIDEO_LENGTHS)]
+
+
+@pytest.mark.parametrize("modalities", ["avsr", "asr", "vsr"])
+@pytest.mark.parametrize("server", [whisper_api, whisper_service])
+def test_batched_decode_matches_single_requests(tiny_whisper, monkeypatch, server, modalities):
+    model = tiny_whisper(video=True)
+    monkeypatch.setattr(server, "load_model", lambda *args: (model, None))
+    if server is whisper_api:
+        key = (None, modalities, "en", "transcribe", 1, FRAME_SHAPE)
+    else:
+        key = (None, modalities, "en", "transcribe", 1, 0, FRAME_SHAPE)
+    items = requests()
+
+    batched = server.decode_batch(key, items)
+    for item, result in zip(items, batched):
+        alone, = server.decode_batch(key, [item])
+        assert result["text"] == alone["text"]
+        if server is whisper_api:
+            assert result["num_tokens"] == alone["num_tokens"]
+            assert result["avg_logprob"] == pytest.approx(alone["avg_logprob"], abs=1e-4)
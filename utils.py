@@ -1,7 +1,10 @@
+import io
 import os
+import json
 import cv2
 import random
 from pathlib import Path
+from subprocess import DEVNULL, CalledProcessError, run
 import torch
 import torchaudio
 import torchaudio.transforms as at
@@ -18,6 +21,8 @@ from operator import itemgetter
 from typing import Iterator, Optional
 from torch.utils.data import Dataset, DistributedSampler
 from torch.utils.data.sampler import Sampler
+from manifest import Manifest, ManifestList
+from whisper.audio import HOP_LENGTH
 
 def load_wave(wave_path, sample_rate:int=16000) -> torch.Tensor:
     waveform, sr = torchaudio.load(wave_path, normalize=True)
@@ -25,9 +30,21 @@ def load_wave(wave_path, sample_rate:int=16000) -> torch.Tensor:
         waveform = at.Resample(sr, sample_rate)(waveform)
     return waveform
 
+def load_wave_bytes(data):
+    """Decode the bytes of an uploaded WAV file in memory, returns (sample_rate, samples)"""
+    return wavfile.read(io.BytesIO(data))
+
 def load_video_feats(video_path, train=False, image_crop_size=88, 
                image_mean=0.421, image_std=0.165):
-    feats = load_video_av_hubert(video_path)
+    if isinstance(video_path, (bytes, bytearray)): # in-memory upload
+        feats = load_video_bytes(video_path)
+    else:
+        feats = load_video_av_hubert(video_path)
+    return preprocess_video_frames(feats, train, image_crop_size, image_mean, image_std)
+
+def preprocess_video_frames(feats, train=False, image_crop_size=88, 
+                            image_mean=0.421, image_std=0.165):
+    """Normalize and crop grayscale uint8 frames (T, H, W), returns (T, H, W, C) float features"""
     if train:
         transform = Compose([
             Normalize( 0.0,255.0 ),
@@ -43,6 +60,35 @@ def load_video_feats(video_path, train=False, image_crop_size=88,
     feats = np.expand_dims(feats, axis=-1) # T, H, W, C
     return feats
 
+def preprocess_video_batch(video, padding_mask=None, train=False, image_crop_size=88,
+                           image_mean=0.421, image_std=0.165, dtype=torch.float32):
+    """
+    preprocess_video_frames for a collated batch of uint8 frames [B, T, H, W], run on its device:
+    one random (train) or center crop per utterance, horizontal flip of half of the utterances when
+    training, then mean / std normalization in `dtype`. Returns [B, C, T, H, W] with the padded
+    frames zeroed. Cached video features (float [B, T, F]) are only cast to `dtype`.
+    """
+    if video.dtype != torch.uint8:
+        return video.to(dtype)
+    B, T, H, W = video.shape
+    crop = torch.arange(image_crop_size, device=video.device)
+    if train:
+        delta_h = torch.randint(0, H - image_crop_size + 1, (B, 1), device=video.device)
+        delta_w = torch.randint(0, W - image_crop_size + 1, (B, 1), device=video.device)
+        flip = torch.rand(B, 1, device=video.device) < 0.5
+        cols = delta_w + torch.where(flip, crop.flip(0), crop)
+    else:
+        delta_h = torch.full((B, 1), (H - image_crop_size) // 2, device=video.device)
+        cols = (W - image_crop_size) // 2 + crop.expand(B, -1)
+    rows = delta_h + crop
+    # crop (and flip) every utterance with two gathers, on uint8 before it grows to `dtype`
+    video = video.gather(2, rows[:, None, :, None].expand(B, T, image_crop_size, W))
+    video = video.gather(3, cols[:, None, None, :].expand(B, T, image_crop_size, image_crop_size))
+    video = (video.to(dtype) / 255.0 - image_mean) / image_std
+    if padding_mask is not None:
+        video = video.masked_fill(padding_mask[:, :, None, None].to(video.device), 0)
+    return video.unsqueeze(1) # C = 1
+
 def load_video_av_hubert(path):
     for i in range(3):
         try:
@@ -63,6 +109,121 @@ def load_video_av_hubert(path):
                 raise ValueError(f"Unable to load {path}")
 
 
+def load_video_bytes(data):
+    """
+    Decode the bytes of a video through ffmpeg into grayscale uint8 frames (T, H, W),
+    without writing them to disk. Requires the ffmpeg CLI in PATH.
+    """
+    if not hasattr(os, "memfd_create"):
+        return decode_video_frames("pipe:0", input=bytes(data))
+    # mp4 files with the moov atom at the end need a seekable input, which a pipe is not,
+    # so hand ffmpeg an anonymous in-memory file instead
+    with os.fdopen(os.memfd_create("video"), "w+b") as f:
+        f.write(data)
+        f.flush()
+        return decode_video_frames(f"/proc/self/fd/{f.fileno()}", stdin=DEVNULL, pass_fds=(f.fileno(),))
+
+def decode_video_frames(source, **kwargs):
+    cmd = [
+        "ffmpeg",
+        "-loglevel", "error",
+        "-i", source,
+        "-f", "image2pipe",
+        "-vcodec", "pgm",
+        "-pix_fmt", "gray",
+        "pipe:1",
+    ]
+    try:
+        out = run(cmd, capture_output=True, check=True, **kwargs).stdout
+    except CalledProcessError as e:
+        raise ValueError(f"Unable to decode video: {e.stderr.decode()}") from e
+    if not out:
+        raise ValueError("Unable to decode video: no frames")
+
+    # every frame is a binary PGM image: b"P5\n<width> <height>\n<maxval>\n" followed by the pixels
+    magic, size, maxval, _ = out[:64].split(b"\n", 3)
+    width, height = map(int, size.split())
+    header_len = len(magic) + len(size) + len(maxval) + 3
+    frame_len = header_len + width * height
+    n_frames = len(out) // frame_len
+    frames = np.frombuffer(out, dtype=np.uint8, count=n_frames * frame_len)
+    return frames.reshape(n_frames, frame_len)[:, header_len:].reshape(n_frames, height, width)
+
+
+class VideoFeatureWriter:
+    """
+    Write per-utterance video_model features (T, F) into a sharded store read by VideoFeatureCache:
+    raw `dtype` shards of at most `shard_frames` frames, an index.tsv (key, shard, offset, length in frames)
+    and a meta.json with the feature dim and dtype
+    """
+    def __init__(self, out_dir, dim, dtype='float16', shard_frames=1000000):
+        self.out_dir = out_dir
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.shard_frames = shard_frames
+        self.shard, self.offset = 0, 0
+        os.makedirs(out_dir, exist_ok=True)
+        with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+            json.dump({'dim': dim, 'dtype': self.dtype.name, 'shard_frames': shard_frames}, f)
+        self.index = open(os.path.join(out_dir, 'index.tsv'), 'w')
+        self.data = open(self.shard_path(self.shard), 'wb')
+
+    def shard_path(self, shard):
+        return os.path.join(self.out_dir, 'shard_{:05d}.bin'.format(shard))
+
+    def add(self, key, feats):
+        feats = np.ascontiguousarray(feats, dtype=self.dtype)
+        assert feats.ndim == 2 and feats.shape[1] == self.dim, feats.shape
+        if self.offset > 0 and self.offset + len(feats) > self.shard_frames:
+            self.data.close()
+            self.shard, self.offset = self.shard + 1, 0
+            self.data = open(self.shard_path(self.shard), 'wb')
+        self.data.write(feats.tobytes())
+        self.index.write('{}\t{}\t{}\t{}\n'.format(key, self.shard, self.offset, len(feats)))
+        self.offset += len(feats)
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class VideoFeatureCache:
+    """
+    Read-only view of a store written by VideoFeatureWriter, `cache[key]` returns the (T, F) features.
+    Shards are memory-mapped lazily, so every DataLoader worker maps them itself after the fork
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.dim, self.dtype = meta['dim'], np.dtype(meta['dtype'])
+        self.index = {}
+        with open(os.path.join(cache_dir, 'index.tsv')) as f:
+            for ln in f:
+                key, shard, offset, length = ln.rstrip('\n').split('\t')
+                self.index[key] = (int(shard), int(offset), int(length))
+        self.shards = {}
+        print("Loaded {} cached video features from {}".format(len(self.index), cache_dir))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, key):
+        shard, offset, length = self.index[key]
+        if shard not in self.shards:
+            path = os.path.join(self.cache_dir, 'shard_{:05d}.bin'.format(shard))
+            self.shards[shard] = np.memmap(path, dtype=self.dtype, mode='r').reshape(-1, self.dim)
+        return self.shards[shard][offset:offset + length]
+
+
 class Compose(object):
     """Compose several preprocess together.
     Args:
@@ -214,7 +375,7 @@ def load_data(AUDIO_MAX_LENGTH, TEXT_MAX_LENGTH, langs=['en', 'ar', 'de', 'el',
               muavic_root='/data/sls/scratch/roudi/datasets/muavic/', reduce_val=None, include_audio_lens=False,
               AUDIO_MAX_LENGTH_VAL=480000, vc2=False, vc2_path='', lrs2=False, visible=False, task='transcribe'):
     # reduce_val: If not None, keep this number of samples from the validation set
-    audio_transcript_pair_list = {'train':[], 'valid':[], 'test':[]}
+    audio_transcript_pair_list = {split: ManifestList(include_audio_lens=include_audio_lens) for split in ['train', 'valid', 'test']}
     for lang in langs:
         for split in audio_transcript_pair_list:
             if lrs2:
@@ -242,36 +403,27 @@ def load_data(AUDIO_MAX_LENGTH, TEXT_MAX_LENGTH, langs=['en', 'ar', 'de', 'el',
                     tsv_fn = os.path.join(muavic_root, 'muavic', lang, 'en', '{}.tsv'.format(split))
                     txt_fn = os.path.join(muavic_root, 'muavic', lang, 'en', '{}.en'.format(split))
                 
-            with open(tsv_fn) as tsv:
-                with open(txt_fn) as txt:
-                    audio_lns = tsv.readlines()[1:]
-                    txt_lns = txt.readlines()
-                    # audio path, audio length, text, text length, video_length
-                    wav_fns = [(audio.strip().split('\t')[2],  int(audio.strip().split('\t')[-1]), txt.strip(), 
-                                len(txt.strip()), int(audio.strip().split('\t')[-2])) for audio, txt in zip(audio_lns, txt_lns)]
-                    pre_video_check = len(wav_fns)
-                    wav_fns =  list(filter(lambda x: x[4] > 0, wav_fns))
-                    post_video_check = len(wav_fns)
-                    print("Removed {} samples with missing video (before filtering lengths)".format(pre_video_check - post_video_check))
-                    pre_video_check = len(wav_fns)
-                    wav_fns =  list(filter(lambda x: x[3] > 0, wav_fns))
-                    post_video_check = len(wav_fns)
-                    print("Removed {} samples with missing text".format(pre_video_check - post_video_check))
-                    len_before = len(wav_fns)
-                    if split == 'train': 
-                        wav_fns =  list(filter(lambda x: x[1] <= AUDIO_MAX_LENGTH, wav_fns))
-                        wav_fns =  list(filter(lambda x: x[3] <= TEXT_MAX_LENGTH, wav_fns))
-                    elif split == 'valid': # whisper pos. embedding only up to 30s long, don't filter test
-                        wav_fns =  list(filter(lambda x: x[1] <= AUDIO_MAX_LENGTH_VAL, wav_fns))
-                    print("Total hours {} : {}".format(split, sum([int(x[1]) for x in wav_fns]) / 16000 / 3600))
-                    if not include_audio_lens:
-                        lang_filtered = [(lang, i[0], i[2]) for i in wav_fns]
-                    else: 
-                        lang_filtered = [(lang, i[0], i[2], i[1]) for i in wav_fns]
-                    if split == 'valid' or split == 'test' and reduce_val is not None:
-                        lang_filtered = lang_filtered[:reduce_val]
-                    len_after = len(lang_filtered)
-                    audio_transcript_pair_list[split] += lang_filtered
+            manifest = Manifest(tsv_fn, txt_fn)
+            rows = np.arange(len(manifest))
+            pre_video_check = len(rows)
+            rows = rows[manifest.video_lens[rows] > 0]
+            post_video_check = len(rows)
+            print("Removed {} samples with missing video (before filtering lengths)".format(pre_video_check - post_video_check))
+            pre_video_check = len(rows)
+            rows = rows[manifest.text_lens[rows] > 0]
+            post_video_check = len(rows)
+            print("Removed {} samples with missing text".format(pre_video_check - post_video_check))
+            len_before = len(rows)
+            if split == 'train': 
+                rows = rows[(manifest.audio_lens[rows] <= AUDIO_MAX_LENGTH) & (manifest.text_lens[rows] <= TEXT_MAX_LENGTH)]
+            elif split == 'valid': # whisper pos. embedding only up to 30s long, don't filter test
+                rows = rows[manifest.audio_lens[rows] <= AUDIO_MAX_LENGTH_VAL]
+            print("Total hours {} : {}".format(split, manifest.audio_lens[rows].sum() / 16000 / 3600))
+            if split == 'valid' or split == 'test' and reduce_val is not None:
+                rows = rows[:reduce_val]
+            len_after = len(rows)
+            # (lang, audio path, text[, audio length]) tuples, built on access
+            audio_transcript_pair_list[split] += ManifestList([(lang, manifest, rows)], include_audio_lens)
             print(lang, split, len_before, len_after)
     print("Total data lengths")
     print(len(audio_transcript_pair_list['train']))
@@ -279,75 +431,142 @@ def load_data(AUDIO_MAX_LENGTH, TEXT_MAX_LENGTH, langs=['en', 'ar', 'de', 'el',
     print(len(audio_transcript_pair_list['test']))
     return audio_transcript_pair_list
 
+class BatchBuffers:
+    """
+    Allocates the padded tensors of the collators, filled with `fill`. With reuse (collation in the main
+    process, num_workers=0) every key cycles through `depth` buffers, grown when a batch needs more, so
+    a batch stays valid until `depth` more batches are collated; with pin_memory they are pinned once
+    for fast non_blocking host-to-device copies. DataLoader workers send their batches through shared
+    memory, so they need fresh tensors (the default) and pin with the DataLoader's pin_memory instead.
+    """
+    def __init__(self, reuse=False, pin_memory=False, depth=2):
+        self.reuse = reuse
+        self.pin_memory = pin_memory
+        self.depth = depth
+        self.buffers = {} # key -> ring of flat tensors
+        self.step = 0
+
+    def next_batch(self):
+        self.step += 1
+
+    def get(self, key, shape, dtype, fill=0):
+        if not self.reuse:
+            return torch.full(shape, fill, dtype=dtype, pin_memory=self.pin_memory)
+        numel = int(np.prod(shape))
+        ring = self.buffers.setdefault(key, [None] * self.depth)
+        slot = self.step % self.depth
+        if ring[slot] is None or ring[slot].dtype != dtype or ring[slot].numel() < numel:
+            ring[slot] = torch.empty(numel, dtype=dtype, pin_memory=self.pin_memory)
+        return ring[slot][:numel].view(shape).fill_(fill)
+
+def pad_audio(features, noise_bank=None, buffers=None):
+    """
+    Zero-pad the raw waveforms of a batch to the longest one and mix in the noise drawn by the dataset
+    (the "noise" and "n_samples" of every feature), returns the padded batch [B, T] and the lengths in samples
+    """
+    buffers = buffers or BatchBuffers()
+    audio_lengths = torch.tensor([len(f["audio"]) for f in features])
+    audio = buffers.get("audio", (len(features), int(audio_lengths.max())), torch.float32)
+    audio_np = audio.numpy() # written in place, no intermediate copies
+    for i, f in enumerate(features):
+        audio_np[i, :len(f["audio"])] = f["audio"]
+    if noise_bank is not None:
+        noise_ids, snrs = zip(*[f["noise"] for f in features])
+        audio_np[:] = noise_bank.mix(audio_np, [f["n_samples"] for f in features], noise_ids, snrs)
+    return audio, audio_lengths
+
+def pad_tokens(features, buffers=None):
+    """Pad the labels with -100 (dummy, ignore index in cross-entropy) and the dec_input_ids with eot"""
+    buffers = buffers or BatchBuffers()
+    max_label_len = max(max(len(f["labels"]), len(f["dec_input_ids"])) for f in features) # seems redundant
+    labels = buffers.get("labels", (len(features), max_label_len), torch.long, fill=-100)
+    dec_input_ids = buffers.get("dec_input_ids", (len(features), max_label_len), torch.long, fill=50257) # 50257 is eot token id
+    labels_np, dec_input_ids_np = labels.numpy(), dec_input_ids.numpy()
+    for i, f in enumerate(features):
+        labels_np[i, :len(f["labels"])] = f["labels"]
+        dec_input_ids_np[i, :len(f["dec_input_ids"])] = f["dec_input_ids"]
+    return labels, dec_input_ids
+
+def pad_video(features, buffers=None):
+    """
+    0 pad the videos, uint8 frames (T, H, W) or cached features (T, F), returns the padded batch, the
+    lengths in frames and the padding mask (True for padded frames). The frames are cropped and
+    normalized on the device by preprocess_video_batch
+    """
+    buffers = buffers or BatchBuffers()
+    video_lengths = torch.tensor([len(f["video"]) for f in features])
+    max_video_len = int(video_lengths.max())
+    first = features[0]["video"]
+    dtype = torch.uint8 if first.dtype == np.uint8 else torch.float32
+    video = buffers.get("video", (len(features), max_video_len) + tuple(first.shape[1:]), dtype)
+    video_np = video.numpy()
+    for i, f in enumerate(features):
+        video_np[i, :len(f["video"])] = f["video"] # also reads memory-mapped frames of a packed corpus
+    padding_mask = torch.arange(max_video_len)[None, :] >= video_lengths[:, None]
+    return video, video_lengths, padding_mask
+
+def pack_segments(audio_lengths, pack_frames):
+    """
+    Plan the packing of a batch of utterances into windows of `pack_frames` encoder frames (1500 is
+    30 s), first-fit decreasing, with one free encoder frame after every utterance so the conv stem
+    does not see its neighbours. Returns the window, first encoder frame and number of encoder frames
+    of every utterance [B, 3], the packing of their log-mels is done on the device by whisper.pack_mel
+    """
+    n_frames = (np.asarray(audio_lengths) // HOP_LENGTH + 1) // 2 # stride 2 conv over the mel frames
+    segments = np.zeros((len(n_frames), 3), dtype=np.int64)
+    ends = [] # encoder frames filled in every window
+    for i in np.argsort(-n_frames, kind='stable'):
+        window = next((w for w, end in enumerate(ends) if end + n_frames[i] <= pack_frames), len(ends))
+        if window == len(ends):
+            ends.append(0)
+        segments[i] = window, ends[window], n_frames[i]
+        ends[window] += n_frames[i] + 1
+    return torch.from_numpy(segments)
+
 class WhisperDataCollatorWhithPadding:
+    """
+    Pads a batch straight into (optionally reused and pinned, see BatchBuffers) tensors. The raw audio
+    comes with its lengths, the log-mels are computed on the device with whisper.log_mel_spectrogram_batch.
+    With pack_frames the batch also comes with the "segments" of its utterances packed into windows of
+    that many encoder frames (pack_segments), for training
+    """
+    def __init__(self, noise_bank=None, reuse_buffers=False, pin_memory=False, pack_frames=0):
+        self.noise_bank = noise_bank # the dataset's noise_bank.NoiseBank, if it adds noise
+        self.buffers = BatchBuffers(reuse=reuse_buffers, pin_memory=pin_memory)
+        self.pack_frames = pack_frames
+
+    def pack(self, batch):
+        if self.pack_frames:
+            batch["segments"] = pack_segments(batch["audio_lengths"].numpy(), self.pack_frames)
+        return batch
+
     def __call__(self, features):
-        input_ids, labels, dec_input_ids = [], [], []
-        for f in features:
-            input_ids.append(f["input_ids"])
-            labels.append(f["labels"])
-            dec_input_ids.append(f["dec_input_ids"])
-
-        audio_lengths = [audio.shape[1] for audio in input_ids]
-        max_audio_len =  max(audio_lengths)
-        input_ids = [np.pad(audio, ((0, 0), (0, max_audio_len - audio_len)), 'constant', constant_values=0) for audio, audio_len in zip(input_ids, audio_lengths)]
-
-        label_lengths = [len(lab) for lab in labels]
-        dec_input_ids_length = [len(e) for e in dec_input_ids]
-        max_label_len = max(label_lengths+dec_input_ids_length) # seems redundant
-
-        # pad the labels with -100 (dummy, ignore index in cross-entropy), pad the dec_input_ids with eot
-        labels = [np.pad(lab, (0, max_label_len - lab_len), 'constant', constant_values=-100) for lab, lab_len in zip(labels, label_lengths)]
-        dec_input_ids = [np.pad(e, (0, max_label_len - e_len), 'constant', constant_values=50257) for e, e_len in zip(dec_input_ids, dec_input_ids_length)] # 50257 is eot token id
-
-        batch = {
-            "input_ids": input_ids,
+        audio, audio_lengths = pad_audio(features, self.noise_bank, self.buffers)
+        labels, dec_input_ids = pad_tokens(features, self.buffers)
+        self.buffers.next_batch()
+        return self.pack({
+            "audio": audio,
+            "audio_lengths": audio_lengths,
             "labels": labels,
             "dec_input_ids": dec_input_ids
-        }
-
-        batch = {k: torch.tensor(np.array(v), requires_grad=False) for k, v in batch.items()}
-
-        return batch
+        })
     
-class WhisperVideoCollatorWithPadding:
+class WhisperVideoCollatorWithPadding(WhisperDataCollatorWhithPadding):
+    """WhisperDataCollatorWhithPadding, plus the videos with their lengths and padding mask"""
     def __call__(self, features):
-        input_ids, labels, dec_input_ids, video = [], [], [], []
-        for f in features:
-            input_ids.append(f["input_ids"])
-            labels.append(f["labels"])
-            dec_input_ids.append(f["dec_input_ids"])
-            video.append(f["video"])
-
-        audio_lengths = [audio.shape[1] for audio in input_ids]
-        max_audio_len =  max(audio_lengths)
-        input_ids = [np.pad(audio, ((0, 0), (0, max_audio_len - audio_len)), 'constant', constant_values=0) for audio, audio_len in zip(input_ids, audio_lengths)]
-
-        label_lengths = [len(lab) for lab in labels]
-        dec_input_ids_length = [len(e) for e in dec_input_ids]
-        max_label_len = max(label_lengths+dec_input_ids_length) # seems redundant
-
-        # pad the labels with -100 (dummy, ignore index in cross-entropy), pad the dec_input_ids with eot
-        labels = [np.pad(lab, (0, max_label_len - lab_len), 'constant', constant_values=-100) for lab, lab_len in zip(labels, label_lengths)]
-        dec_input_ids = [np.pad(e, (0, max_label_len - e_len), 'constant', constant_values=50257) for e, e_len in zip(dec_input_ids, dec_input_ids_length)] # 50257 is eot token id
-
-        # 0 pad the videos
-        video_lengths = [len(vid) for vid in video]
-        max_video_len = max(video_lengths)
-        video = [np.pad(vid, ((0, max_video_len - vid_len), (0, 0), (0, 0), (0, 0)), 'constant', constant_values=0) for vid, vid_len in zip(video, video_lengths)]
-        padding_mask = create_padding_mask(max_video_len, [max_video_len - vid_len for vid_len in video_lengths])
-        
-        batch = {
-            "input_ids": input_ids,
+        audio, audio_lengths = pad_audio(features, self.noise_bank, self.buffers)
+        labels, dec_input_ids = pad_tokens(features, self.buffers)
+        video, video_lengths, padding_mask = pad_video(features, self.buffers)
+        self.buffers.next_batch()
+        return self.pack({
+            "audio": audio,
+            "audio_lengths": audio_lengths,
             "labels": labels,
             "dec_input_ids": dec_input_ids,
             "video": video,
+            "video_lengths": video_lengths,
             "padding_mask": padding_mask,
-        }
-
-        batch = {k: torch.tensor(np.array(v), requires_grad=False) for k, v in batch.items()}
-        batch['video'] = batch['video'].permute((0, 4, 1, 2, 3)).contiguous() # [B, T, H, W, C] -> [B, C, T, H, W]
-
-        return batch
+        })
     
 def create_padding_mask(T, padding_amounts):
     """
@@ -367,18 +586,22 @@ def create_padding_mask(T, padding_amounts):
     mask = padded_lens <= torch.arange(T, dtype=torch.long)[None, :]  # Add a dimension for broadcasting
     return mask
 
+def trainable_named_parameters(model):
+    """Named parameters which get gradients, frozen ones take no optimizer state"""
+    return [(n, p) for n, p in model.named_parameters() if p.requires_grad]
+
 def whisper_optimizer(model, cfg, t_total, video=True):
     no_decay = ["bias", "LayerNorm.weight"]
     projection = ["video_projection"] # linear layer and scalar
     if video and cfg.video_projection_separate_lr != '': # ft video projection separate lr
         optimizer_grouped_parameters = [
             {
-                "params": [p for n, p in model.named_parameters()
+                "params": [p for n, p in trainable_named_parameters(model)
                             if not any(nd in n for nd in projection)],
                 "lr": cfg.learning_rate,
             },
             {
-                "params": [p for n, p in model.named_parameters()
+                "params": [p for n, p in trainable_named_parameters(model)
                             if any(nd in n for nd in projection)],
                 "lr": cfg.video_projection_separate_lr,
             },
@@ -386,12 +609,12 @@ def whisper_optimizer(model, cfg, t_total, video=True):
     else:
         optimizer_grouped_parameters = [
             {
-                "params": [p for n, p in model.named_parameters()
+                "params": [p for n, p in trainable_named_parameters(model)
                             if not any(nd in n for nd in no_decay)],
                 "weight_decay": cfg.weight_decay,
             },
             {
-                "params": [p for n, p in model.named_parameters()
+                "params": [p for n, p in trainable_named_parameters(model)
                             if any(nd in n for nd in no_decay)],
                 "weight_decay": 0.0,
             },
@@ -434,19 +657,24 @@ def whisper_video_projection_optimizer(model, cfg, t_total):
     )
     return optimizer, scheduler
 
-def whisper_flamingo_projection_optimizer(model, cfg, t_total):
+def whisper_flamingo_trainable_layers(cfg):
+    """Name parts of the parameters trained with gated x-attn, the rest of the model is frozen"""
     video_projection = ["video_projection"]
     x_attn = ["gated_x_attn", "attn_gate", "ff"] if cfg.freeze_video_model else ["video_model", "gated_x_attn", "attn_gate", "ff"]
+    return x_attn + video_projection
+
+def whisper_flamingo_projection_optimizer(model, cfg, t_total):
+    trainable_layers = whisper_flamingo_trainable_layers(cfg)
     optimizer_grouped_parameters = [
         {
-            "params": [p for n, p in model.named_parameters()
-                        if any(nd in n for nd in x_attn + video_projection)],
+            "params": [p for n, p in trainable_named_parameters(model)
+                        if any(nd in n for nd in trainable_layers)],
             "lr": cfg.learning_rate,
         },
     ]
     print("optimizing params: ")
-    print([n for n, p in model.named_parameters()
-                        if any(nd in n for nd in x_attn + video_projection)])
+    print([n for n, p in trainable_named_parameters(model)
+                        if any(nd in n for nd in trainable_layers)])
     optimizer = AdamW(optimizer_grouped_parameters,
                         lr=cfg.learning_rate,
                         eps=cfg.adam_epsilon,
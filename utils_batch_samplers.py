@@ -207,4 +207,104 @@ class LengthBatchSampler(Sampler):
         return len(self.batch_list)
 
     def __iter__(self) -> Iterator[Tuple[str, ...]]:
-        return iter(self.batch_list)
\ No newline at end of file
+        return iter(self.batch_list)
+
+class CostBatchSampler(Sampler):
+    """Distributed bucketing batch sampler sized by compute.
+
+    Samples sorted by `costs` (e.g. audio samples plus weighted video frames and
+    text length) are cut into batches whose padded cost, batch size x max cost,
+    stays within `batch_cost`. Each epoch the batches are sorted by cost and
+    dealt `num_replicas` at a time, so at every step all ranks run batches of
+    about the same cost instead of waiting at the all-reduce for the rank with
+    the longest one. The rank of every batch within a step and the order of the
+    steps are shuffled with (seed, epoch), identically on every rank, and every
+    rank gets the same number of batches: the cheapest remainder is dropped with
+    drop_last, else the cheapest batches are repeated.
+
+    Use as the DataLoader's batch_sampler with use_distributed_sampler=False.
+    state_dict() / load_state_dict() skip the batches already trained on when
+    resuming mid-epoch.
+    """
+
+    def __init__(
+        self,
+        costs,
+        batch_cost: float,
+        num_replicas: int = 1,
+        rank: int = 0,
+        seed: int = 0,
+        epoch: int = 0,
+        sort_in_batch: str = "descending",
+        drop_last: bool = True,
+    ):
+        assert batch_cost > 0
+        if sort_in_batch != "descending" and sort_in_batch != "ascending":
+            raise ValueError(
+                f"sort_in_batch must be ascending or descending: {sort_in_batch}"
+            )
+        self.batch_cost = batch_cost
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = epoch
+        self.sort_in_batch = sort_in_batch
+        self.drop_last = drop_last
+        self.start = 0  # batches of this epoch already done, when resuming
+
+        costs = np.asarray(costs)
+        if len(costs) == 0:
+            raise RuntimeError("0 batches")
+        self.batch_list, batch_costs, batch = [], [], []
+        for key in np.argsort(costs, kind="stable"):
+            # ascending order, the new sample has the max cost of the batch
+            if batch and (len(batch) + 1) * costs[key] > batch_cost:
+                self.batch_list.append(batch)
+                batch_costs.append(len(batch) * costs[batch[-1]])
+                batch = []
+            batch.append(int(key))
+        self.batch_list.append(batch)
+        batch_costs.append(len(batch) * costs[batch[-1]])
+        if sort_in_batch == "descending":
+            self.batch_list = [tuple(reversed(b)) for b in self.batch_list]
+        else:
+            self.batch_list = [tuple(b) for b in self.batch_list]
+
+        # batch ids sorted by cost, one row per step, one column per rank
+        by_cost = np.argsort(batch_costs, kind="stable")
+        remainder = len(by_cost) % num_replicas
+        if remainder and drop_last and len(by_cost) >= num_replicas:
+            by_cost = by_cost[remainder:]
+        elif remainder:  # repeat the cheapest batches, next to themselves
+            positions = np.arange(len(by_cost))
+            by_cost = by_cost[np.sort(np.concatenate([np.resize(positions, num_replicas - remainder), positions]))]
+        self.steps = by_cost.reshape(-1, num_replicas)
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}("
+            f"N-batch={len(self)}, "
+            f"batch_cost={self.batch_cost}, "
+            f"rank={self.rank}/{self.num_replicas}, "
+            f"sort_in_batch={self.sort_in_batch})"
+        )
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def state_dict(self, batches_done: int):
+        return {"epoch": self.epoch, "batches_done": batches_done}
+
+    def load_state_dict(self, state):
+        self.epoch = state["epoch"]
+        self.start = state["batches_done"]
+
+    def __len__(self):
+        return len(self.steps) - self.start
+
+    def __iter__(self) -> Iterator[Tuple[int, ...]]:
+        rng = np.random.default_rng((self.seed, self.epoch))
+        steps = rng.permuted(self.steps, axis=1)  # rank of every batch within a step
+        steps = steps[rng.permutation(len(steps))]
+        start, self.start = self.start, 0  # only the resumed epoch is shortened
+        return iter([self.batch_list[b] for b in steps[start:, self.rank]])
@@ -8,9 +8,9 @@ from typing import List, Optional, Union
 import torch
 from tqdm import tqdm
 
-from .audio import load_audio, log_mel_spectrogram, pad_or_trim
+from .audio import load_audio, log_mel_spectrogram, log_mel_spectrogram_batch, pad_or_trim
 from .decoding import DecodingOptions, DecodingResult, decode, detect_language
-from .model import ModelDimensions, Whisper
+from .model import ModelDimensions, Whisper, encoder_padding_mask, pack_mel
 from .transcribe import transcribe
 from .version import __version__
 
@@ -16,7 +16,8 @@ HOP_LENGTH = 160
 CHUNK_LENGTH = 30
 N_SAMPLES = CHUNK_LENGTH * SAMPLE_RATE  # 480000 samples in a 30-second chunk
 N_FRAMES = exact_div(N_SAMPLES, HOP_LENGTH)  # 3000 frames in a mel spectrogram input
-N_VIDEO_FRAMES = (CHUNK_LENGTH * 25) # 750 video frames in 30 s
+VIDEO_FRAMES_PER_SECOND = 25
+N_VIDEO_FRAMES = (CHUNK_LENGTH * VIDEO_FRAMES_PER_SECOND) # 750 video frames in 30 s
 
 N_SAMPLES_PER_TOKEN = HOP_LENGTH * 2  # the initial convolutions has stride 2
 FRAMES_PER_SECOND = exact_div(SAMPLE_RATE, HOP_LENGTH)  # 10ms per audio frame
@@ -89,6 +90,11 @@ def pad_or_trim(array, length: int = N_SAMPLES, *, axis: int = -1):
     return array
 
 
+@lru_cache(maxsize=None)
+def hann_window(device) -> torch.Tensor:
+    return torch.hann_window(N_FFT).to(device)
+
+
 @lru_cache(maxsize=None)
 def mel_filters(device, n_mels: int) -> torch.Tensor:
     """
@@ -148,7 +154,7 @@ def log_mel_spectrogram(
         audio = audio.to(device)
     if padding > 0:
         audio = F.pad(audio, (0, padding))
-    window = torch.hann_window(N_FFT).to(audio.device)
+    window = hann_window(audio.device)
     stft = torch.stft(audio, N_FFT, HOP_LENGTH, window=window, return_complex=True)
     magnitudes = stft[..., :-1].abs() ** 2
 
@@ -159,3 +165,49 @@ def log_mel_spectrogram(
     log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
     log_spec = (log_spec + 4.0) / 4.0
     return log_spec
+
+
+def log_mel_spectrogram_batch(
+    audio: torch.Tensor,
+    lengths: Optional[torch.Tensor] = None,
+    n_mels: int = 80,
+):
+    """
+    Compute the log-Mel spectrograms of a batch of zero-padded waveforms in one pass, on their device
+
+    Parameters
+    ----------
+    audio: torch.Tensor, shape = (batch_size, n_samples)
+        The zero-padded audio waveforms in 16 kHz
+
+    lengths: Optional[torch.Tensor], shape = (batch_size,)
+        The number of samples of every waveform, all of n_samples if not given
+
+    n_mels: int
+        The number of Mel-frequency filters, 80 or 128
+
+    Returns
+    -------
+    torch.Tensor, shape = (batch_size, n_mels, n_samples // HOP_LENGTH)
+        The log-Mel spectrograms, normalized per utterance as log_mel_spectrogram does, and zero beyond
+        the length of each utterance, as the collators pad them
+
+    torch.Tensor, shape = (batch_size,)
+        The number of frames of every spectrogram
+    """
+    if lengths is None:
+        lengths = torch.full((audio.shape[0],), audio.shape[-1], device=audio.device)
+    with torch.autocast(device_type=audio.device.type, enabled=False): # 1e-10 underflows in fp16
+        audio = audio.float()
+        stft = torch.stft(audio, N_FFT, HOP_LENGTH, window=hann_window(audio.device), return_complex=True)
+        magnitudes = stft[..., :-1].abs() ** 2
+
+        mel_spec = mel_filters(audio.device, n_mels) @ magnitudes
+        log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+
+    n_frames = lengths.to(audio.device) // HOP_LENGTH
+    padding = (torch.arange(log_spec.shape[-1], device=audio.device) >= n_frames[:, None]).unsqueeze(1)
+    log_max = log_spec.masked_fill(padding, float("-inf")).amax(dim=(1, 2), keepdim=True)
+    log_spec = torch.maximum(log_spec, log_max - 8.0)
+    log_spec = (log_spec + 4.0) / 4.0
+    return log_spec.masked_fill(padding, 0.0), n_frames
@@ -17,12 +17,13 @@ if TYPE_CHECKING:
 
 @torch.no_grad()
 def detect_language(
-    model: "Whisper", mel: Tensor, tokenizer: Tokenizer = None
+    model: "Whisper", mel: Tensor, tokenizer: Tokenizer = None, x_v: Optional[Tensor] = None
 ) -> Tuple[Tensor, List[dict]]:
     """
     Detect the spoken language in the audio, and return them as list of strings, along with the ids
     of the most probable language tokens and the probability distribution over all language tokens.
     This is performed outside the main decode loop in order to not interfere with kv-caching.
+    Models with gated video cross-attention also need the video frames or encoded video features `x_v`.
 
     Returns
     -------
@@ -48,13 +49,14 @@ def detect_language(
         mel = mel.unsqueeze(0)
 
     # skip encoder forward pass if already-encoded audio features were given
-    if mel.shape[-2:] != (model.dims.n_audio_ctx, model.dims.n_audio_state):
-        mel = model.encoder(mel)
+    # (only the feature dim is checked, video-only features are shorter than n_audio_ctx)
+    if mel.shape[-1] != model.dims.n_audio_state:
+        mel, x_v = model.encoder(mel, x_v)
 
     # forward pass using a single token, startoftranscript
     n_audio = mel.shape[0]
     x = torch.tensor([[tokenizer.sot]] * n_audio).to(mel.device)  # [n_audio, 1]
-    logits = model.logits(x, mel)[:, 0]
+    logits = model.logits(x, mel, x_v)[:, 0]
 
     # collect detected languages; suppress all non-language tokens
     mask = torch.ones(logits.shape[-1], dtype=torch.bool)
@@ -145,39 +147,35 @@ class PyTorchInference(Inference):
     def __init__(self, model: "Whisper", initial_token_length: int):
         self.model: "Whisper" = model
         self.initial_token_length = initial_token_length
-        self.kv_cache = {}
+        self.kv_cache = None
         self.hooks = []
 
-        key_modules = [block.attn.key for block in self.model.decoder.blocks]
-        value_modules = [block.attn.value for block in self.model.decoder.blocks]
-        self.kv_modules = key_modules + value_modules
+    def logits(self, tokens: Tensor, audio_features: Tensor, x_v, xa_padding_mask=None,
+               xv_padding_mask=None) -> Tensor:
+        if not self.hooks:
+            self.kv_cache, self.hooks = self.model.install_kv_cache_hooks(self.kv_cache)
 
-    def logits(self, tokens: Tensor, audio_features: Tensor, x_v) -> Tensor:
-        # NOTE: disable kv cache here
-        # if not self.kv_cache:
-        #     self.kv_cache, self.hooks = self.model.install_kv_cache_hooks()
+        if tokens.shape[-1] > self.initial_token_length:
+            # only need to use the last token except in the first forward pass
+            tokens = tokens[:, -1:]
 
-        # if tokens.shape[-1] > self.initial_token_length:
-        #     # only need to use the last token except in the first forward pass
-        #     tokens = tokens[:, -1:]
-
-        return self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache, xv=x_v)
+        return self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache, xv=x_v,
+                                  xa_padding_mask=xa_padding_mask, xv_padding_mask=xv_padding_mask)
 
     def cleanup_caching(self):
         for hook in self.hooks:
             hook.remove()
 
-        self.kv_cache = {}
+        # keep the preallocated buffers around in case this inference object is reused
+        if self.kv_cache is not None:
+            self.kv_cache.reset()
         self.hooks = []
 
     def rearrange_kv_cache(self, source_indices):
         if source_indices != list(range(len(source_indices))):
-            for module in self.kv_modules:
-                # update the key/value cache to contain the selected sequences
-                try:
-                    self.kv_cache[module] = self.kv_cache[module][source_indices].detach()
-                except:
-                    continue
+            # update the self-attention cache to contain the selected sequences;
+            # cross-attention caches are identical within a group and are left as-is
+            self.kv_cache.rearrange(source_indices)
 
 
 class SequenceRanker:
@@ -645,12 +643,14 @@ class DecodingTask:
 
         return tuple(sorted(set(suppress_tokens)))
 
-    def _get_audio_features(self, mel: Tensor, x_v=None, test_a=False, test_v=False):
+    def _get_audio_features(self, mel: Tensor, x_v=None, test_a=False, test_v=False, mel_lengths=None,
+                            video_padding_mask=None):
         if self.options.fp16:
             mel = mel.half()
 
         if torch.is_tensor(x_v):
-            audio_features, x_v = self.model.encoder(mel, x_v, test_a=test_a, test_v=test_v)
+            audio_features, x_v = self.model.encoder(mel, x_v, test_a=test_a, test_v=test_v,
+                                                     padding_mask=video_padding_mask, x_lengths=mel_lengths)
         else:
             if mel.shape[-2:] == (
                 self.model.dims.n_audio_ctx,
@@ -659,7 +659,7 @@ class DecodingTask:
                 # encoded audio features are given; skip audio encoding
                 audio_features = mel
             else:
-                audio_features, x_v = self.model.encoder(mel)
+                audio_features, x_v = self.model.encoder(mel, test_a=test_a, x_lengths=mel_lengths)
 
         if audio_features.dtype != (
             torch.float16 if self.options.fp16 else torch.float32
@@ -670,13 +670,13 @@ class DecodingTask:
 
         return audio_features, x_v
 
-    def _detect_language(self, audio_features: Tensor, tokens: Tensor):
+    def _detect_language(self, audio_features: Tensor, tokens: Tensor, x_v=None):
         languages = [self.options.language] * audio_features.shape[0]
         lang_probs = None
 
         if self.options.language is None or self.options.task == "lang_id":
             lang_tokens, lang_probs = self.model.detect_language(
-                audio_features, self.tokenizer
+                audio_features, self.tokenizer, x_v
             )
             languages = [max(probs, key=probs.get) for probs in lang_probs]
             if self.options.language is None:
@@ -684,14 +684,14 @@ class DecodingTask:
 
         return languages, lang_probs
 
-    def _main_loop(self, audio_features: Tensor, tokens: Tensor, x_v):
+    def _main_loop(self, audio_features: Tensor, tokens: Tensor, x_v, xa_padding_mask=None, xv_padding_mask=None):
         n_batch = tokens.shape[0]
         sum_logprobs: Tensor = torch.zeros(n_batch, device=audio_features.device)
         no_speech_probs = [np.nan] * n_batch
 
         try:
             for i in range(self.sample_len):
-                logits = self.inference.logits(tokens, audio_features, x_v)
+                logits = self.inference.logits(tokens, audio_features, x_v, xa_padding_mask, xv_padding_mask)
 
                 if (
                     i == 0 and self.tokenizer.no_speech is not None
@@ -717,17 +717,27 @@ class DecodingTask:
         return tokens, sum_logprobs, no_speech_probs
 
     @torch.no_grad()
-    def run(self, mel: Tensor, x_v=None, test_a=False, test_v=False) -> List[DecodingResult]:
+    def run(self, mel: Tensor, x_v=None, test_a=False, test_v=False, mel_lengths=None,
+            video_padding_mask=None) -> List[DecodingResult]:
         self.decoder.reset()
         tokenizer: Tokenizer = self.tokenizer
         n_audio: int = mel.shape[0]
 
         # audio_features: Tensor = self._get_audio_features(mel, x_v, test_a, test_v)  # encoder forward pass
-        audio_features, x_v = self._get_audio_features(mel, x_v, test_a, test_v)
+        audio_features, x_v = self._get_audio_features(mel, x_v, test_a, test_v, mel_lengths, video_padding_mask)
+        # padded audio / video features are not attended to, video-only features (test_v) are all zeros
+        xa_padding_mask = None
+        if mel_lengths is not None and not test_v:
+            from .model import encoder_padding_mask  # whisper.model imports this module
+
+            xa_padding_mask = encoder_padding_mask(mel_lengths, audio_features.shape[1])
+        xv_padding_mask = None
+        if torch.is_tensor(x_v) and video_padding_mask is not None and x_v.shape[1] == video_padding_mask.shape[1]:
+            xv_padding_mask = video_padding_mask.to(x_v.device)
         tokens: Tensor = torch.tensor([self.initial_tokens]).repeat(n_audio, 1)
 
         # detect language if requested, overwriting the language token
-        languages, language_probs = self._detect_language(audio_features, tokens)
+        languages, language_probs = self._detect_language(audio_features, tokens, x_v)
         if self.options.task == "lang_id":
             return [
                 DecodingResult(
@@ -738,11 +748,19 @@ class DecodingTask:
                 )
             ]
     
-        # repeat text tensors by the group size, for beam search or best-of-n sampling
+        # repeat text and audio/video tensors by the group size, for beam search or best-of-n sampling
+        audio_features = audio_features.repeat_interleave(self.n_group, dim=0)
+        if torch.is_tensor(x_v):
+            x_v = x_v.repeat_interleave(self.n_group, dim=0)
+        if xa_padding_mask is not None:
+            xa_padding_mask = xa_padding_mask.repeat_interleave(self.n_group, dim=0)
+        if xv_padding_mask is not None:
+            xv_padding_mask = xv_padding_mask.repeat_interleave(self.n_group, dim=0)
         tokens = tokens.repeat_interleave(self.n_group, dim=0).to(audio_features.device)
 
         # call the main sampling loop
-        tokens, sum_logprobs, no_speech_probs = self._main_loop(audio_features, tokens, x_v)
+        tokens, sum_logprobs, no_speech_probs = self._main_loop(audio_features, tokens, x_v,
+                                                                xa_padding_mask, xv_padding_mask)
 
         # reshape the tensors to have (n_audio, n_group) as the first two dimensions
         audio_features = audio_features[:: self.n_group]
@@ -805,6 +823,8 @@ def decode(
     x_v = None,
     test_v=False,
     test_a=False,
+    mel_lengths: Optional[Tensor] = None,
+    video_padding_mask: Optional[Tensor] = None,
     **kwargs,
 ) -> Union[DecodingResult, List[DecodingResult]]:
     """
@@ -821,6 +841,13 @@ def decode(
     options: DecodingOptions
         A dataclass that contains all necessary options for decoding 30-second segments
 
+    mel_lengths: torch.Tensor, shape = (*)
+        The number of frames of every Mel spectrogram of a zero-padded batch, e.g. from
+        log_mel_spectrogram_batch; if given, the padded frames are not attended to
+
+    video_padding_mask: torch.BoolTensor, shape = (*, n_frames)
+        True for the padded frames of a batch of videos
+
     Returns
     -------
     result: Union[DecodingResult, List[DecodingResult]]
@@ -832,6 +859,6 @@ def decode(
     if kwargs:
         options = replace(options, **kwargs)
 
-    result = DecodingTask(model, options).run(mel, x_v, test_a, test_v)
+    result = DecodingTask(model, options).run(mel, x_v, test_a, test_v, mel_lengths, video_padding_mask)
 
     return result[0] if single else result
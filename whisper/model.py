@@ -1,18 +1,28 @@
 import base64
 import gzip
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Dict, Iterable, Optional
+from typing import Dict, Iterable, Optional, Tuple
 
 import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import Tensor, nn
+from torch.utils.checkpoint import checkpoint
 
 from .resnet import ResEncoder
 from .decoding import decode as decode_function
 from .decoding import detect_language as detect_language_function
 from .transcribe import transcribe as transcribe_function
 
+try:
+    from torch.nn.functional import scaled_dot_product_attention
+
+    SDPA_AVAILABLE = True
+except (ImportError, RuntimeError, OSError):
+    scaled_dot_product_attention = None
+    SDPA_AVAILABLE = False
+
 
 @dataclass
 class ModelDimensions:
@@ -60,7 +70,56 @@ def sinusoids(length, channels, max_timescale=10000):
     return torch.cat([torch.sin(scaled_time), torch.cos(scaled_time)], dim=1)
 
 
+def encoder_padding_mask(mel_lengths: Tensor, n_ctx: int) -> Tensor:
+    """Padding mask (batch_size, n_ctx) of the audio encoder output, True beyond the frames of
+    mel_lengths (the stride 2 conv halves the frame rate), for the decoder cross-attention"""
+    return torch.arange(n_ctx, device=mel_lengths.device) >= (mel_lengths[:, None] + 1) // 2
+
+
+def run_block(block: nn.Module, checkpointed: bool, *args, **kwargs):
+    """Run a residual block, with `checkpointed` its activations are recomputed in the backward pass"""
+    if checkpointed and torch.is_grad_enabled():
+        return checkpoint(block, *args, use_reentrant=False, **kwargs)
+    return block(*args, **kwargs)
+
+
+def pack_mel(mel: Tensor, segments: Tensor) -> Tuple[Tensor, Tensor]:
+    """
+    Pack the log-mels of a batch of utterances into windows, as planned by the collator.
+    segments : torch.LongTensor, shape = (batch_size, 3)
+        the window, first encoder frame and number of encoder frames of every utterance
+    Returns the windows (n_windows, n_mels, n_frames) and their lengths in mel frames. Every
+    utterance spans an even number of mel frames, so the stride 2 conv keeps it on its own frames,
+    and pack_segments leaves one encoder frame between utterances, zeroed by the encoder after conv1,
+    so the kernels see the same zero padding as for the utterance alone
+    """
+    window, start, length = segments.unbind(1)
+    n_windows = int(window.max()) + 1
+    window_lengths = torch.zeros(n_windows, dtype=torch.long, device=mel.device)
+    window_lengths = window_lengths.scatter_reduce(0, window, 2 * (start + length), reduce="amax")
+    mel = F.pad(mel, (0, max(0, 2 * int(length.max()) - mel.shape[-1])))
+    rows, frames = (torch.arange(mel.shape[-1], device=mel.device) < 2 * length[:, None]).nonzero(as_tuple=True)
+    packed = mel.new_zeros(n_windows, mel.shape[1], int(window_lengths.max()))
+    packed[window[rows], :, 2 * start[rows] + frames] = mel[rows, :, frames]
+    return packed, window_lengths
+
+
+@contextmanager
+def disable_sdpa():
+    """Use the explicit attention, which returns the attention logits, e.g. to align words"""
+    prev_state = MultiHeadAttention.use_sdpa
+    try:
+        MultiHeadAttention.use_sdpa = False
+        yield
+    finally:
+        MultiHeadAttention.use_sdpa = prev_state
+
+
 class MultiHeadAttention(nn.Module):
+    # fused scaled_dot_product_attention (flash / memory-efficient kernels), without the
+    # (n_ctx x n_ctx) logits; see disable_sdpa when they are needed
+    use_sdpa = True
+
     def __init__(self, n_state: int, n_head: int):
         super().__init__()
         self.n_head = n_head
@@ -75,7 +134,12 @@ class MultiHeadAttention(nn.Module):
         xa: Optional[Tensor] = None,
         mask: Optional[Tensor] = None,
         kv_cache: Optional[dict] = None,
+        key_padding_mask: Optional[Tensor] = None,
     ):
+        """
+        key_padding_mask : torch.BoolTensor, shape = (batch_size, n_keys)
+            True for the padded keys (audio or video frames), which are not attended to
+        """
         q = self.query(x)
 
         if kv_cache is None or xa is None or self.key not in kv_cache:
@@ -88,25 +152,122 @@ class MultiHeadAttention(nn.Module):
             k = kv_cache[self.key]
             v = kv_cache[self.value]
 
-        wv, qk = self.qkv_attention(q, k, v, mask)
+        wv, qk = self.qkv_attention(q, k, v, mask, key_padding_mask)
         return self.out(wv), qk
 
+    @staticmethod
+    def expand_key_padding_mask(key_padding_mask: Tensor) -> Tensor:
+        """(batch, n_keys) padded keys, or (batch, n_queries, n_keys) keys hidden from every query
+        (the block-diagonal mask of packed utterances), to (batch, 1, n_queries or 1, n_keys)"""
+        if key_padding_mask.dim() == 2:
+            return key_padding_mask[:, None, None, :]
+        return key_padding_mask[:, None]
+
     def qkv_attention(
-        self, q: Tensor, k: Tensor, v: Tensor, mask: Optional[Tensor] = None
-    ):
+        self, q: Tensor, k: Tensor, v: Tensor, mask: Optional[Tensor] = None,
+        key_padding_mask: Optional[Tensor] = None,
+    ) -> Tuple[Tensor, Optional[Tensor]]:
         n_batch, n_ctx, n_state = q.shape
         scale = (n_state // self.n_head) ** -0.25
-        q = q.view(*q.shape[:2], self.n_head, -1).permute(0, 2, 1, 3) * scale
-        k = k.view(*k.shape[:2], self.n_head, -1).permute(0, 2, 3, 1) * scale
+        q = q.view(*q.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
+        k = k.view(*k.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
         v = v.view(*v.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
 
-        qk = q @ k
-        if mask is not None:
-            qk = qk + mask[:n_ctx, :n_ctx]
-        qk = qk.float()
+        if SDPA_AVAILABLE and MultiHeadAttention.use_sdpa:
+            # `mask` is the causal one of the decoder self-attention, a single query (incremental
+            # decoding) attends to all the cached keys. Padded keys are only masked in the encoder
+            # self-attention and the cross-attentions, which are not causal
+            attn_mask = None if key_padding_mask is None else ~self.expand_key_padding_mask(key_padding_mask)
+            a = scaled_dot_product_attention(q, k, v, attn_mask=attn_mask,
+                                             is_causal=attn_mask is None and mask is not None and n_ctx > 1)
+            out = a.permute(0, 2, 1, 3).flatten(start_dim=2)
+            qk = None
+        else:
+            qk = (q * scale) @ (k * scale).transpose(-1, -2)
+            if mask is not None:
+                qk = qk + mask[:n_ctx, :n_ctx]
+            if key_padding_mask is not None:
+                qk = qk.masked_fill(self.expand_key_padding_mask(key_padding_mask), float("-inf"))
+            qk = qk.float()
+
+            w = F.softmax(qk, dim=-1).to(q.dtype)
+            out = (w @ v).permute(0, 2, 1, 3).flatten(start_dim=2)
+            qk = qk.detach()
+
+        return out, qk
+
+class KVCache:
+    """
+    Preallocated key/value cache for incremental decoding. Self-attention projections are written
+    by index into a (n_ctx, n_batch, n_state) buffer that is allocated once, on the first forward
+    pass, so no memory is allocated or copied as the output grows. Cross-attention projections
+    (audio and gated video) are stored as computed, since they are only calculated once.
+    """
+
+    def __init__(self, n_ctx: int, self_attn_modules: Iterable[nn.Module]):
+        self.n_ctx = n_ctx
+        self.self_attn_modules = set(self_attn_modules)
+        self.buffers: Dict[nn.Module, Tensor] = {}
+        self.scratch: Dict[nn.Module, Tensor] = {}
+        self.lengths: Dict[nn.Module, int] = {}
+        self.cross: Dict[nn.Module, Tensor] = {}
+
+    def __contains__(self, module: nn.Module) -> bool:
+        return module in self.lengths or module in self.cross
+
+    def __len__(self) -> int:
+        return len(self.lengths) + len(self.cross)
+
+    def __getitem__(self, module: nn.Module) -> Tensor:
+        if module in self.cross:
+            return self.cross[module]
+        # (n_ctx, n_batch, n_state) -> (n_batch, n_tokens, n_state) view of the filled positions
+        return self.buffers[module][: self.lengths[module]].transpose(0, 1)
+
+    def update(self, module: nn.Module, output: Tensor) -> Tensor:
+        if module not in self.self_attn_modules:
+            self.cross[module] = output
+            return output
+
+        n_batch, n_tokens, n_state = output.shape
+        buffer = self.buffers.get(module)
+        if (
+            buffer is None
+            or buffer.shape[1:] != (n_batch, n_state)
+            or buffer.dtype != output.dtype
+            or buffer.device != output.device
+        ):
+            buffer = output.new_empty(self.n_ctx, n_batch, n_state)
+            self.buffers[module] = buffer
+            self.scratch.pop(module, None)
+
+        offset = self.lengths.get(module, 0)
+        if offset + n_tokens > self.n_ctx:
+            raise ValueError(f"kv cache overflow: {offset + n_tokens} > {self.n_ctx} tokens")
+        buffer[offset : offset + n_tokens] = output.transpose(0, 1)
+        self.lengths[module] = offset + n_tokens
+        return self[module]
+
+    def rearrange(self, source_indices) -> None:
+        """Reorder the self-attention caches along the batch dimension, e.g. for beam search"""
+        for module, buffer in self.buffers.items():
+            if module not in self.lengths:
+                continue
+            if not torch.is_tensor(source_indices):
+                source_indices = torch.tensor(source_indices, device=buffer.device)
+            length = self.lengths[module]
+            # gather into a preallocated scratch buffer and swap, instead of allocating a new tensor
+            scratch = self.scratch.get(module)
+            if scratch is None:
+                scratch = torch.empty_like(buffer)
+            torch.index_select(buffer[:length], 1, source_indices, out=scratch[:length])
+            self.buffers[module], self.scratch[module] = scratch, buffer
+
+    def reset(self) -> None:
+        """Forget the cached positions, keeping the allocated buffers for the next sequence"""
+        self.lengths.clear()
+        self.cross.clear()
 
-        w = F.softmax(qk, dim=-1).to(q.dtype)
-        return (w @ v).permute(0, 2, 1, 3).flatten(start_dim=2), qk.detach()
 
 class ResidualAttentionBlock(nn.Module):
     def __init__(self, n_state: int, n_head: int, cross_attention: bool = False, 
@@ -141,8 +302,10 @@ class ResidualAttentionBlock(nn.Module):
             )
             self.ff_gate = nn.Parameter(torch.tensor([0.]))  
         
-    def apply_gated_x_attn(self, x, xv):
-        x = x + self.gated_x_attn(self.gated_x_attn_ln(x), xv)[0] * self.attn_gate.tanh()
+    def apply_gated_x_attn(self, x, xv, kv_cache: Optional[dict] = None, xv_padding_mask: Optional[Tensor] = None):
+        # the video keys/values only depend on xv, so they are projected once and reused from kv_cache
+        x = x + self.gated_x_attn(self.gated_x_attn_ln(x), xv, kv_cache=kv_cache,
+                                  key_padding_mask=xv_padding_mask)[0] * self.attn_gate.tanh()
         x = x + self.ff(self.ff_ln(x)) * self.ff_gate.tanh()
         return x
 
@@ -153,12 +316,19 @@ class ResidualAttentionBlock(nn.Module):
         mask: Optional[Tensor] = None,
         kv_cache: Optional[dict] = None,
         xv: Optional[Tensor] = None,
+        padding_mask: Optional[Tensor] = None,
+        xa_padding_mask: Optional[Tensor] = None,
+        xv_padding_mask: Optional[Tensor] = None,
     ):
+        """
+        padding_mask, xa_padding_mask, xv_padding_mask : torch.BoolTensor, shape = (batch_size, n_frames)
+            True for the padded frames of x (encoder self-attention), xa and xv (cross-attentions)
+        """
         if self.add_gated_x_attn != 0: 
-            x = self.apply_gated_x_attn(x, xv)
-        x = x + self.attn(self.attn_ln(x), mask=mask, kv_cache=kv_cache)[0]
+            x = self.apply_gated_x_attn(x, xv, kv_cache=kv_cache, xv_padding_mask=xv_padding_mask)
+        x = x + self.attn(self.attn_ln(x), mask=mask, kv_cache=kv_cache, key_padding_mask=padding_mask)[0]
         if self.cross_attn:
-            x = x + self.cross_attn(self.cross_attn_ln(x), xa, kv_cache=kv_cache)[0]
+            x = x + self.cross_attn(self.cross_attn_ln(x), xa, kv_cache=kv_cache, key_padding_mask=xa_padding_mask)[0]
         x = x + self.mlp(self.mlp_ln(x))        
         return x
     
@@ -182,6 +352,8 @@ class AudioEncoder(nn.Module):
         self.dropout_rate = dropout_rate
         self.dropout = torch.nn.Dropout(dropout_rate)      
         self.video = video
+        self.frozen_audio, self.frozen_video, self.frozen_dtype = False, False, None # see freeze
+        self.checkpoint_every = 0 # see checkpoint_activations
         self.av_hubert_encoder = av_hubert_encoder
         self.av_fusion = av_fusion
         self.video_model_path = video_model_path
@@ -210,33 +382,182 @@ class AudioEncoder(nn.Module):
                 num_parameters = sum(p.numel() for p in self.video_projection_blocks.parameters())
                 print("Adding visual transformer layers with number of params: {}".format(num_parameters)) 
 
+    def freeze(self, audio=True, video=True, dtype=torch.float16):
+        """
+        Frozen-backbone mode, set once before training: the Whisper audio stack and / or the video
+        model get no gradients, stay in eval mode, keep their weights in `dtype` (norms stay fp32)
+        and run under inference_mode and autocast to `dtype`. Only the video projection trains
+        """
+        assert not audio or self.av_fusion != "lip-reader", "the lip-reader trains through the audio stack"
+        self.frozen_audio, self.frozen_video, self.frozen_dtype = audio, video and self.video, dtype
+        for module in self.frozen_modules():
+            module.requires_grad_(False)
+            for m in module.modules():
+                if not isinstance(m, (nn.LayerNorm, nn.GroupNorm, nn.modules.batchnorm._BatchNorm)):
+                    for p in m.parameters(recurse=False):
+                        p.data = p.data.to(dtype)
+        self.train(self.training)
+
+    def checkpoint_activations(self, every: int = 1):
+        """
+        Recompute the activations of every `every`-th block of the audio stack and of the AV-HuBERT
+        transformer in the backward pass, 0 to keep them all. A frozen video model is left as is
+        """
+        self.checkpoint_every = every
+        if every and self.video and self.av_hubert_encoder and any(p.requires_grad for p in self.video_model.parameters()):
+            from fairseq.modules.checkpoint_activations import checkpoint_wrapper
+            for module in self.video_model.modules():
+                if type(module).__name__ == "TransformerEncoder": # fairseq wav2vec2
+                    for layer in module.layers[::every]:
+                        if not hasattr(layer, "precheckpoint_forward"): # checkpoint_activations in its cfg
+                            checkpoint_wrapper(layer)
+
+    def frozen_modules(self):
+        audio = [self.conv1, self.conv2, self.blocks, self.ln_post] if self.frozen_audio else []
+        return audio + ([self.video_model] if self.frozen_video else [])
+
+    def train(self, mode: bool = True):
+        super().train(mode)
+        for module in self.frozen_modules():
+            module.eval()
+        return self
+
+    @contextmanager
+    def run_frozen(self, frozen: bool, device: torch.device):
+        """Context of the frozen submodules, no autograd and reduced precision"""
+        if not frozen:
+            yield
+            return
+        with torch.inference_mode(), torch.autocast(device.type, dtype=self.frozen_dtype):
+            yield
+
+    def encode_video(self, x_v: Tensor, padding_mask=None) -> Tensor:
+        """
+        x_v : torch.Tensor, shape = (batch_size, 1, n_frames, height, width)
+            the video frames, returns the video_model features (batch_size, n_frames, n_video_state)
+            before video_projection, as stored by whisper_extract_video_feats.py
+        """
+        with self.run_frozen(self.frozen_video, x_v.device):
+            x_v = self._encode_video(x_v, padding_mask)
+        return x_v.clone() if self.frozen_video else x_v # inference tensors can't be saved for backward
+
+    def _encode_video(self, x_v: Tensor, padding_mask=None) -> Tensor:
+        if not self.av_hubert_encoder:
+            x_v = self.video_model(x_v) # B, F, T
+            x_v = x_v.permute(0, 2, 1) # B, T, F
+        elif not 'ft' in self.video_model_path: # AV-HuBERT ssl
+            x_v = self.video_model(source={'video': x_v, 'audio': None}, 
+                                    padding_mask=padding_mask, 
+                                    mask=False, 
+                                    features_only=True)
+            x_v = x_v['x']
+        else:
+            x_v = self.video_model(source={'video': x_v, 'audio': None}, padding_mask=padding_mask)
+            x_v = x_v['encoder_out'].permute(1, 0 , 2) # T, B, F -> B, T, F
+        return x_v
+
+    def sample_modalities(self, batch_size, device):
+        """
+        Modality dropout: every utterance uses both modalities with probability prob_av, only the
+        audio with probability prob_a, else only the video. Returns the (use_audio, use_video) row masks
+        """
+        p = torch.from_numpy(np.random.random(batch_size)).to(device)
+        use_a = p <= self.prob_av + self.prob_a
+        use_v = (p <= self.prob_av) | ~use_a
+        return use_a, use_v
+
+    def encode_modalities(self, mel: Tensor, x_v, use_a: Tensor, use_v: Tensor, padding_mask=None, x_lengths=None):
+        """
+        Modality dropout without computing the dropped modalities: the audio stack only encodes the
+        rows of use_a and the video model the rows of use_v (the test_a and test_v paths), dropped
+        features are zeros as with x = 0 * x and x_v = 0 * x_v
+        """
+        batch_size, n_state = mel.shape[0], self.positional_embedding.shape[1]
+
+        def scatter(use, encode, shape):
+            rows = use.nonzero()[:, 0]
+            if len(rows) == 0:
+                return mel.new_zeros((batch_size,) + shape)
+            out = encode(rows)
+            return out.new_zeros((batch_size,) + out.shape[1:]).index_copy(0, rows, out)
+
+        x = scatter(use_a, lambda rows: self(mel[rows], test_a=True,
+                                             x_lengths=None if x_lengths is None else x_lengths[rows])[0],
+                    (min((mel.shape[-1] + 1) // 2, self.positional_embedding.shape[0]), n_state))
+        if self.video:
+            n_frames = x_v.shape[1] if x_v.dim() == 3 else x_v.shape[2]
+            x_v = scatter(use_v, lambda rows: self(mel[rows], x_v[rows], test_v=True,
+                                                   padding_mask=None if padding_mask is None else padding_mask[rows])[1],
+                          (n_frames, n_state))
+        return x, x_v
+
+    @staticmethod
+    def packed_positions(segments: Tensor, n_windows: int, n_ctx: int) -> Tuple[Tensor, Tensor]:
+        """
+        The utterance (-1 for padding) of every encoder frame of packed windows and the frame
+        positions within their utterance, both (n_windows, n_ctx), see pack_mel
+        """
+        window, start, length = segments.unbind(1)
+        frames = torch.arange(n_ctx, device=segments.device)
+        rows, cols = ((frames >= start[:, None]) & (frames < (start + length)[:, None])).nonzero(as_tuple=True)
+        segment_ids = torch.full((n_windows, n_ctx), -1, dtype=torch.long, device=segments.device)
+        positions = torch.zeros((n_windows, n_ctx), dtype=torch.long, device=segments.device)
+        segment_ids[window[rows], cols] = rows
+        positions[window[rows], cols] = cols - start[rows]
+        return segment_ids, positions
+
+    @staticmethod
+    def unpack(x: Tensor, segments: Tensor) -> Tensor:
+        """The encoder frames of every utterance of packed windows, (batch_size, max length, n_state),
+        frames beyond the length of an utterance are masked by encoder_padding_mask"""
+        window, start, length = segments.unbind(1)
+        frames = start[:, None] + torch.arange(int(length.max()), device=x.device)
+        return x[window[:, None], frames.clamp(max=x.shape[1] - 1)]
+
     def forward(self, x: Tensor, x_v=None, training=False, test_a=False, test_v=False, track_norm=False, 
-                padding_mask=None):
+                padding_mask=None, x_lengths=None, segments=None):
         """
         x : torch.Tensor, shape = (batch_size, n_mels, n_ctx)
             the mel spectrogram of the audio
+        x_v : torch.Tensor, shape = (batch_size, 1, n_frames, height, width)
+            the video frames, or the cached video_model features (batch_size, n_frames, n_video_state)
+        padding_mask : torch.BoolTensor, shape = (batch_size, n_frames)
+            True for the padded video frames
+        x_lengths : torch.Tensor, shape = (batch_size,)
+            the number of mel frames of every utterance, if given the padded frames are not attended
+            to and the frames padded in the whole batch are skipped. The decoder cross-attention
+            mask is encoder_padding_mask(x_lengths, n_audio_ctx)
+        segments : torch.LongTensor, shape = (batch_size, 3)
+            x holds windows of packed utterances (pack_mel) and x_lengths their lengths: the frames
+            only attend to their utterance, with positions from its start, and the features are
+            returned per utterance, as x_v
         """
+        attn_padding_mask = None
+        if not test_v and x_lengths is not None:
+            x = x[:, :, :int(x_lengths.max())]
+        use_a = use_v = None
+        if training: # modality dropout, encoder
+            use_a, use_v = self.sample_modalities(x.shape[0] if segments is None else len(segments), x.device)
+            if segments is None and (not self.video or self.av_fusion == "separate"): # audio and video encoded independently
+                return self.encode_modalities(x, x_v, use_a, use_v, padding_mask, x_lengths)
         if not test_v:
-            x = F.gelu(self.conv1(x))
-            x = F.gelu(self.conv2(x))
-            x = x.permute(0, 2, 1)
-            if track_norm:
-                x_norm = torch.linalg.norm(x, dim=-1).mean()
+            with self.run_frozen(self.frozen_audio, x.device):
+                x = F.gelu(self.conv1(x))
+                if segments is not None: # the frames between packed utterances are conv2's zero padding
+                    inside = self.packed_positions(segments, x.shape[0], (x.shape[-1] + 1) // 2)[0] >= 0
+                    x = x * inside.repeat_interleave(2, dim=1)[:, None, :x.shape[-1]].to(x.dtype)
+                elif x_lengths is not None: # past an odd length, conv2 reads its zero padding as when alone
+                    inside = torch.arange(x.shape[-1], device=x.device) < x_lengths[:, None]
+                    x = x * inside[:, None, :].to(x.dtype)
+                x = F.gelu(self.conv2(x))
+                x = x.permute(0, 2, 1)
+                if track_norm:
+                    x_norm = torch.linalg.norm(x, dim=-1).mean()
 
         if self.video and not test_a:
-            if not self.av_hubert_encoder:
-                x_v = self.video_model(x_v) # B, F, T
-                x_v = x_v.permute(0, 2, 1) # B, T, F
-            elif not 'ft' in self.video_model_path: # AV-HuBERT ssl
-                x_v = self.video_model(source={'video': x_v, 'audio': None}, 
-                                        padding_mask=padding_mask, 
-                                        mask=False, 
-                                        features_only=True)
-                x_v = x_v['x']
-            else:
-                x_v = self.video_model(source={'video': x_v, 'audio': None}, padding_mask=padding_mask)
-                x_v = x_v['encoder_out'].permute(1, 0 , 2) # T, B, F -> B, T, F
-                
+            if x_v.dim() != 3: # raw frames [B, C, T, H, W], else cached video_model features [B, T, F]
+                x_v = self.encode_video(x_v, padding_mask)
+
             if track_norm:
                 x_v_norm_pre = torch.linalg.norm(x_v, dim=-1).mean()
 
@@ -251,36 +572,56 @@ class AudioEncoder(nn.Module):
                     x_v = x_v[ :, :1500, :]
                 # NOTE: if max_len is 30s, then the cropping doesn't do anything.
                 x_v = (x_v + self.positional_embedding[: x_v.shape[1]]).to(x_v.dtype) # trim pos embedding
+                if padding_mask is not None:
+                    attn_padding_mask = padding_mask.repeat_interleave(2, dim=1)[:, :x_v.shape[1]]
 
                 for layer, block in enumerate(self.video_projection_blocks): # NOTE: new transformer layers
-                    x_v = block(x_v)
+                    x_v = block(x_v, padding_mask=attn_padding_mask)
 
                 x = x_v # NOTE: use AV-HuBERT output as input
 
             if track_norm:
                 x_v_norm_post = torch.linalg.norm(x_v, dim=-1).mean()
 
-        if not test_v:
-            # NOTE: pos embedding has max length of 1500 (30s after conv downsample from 3000 mel frames)
-            if x.shape[1] > 1500:
-                x = x[ :, :1500, :]
+        if test_v and self.av_fusion == "separate":
+            # NOTE: video-only decoding with gated x-attn; the audio features are dropped (x = 0 * x)
+            # as in modality dropout, so the audio stack is skipped. 25 Hz video -> 50 Hz audio frames
+            n_ctx = min(2 * x_v.shape[1], self.positional_embedding.shape[0])
+            return x_v.new_zeros(x_v.shape[0], n_ctx, x_v.shape[-1]), x_v
 
-            # NOTE: if max_len is 30s, then the cropping doesn't do anything.
-            x = (x + self.positional_embedding[: x.shape[1]]).to(x.dtype) # trim pos embedding
+        with self.run_frozen(self.frozen_audio, x.device):
+            if not test_v:
+                # NOTE: pos embedding has max length of 1500 (30s after conv downsample from 3000 mel frames)
+                if x.shape[1] > 1500:
+                    x = x[ :, :1500, :]
 
-        for layer, block in enumerate(self.blocks):
-            x = block(x)
-
-        x = self.ln_post(x)
-
-        if training: # modality dropout, encoder
-            mod_drop_prob = np.random.random()
-            if 0 < mod_drop_prob <= self.prob_av:
-                pass # use both modalities
-            elif self.prob_av < mod_drop_prob <= self.prob_av + self.prob_a:
-                x_v = 0 * x_v # drop video
-            else:
-                x = 0 * x # drop audio
+                # NOTE: if max_len is 30s, then the cropping doesn't do anything.
+                if segments is not None: # packed utterances, block-diagonal attention
+                    segment_ids, positions = self.packed_positions(segments, x.shape[0], x.shape[1])
+                    x = (x + self.positional_embedding[positions]).to(x.dtype)
+                    attn_padding_mask = segment_ids[:, :, None] != segment_ids[:, None, :]
+                else:
+                    x = (x + self.positional_embedding[: x.shape[1]]).to(x.dtype) # trim pos embedding
+                if x_lengths is not None and segments is None and self.av_fusion != "lip-reader":
+                    attn_padding_mask = encoder_padding_mask(x_lengths, x.shape[1])
+
+            for layer, block in enumerate(self.blocks):
+                checkpointed = self.training and self.checkpoint_every and layer % self.checkpoint_every == 0
+                x = run_block(block, checkpointed, x, padding_mask=attn_padding_mask)
+
+            x = self.ln_post(x)
+            if segments is not None and not test_v:
+                x = self.unpack(x, segments)
+        if self.frozen_audio:
+            x = x.clone() # inference tensors can't be saved for backward
+
+        if use_a is not None: # lip-reader (the audio stack encodes the video) or packed utterances
+            x = x * use_a[:, None, None] # drop audio
+            x_v = x_v * use_v[:, None, None] # drop video
+        if test_a and self.video and self.av_fusion == "separate":
+            # NOTE: audio-only decoding with gated x-attn; the video features are dropped (x_v = 0 * x_v)
+            # as in modality dropout. Attention over all-zero keys is uniform, so one frame is enough
+            x_v = x.new_zeros(x.shape[0], 1, x.shape[-1])
         if track_norm:
             return x, x_norm, x_v_norm_pre, x_v_norm_post, x_v
         return x, x_v
@@ -308,19 +649,26 @@ class TextDecoder(nn.Module):
 
         mask = torch.empty(n_ctx, n_ctx).fill_(-np.inf).triu_(1)
         self.register_buffer("mask", mask, persistent=False)
+        self.checkpoint_every = 0 # every n-th block recomputed in the backward pass, 0 for none
         self.dropout_rate = dropout_rate
         self.dropout = torch.nn.Dropout(dropout_rate)      
 
 
     def forward(self, x: Tensor, xa: Tensor, kv_cache: Optional[dict] = None, 
-                xv: Optional[Tensor] = None):
+                xv: Optional[Tensor] = None, xa_padding_mask: Optional[Tensor] = None,
+                xv_padding_mask: Optional[Tensor] = None):
         """
         x : torch.LongTensor, shape = (batch_size, <= n_ctx)
             the text tokens
         xa : torch.Tensor, shape = (batch_size, n_audio_ctx, n_audio_state)
             the encoded audio features to be attended on
+        xa_padding_mask, xv_padding_mask : torch.BoolTensor, shape = (batch_size, n_audio_ctx / n_frames)
+            True for the padded audio features (encoder_padding_mask) and video features
         """
-        offset = next(iter(kv_cache.values())).shape[1] if kv_cache else 0
+        # the cache also holds the audio and video cross-attention projections (encoder length),
+        # so the number of previously decoded tokens is read from the first self-attention cache
+        self_attn_key = self.blocks[0].attn.key
+        offset = kv_cache[self_attn_key].shape[1] if kv_cache and self_attn_key in kv_cache else 0
         x = (
             self.token_embedding(x)
             + self.positional_embedding[offset : offset + x.shape[-1]]
@@ -329,7 +677,10 @@ class TextDecoder(nn.Module):
         x = x.to(xa.dtype)
 
         for layer, block in enumerate(self.blocks):
-            x = block(x, xa, mask=self.mask, kv_cache=kv_cache, xv=xv)
+            checkpointed = (self.training and kv_cache is None and self.checkpoint_every
+                            and layer % self.checkpoint_every == 0)
+            x = run_block(block, checkpointed, x, xa, mask=self.mask, kv_cache=kv_cache, xv=xv,
+                          xa_padding_mask=xa_padding_mask, xv_padding_mask=xv_padding_mask)
             
         x = self.ln(x)
         logits = (
@@ -388,11 +739,21 @@ class Whisper(nn.Module):
     #     )
     #     self.register_buffer("alignment_heads", mask.to_sparse(), persistent=False)
 
+    def checkpoint_activations(self, stacks: str = "all", every: int = 1):
+        """
+        Activation checkpointing of the transformer blocks, trading compute for memory in training.
+        stacks : '' (none), 'encoder' (audio stack and AV-HuBERT), 'decoder' or 'all'
+        every : checkpoint every n-th block of a stack
+        """
+        assert stacks in ["", "encoder", "decoder", "all"], stacks
+        self.encoder.checkpoint_activations(every if stacks in ["encoder", "all"] else 0)
+        self.decoder.checkpoint_every = every if stacks in ["decoder", "all"] else 0
+
     def embed_audio(self, mel: torch.Tensor):
         return self.encoder(mel)
 
-    def logits(self, tokens: torch.Tensor, audio_features: torch.Tensor):
-        return self.decoder(tokens, audio_features)
+    def logits(self, tokens: torch.Tensor, audio_features: torch.Tensor, x_v: Optional[torch.Tensor] = None):
+        return self.decoder(tokens, audio_features, xv=x_v)
 
     def forward(
         self, mel: torch.Tensor, tokens: torch.Tensor
@@ -411,30 +772,37 @@ class Whisper(nn.Module):
     def num_languages(self):
         return self.dims.n_vocab - 51765 - int(self.is_multilingual)
 
-    def install_kv_cache_hooks(self, cache: Optional[dict] = None):
+    def install_kv_cache_hooks(self, cache: Optional[KVCache] = None):
         """
         The `MultiHeadAttention` module optionally accepts `kv_cache` which stores the key and value
-        tensors calculated for the previous positions. This method returns a dictionary that stores
+        tensors calculated for the previous positions. This method returns a `KVCache` that stores
         all caches, and the necessary hooks for the key and value projection modules that save the
-        intermediate tensors to be reused during later calculations.
+        intermediate tensors to be reused during later calculations. The hooks cover the self-attention,
+        the audio cross-attention and the gated video cross-attention (`gated_x_attn`) projections;
+        the cross-attention entries are computed on the first forward pass and reused afterwards.
+
+        Parameters
+        ----------
+        cache : Optional[KVCache]
+            An existing cache whose buffers are reused; a new one is created if None
 
         Returns
         -------
-        cache : Dict[nn.Module, torch.Tensor]
-            A dictionary object mapping the key/value projection modules to its cache
+        cache : KVCache
+            A cache object mapping the key/value projection modules to its cache
         hooks : List[RemovableHandle]
             List of PyTorch RemovableHandle objects to stop the hooks to be called
         """
-        cache = {**cache} if cache is not None else {}
+        self_attn_modules = [
+            module for block in self.decoder.blocks for module in (block.attn.key, block.attn.value)
+        ]
+        if cache is None:
+            cache = KVCache(self.dims.n_text_ctx, self_attn_modules)
+        cache.reset()
         hooks = []
 
         def save_to_cache(module, _, output):
-            if module not in cache or output.shape[1] > self.dims.n_text_ctx:
-                # save as-is, for the first token or cross attention
-                cache[module] = output
-            else:
-                cache[module] = torch.cat([cache[module], output], dim=1).detach()
-            return cache[module]
+            return cache.update(module, output)
 
         def install_hooks(layer: nn.Module):
             if isinstance(layer, MultiHeadAttention):
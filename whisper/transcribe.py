@@ -2,7 +2,7 @@ import argparse
 import os
 import traceback
 import warnings
-from typing import TYPE_CHECKING, Optional, Tuple, Union
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
@@ -15,6 +15,7 @@ from .audio import (
     N_VIDEO_FRAMES,
     N_SAMPLES,
     SAMPLE_RATE,
+    VIDEO_FRAMES_PER_SECOND,
     log_mel_spectrogram,
     pad_or_trim,
 )
@@ -49,7 +50,10 @@ def transcribe(
     word_timestamps: bool = False,
     prepend_punctuations: str = "\"'“¿([{-",
     append_punctuations: str = "\"'.。,，!！?？:：”)]}、",
-    video: bool = False,
+    video: Optional[Union[np.ndarray, torch.Tensor]] = None,
+    test_a: bool = False,
+    test_v: bool = False,
+    batch_size: int = 1,
     **decode_options,
 ):
     """
@@ -101,6 +105,21 @@ def transcribe(
         "prompt-engineer" a context for transcription, e.g. custom vocabularies or proper nouns
         to make it more likely to predict those word correctly.
 
+    video: Optional[Union[np.ndarray, torch.Tensor]], shape = (T, H, W, C)
+        The 25 fps lip video as returned by `load_video_feats`, aligned with the audio. Each 30-second
+        mel window is decoded together with the matching video frames
+
+    test_a: bool
+        Audio-only decoding, the video features are dropped
+
+    test_v: bool
+        Video-only decoding, the audio features are dropped; `audio` only sets the duration
+
+    batch_size: int
+        Number of consecutive 30-second windows decoded in one batch. With batch_size > 1 the
+        windows are fixed (no seeking to the last timestamp) and every window of a batch is
+        conditioned on the text of the previous batches only
+
     decode_options: dict
         Keyword arguments to construct `DecodingOptions` instances
 
@@ -124,6 +143,22 @@ def transcribe(
     mel = log_mel_spectrogram(audio, model.dims.n_mels, padding=N_SAMPLES)
     content_frames = mel.shape[-1] - N_FRAMES
 
+    if test_v and video is None:
+        raise ValueError("Video-only transcription requires `video`")
+    if video is not None and not test_a:
+        video = torch.as_tensor(video).permute(3, 0, 1, 2)  # [T, H, W, C] -> [C, T, H, W]
+    else:
+        video = None
+
+    def video_segment(seek: int, segment_size: int) -> Optional[torch.Tensor]:
+        """The video frames covering mel frames [seek, seek + segment_size), zero padded"""
+        if video is None:
+            return None
+        start = seek * VIDEO_FRAMES_PER_SECOND // FRAMES_PER_SECOND
+        length = -(-segment_size * VIDEO_FRAMES_PER_SECOND // FRAMES_PER_SECOND)
+        segment = pad_or_trim(video[:, start : start + length], length, axis=1)
+        return segment.unsqueeze(0).to(model.device).to(dtype)
+
     if decode_options.get("language", None) is None:
         if not model.is_multilingual:
             decode_options["language"] = "en"
@@ -133,8 +168,12 @@ def transcribe(
                     "Detecting language using up to the first 30 seconds. Use `--language` to specify the language"
                 )
             mel_segment = pad_or_trim(mel, N_FRAMES).to(model.device).to(dtype)
-            vid_segment = pad_or_trim(video, N_VIDEO_FRAMES).to(model.device).to(dtype)
-            _, probs = model.detect_language(mel_segment)
+            vid_segment = video_segment(0, min(N_FRAMES, content_frames))
+            with torch.no_grad():
+                audio_features, x_v = model.encoder(
+                    mel_segment.unsqueeze(0), vid_segment, test_a=test_a, test_v=test_v
+                )
+                _, probs = model.detect_language(audio_features[0], x_v=x_v)
             decode_options["language"] = max(probs, key=probs.get)
             if verbose is not None:
                 print(
@@ -153,11 +192,14 @@ def transcribe(
     if word_timestamps and task == "translate":
         warnings.warn("Word-level timestamps on translations may not be reliable.")
 
-    def decode_with_fallback(segment: torch.Tensor) -> DecodingResult:
+    def decode_with_fallback(
+        segment: torch.Tensor, vid_segment: Optional[torch.Tensor] = None
+    ) -> List[DecodingResult]:
         temperatures = (
             [temperature] if isinstance(temperature, (int, float)) else temperature
         )
-        decode_result = None
+        decode_results = [None] * segment.shape[0]
+        remaining = list(range(segment.shape[0]))  # windows that still need a (re)decode
 
         for t in temperatures:
             kwargs = {**decode_options}
@@ -170,28 +212,40 @@ def transcribe(
                 kwargs.pop("best_of", None)
 
             options = DecodingOptions(**kwargs, temperature=t)
-            decode_result = model.decode(segment, options)
+            results = model.decode(
+                segment[remaining],
+                options,
+                vid_segment[remaining] if vid_segment is not None else None,
+                test_a=test_a,
+                test_v=test_v,
+            )
 
-            needs_fallback = False
-            if (
-                compression_ratio_threshold is not None
-                and decode_result.compression_ratio > compression_ratio_threshold
-            ):
-                needs_fallback = True  # too repetitive
-            if (
-                logprob_threshold is not None
-                and decode_result.avg_logprob < logprob_threshold
-            ):
-                needs_fallback = True  # average log probability is too low
-            if (
-                no_speech_threshold is not None
-                and decode_result.no_speech_prob > no_speech_threshold
-            ):
-                needs_fallback = False  # silence
-            if not needs_fallback:
+            failed = []
+            for i, decode_result in zip(remaining, results):
+                decode_results[i] = decode_result
+                needs_fallback = False
+                if (
+                    compression_ratio_threshold is not None
+                    and decode_result.compression_ratio > compression_ratio_threshold
+                ):
+                    needs_fallback = True  # too repetitive
+                if (
+                    logprob_threshold is not None
+                    and decode_result.avg_logprob < logprob_threshold
+                ):
+                    needs_fallback = True  # average log probability is too low
+                if (
+                    no_speech_threshold is not None
+                    and decode_result.no_speech_prob > no_speech_threshold
+                ):
+                    needs_fallback = False  # silence
+                if needs_fallback:
+                    failed.append(i)
+            remaining = failed
+            if not remaining:
                 break
 
-        return decode_result
+        return decode_results
 
     seek = 0
     input_stride = exact_div(
@@ -232,150 +286,180 @@ def transcribe(
         total=content_frames, unit="frames", disable=verbose is not False
     ) as pbar:
         last_speech_timestamp = 0.0
+        fixed_windows = batch_size > 1
         while seek < content_frames:
-            time_offset = float(seek * HOP_LENGTH / SAMPLE_RATE)
-            mel_segment = mel[:, seek : seek + N_FRAMES]
-            segment_size = min(N_FRAMES, content_frames - seek)
-            segment_duration = segment_size * HOP_LENGTH / SAMPLE_RATE
-            mel_segment = pad_or_trim(mel_segment, N_FRAMES).to(model.device).to(dtype)
+            # the next `batch_size` windows, decoded together
+            window_seeks = list(range(seek, content_frames, N_FRAMES))[:batch_size]
+            segment_sizes = [min(N_FRAMES, content_frames - s) for s in window_seeks]
+            mel_segments = torch.stack(
+                [pad_or_trim(mel[:, s : s + N_FRAMES], N_FRAMES) for s in window_seeks]
+            ).to(model.device).to(dtype)
+            vid_segments = None
+            if video is not None:
+                vid_segments = [video_segment(s, n) for s, n in zip(window_seeks, segment_sizes)]
+                max_len = max(v.shape[2] for v in vid_segments)
+                vid_segments = torch.cat([pad_or_trim(v, max_len, axis=2) for v in vid_segments])
 
             decode_options["prompt"] = all_tokens[prompt_reset_since:]
-            result: DecodingResult = decode_with_fallback(mel_segment)
-            tokens = torch.tensor(result.tokens)
+            results = decode_with_fallback(mel_segments, vid_segments)
+
+            for seek, segment_size, mel_segment, result in zip(
+                window_seeks, segment_sizes, mel_segments, results
+            ):
+                time_offset = float(seek * HOP_LENGTH / SAMPLE_RATE)
+                segment_duration = segment_size * HOP_LENGTH / SAMPLE_RATE
+                tokens = torch.tensor(result.tokens)
+
+                if no_speech_threshold is not None:
+                    # no voice activity check
+                    should_skip = result.no_speech_prob > no_speech_threshold
+                    if (
+                        logprob_threshold is not None
+                        and result.avg_logprob > logprob_threshold
+                    ):
+                        # don't skip if the logprob is high enough, despite the no_speech_prob
+                        should_skip = False
+
+                    if should_skip:
+                        seek += segment_size  # fast-forward to the next segment boundary
+                        continue
+
+                previous_seek = seek
+                current_segments = []
+
+                timestamp_tokens: torch.Tensor = tokens.ge(tokenizer.timestamp_begin)
+                single_timestamp_ending = timestamp_tokens[-2:].tolist() == [False, True]
+
+                consecutive = torch.where(timestamp_tokens[:-1] & timestamp_tokens[1:])[0]
+                consecutive.add_(1)
+                if len(consecutive) > 0:
+                    # if the output contains two consecutive timestamp tokens
+                    slices = consecutive.tolist()
+                    if single_timestamp_ending:
+                        slices.append(len(tokens))
+
+                    last_slice = 0
+                    for current_slice in slices:
+                        sliced_tokens = tokens[last_slice:current_slice]
+                        start_timestamp_pos = (
+                            sliced_tokens[0].item() - tokenizer.timestamp_begin
+                        )
+                        end_timestamp_pos = (
+                            sliced_tokens[-1].item() - tokenizer.timestamp_begin
+                        )
+                        current_segments.append(
+                            new_segment(
+                                start=time_offset + start_timestamp_pos * time_precision,
+                                end=time_offset + end_timestamp_pos * time_precision,
+                                tokens=sliced_tokens,
+                                result=result,
+                            )
+                        )
+                        last_slice = current_slice
+
+                    if single_timestamp_ending:
+                        # single timestamp at the end means no speech after the last timestamp.
+                        seek += segment_size
+                    elif fixed_windows:
+                        # the next window is already decoded, so keep the unfinished segment
+                        # up to the end of this window instead of seeking back to it
+                        if last_slice < len(tokens):
+                            current_segments.append(
+                                new_segment(
+                                    start=current_segments[-1]["end"],
+                                    end=time_offset + segment_duration,
+                                    tokens=tokens[last_slice:],
+                                    result=result,
+                                )
+                            )
+                        seek += segment_size
+                    else:
+                        # otherwise, ignore the unfinished segment and seek to the last timestamp
+                        last_timestamp_pos = (
+                            tokens[last_slice - 1].item() - tokenizer.timestamp_begin
+                        )
+                        seek += last_timestamp_pos * input_stride
+                else:
+                    duration = segment_duration
+                    timestamps = tokens[timestamp_tokens.nonzero().flatten()]
+                    if (
+                        len(timestamps) > 0
+                        and timestamps[-1].item() != tokenizer.timestamp_begin
+                    ):
+                        # no consecutive timestamps but it has a timestamp; use the last one.
+                        last_timestamp_pos = (
+                            timestamps[-1].item() - tokenizer.timestamp_begin
+                        )
+                        duration = last_timestamp_pos * time_precision
 
-            if no_speech_threshold is not None:
-                # no voice activity check
-                should_skip = result.no_speech_prob > no_speech_threshold
-                if (
-                    logprob_threshold is not None
-                    and result.avg_logprob > logprob_threshold
-                ):
-                    # don't skip if the logprob is high enough, despite the no_speech_prob
-                    should_skip = False
-
-                if should_skip:
-                    seek += segment_size  # fast-forward to the next segment boundary
-                    continue
-
-            previous_seek = seek
-            current_segments = []
-
-            timestamp_tokens: torch.Tensor = tokens.ge(tokenizer.timestamp_begin)
-            single_timestamp_ending = timestamp_tokens[-2:].tolist() == [False, True]
-
-            consecutive = torch.where(timestamp_tokens[:-1] & timestamp_tokens[1:])[0]
-            consecutive.add_(1)
-            if len(consecutive) > 0:
-                # if the output contains two consecutive timestamp tokens
-                slices = consecutive.tolist()
-                if single_timestamp_ending:
-                    slices.append(len(tokens))
-
-                last_slice = 0
-                for current_slice in slices:
-                    sliced_tokens = tokens[last_slice:current_slice]
-                    start_timestamp_pos = (
-                        sliced_tokens[0].item() - tokenizer.timestamp_begin
-                    )
-                    end_timestamp_pos = (
-                        sliced_tokens[-1].item() - tokenizer.timestamp_begin
-                    )
                     current_segments.append(
                         new_segment(
-                            start=time_offset + start_timestamp_pos * time_precision,
-                            end=time_offset + end_timestamp_pos * time_precision,
-                            tokens=sliced_tokens,
+                            start=time_offset,
+                            end=time_offset + duration,
+                            tokens=tokens,
                             result=result,
                         )
                     )
-                    last_slice = current_slice
-
-                if single_timestamp_ending:
-                    # single timestamp at the end means no speech after the last timestamp.
                     seek += segment_size
-                else:
-                    # otherwise, ignore the unfinished segment and seek to the last timestamp
-                    last_timestamp_pos = (
-                        tokens[last_slice - 1].item() - tokenizer.timestamp_begin
-                    )
-                    seek += last_timestamp_pos * input_stride
-            else:
-                duration = segment_duration
-                timestamps = tokens[timestamp_tokens.nonzero().flatten()]
-                if (
-                    len(timestamps) > 0
-                    and timestamps[-1].item() != tokenizer.timestamp_begin
-                ):
-                    # no consecutive timestamps but it has a timestamp; use the last one.
-                    last_timestamp_pos = (
-                        timestamps[-1].item() - tokenizer.timestamp_begin
-                    )
-                    duration = last_timestamp_pos * time_precision
-
-                current_segments.append(
-                    new_segment(
-                        start=time_offset,
-                        end=time_offset + duration,
-                        tokens=tokens,
-                        result=result,
+
+                if word_timestamps:
+                    add_word_timestamps(
+                        segments=current_segments,
+                        model=model,
+                        tokenizer=tokenizer,
+                        mel=mel_segment,
+                        num_frames=segment_size,
+                        prepend_punctuations=prepend_punctuations,
+                        append_punctuations=append_punctuations,
+                        last_speech_timestamp=last_speech_timestamp,
                     )
+                    word_end_timestamps = [
+                        w["end"] for s in current_segments for w in s["words"]
+                    ]
+                    if len(word_end_timestamps) > 0:
+                        last_speech_timestamp = word_end_timestamps[-1]
+                    if (
+                        not single_timestamp_ending
+                        and not fixed_windows
+                        and len(word_end_timestamps) > 0
+                    ):
+                        seek_shift = round(
+                            (word_end_timestamps[-1] - time_offset) * FRAMES_PER_SECOND
+                        )
+                        if seek_shift > 0:
+                            seek = previous_seek + seek_shift
+
+                if verbose:
+                    for segment in current_segments:
+                        start, end, text = segment["start"], segment["end"], segment["text"]
+                        line = f"[{format_timestamp(start)} --> {format_timestamp(end)}] {text}"
+                        print(make_safe(line))
+
+                # if a segment is instantaneous or does not contain text, clear it
+                for i, segment in enumerate(current_segments):
+                    if segment["start"] == segment["end"] or segment["text"].strip() == "":
+                        segment["text"] = ""
+                        segment["tokens"] = []
+                        segment["words"] = []
+
+                all_segments.extend(
+                    [
+                        {"id": i, **segment}
+                        for i, segment in enumerate(
+                            current_segments, start=len(all_segments)
+                        )
+                    ]
                 )
-                seek += segment_size
-
-            if word_timestamps:
-                add_word_timestamps(
-                    segments=current_segments,
-                    model=model,
-                    tokenizer=tokenizer,
-                    mel=mel_segment,
-                    num_frames=segment_size,
-                    prepend_punctuations=prepend_punctuations,
-                    append_punctuations=append_punctuations,
-                    last_speech_timestamp=last_speech_timestamp,
+                all_tokens.extend(
+                    [token for segment in current_segments for token in segment["tokens"]]
                 )
-                word_end_timestamps = [
-                    w["end"] for s in current_segments for w in s["words"]
-                ]
-                if len(word_end_timestamps) > 0:
-                    last_speech_timestamp = word_end_timestamps[-1]
-                if not single_timestamp_ending and len(word_end_timestamps) > 0:
-                    seek_shift = round(
-                        (word_end_timestamps[-1] - time_offset) * FRAMES_PER_SECOND
-                    )
-                    if seek_shift > 0:
-                        seek = previous_seek + seek_shift
-
-            if verbose:
-                for segment in current_segments:
-                    start, end, text = segment["start"], segment["end"], segment["text"]
-                    line = f"[{format_timestamp(start)} --> {format_timestamp(end)}] {text}"
-                    print(make_safe(line))
-
-            # if a segment is instantaneous or does not contain text, clear it
-            for i, segment in enumerate(current_segments):
-                if segment["start"] == segment["end"] or segment["text"].strip() == "":
-                    segment["text"] = ""
-                    segment["tokens"] = []
-                    segment["words"] = []
-
-            all_segments.extend(
-                [
-                    {"id": i, **segment}
-                    for i, segment in enumerate(
-                        current_segments, start=len(all_segments)
-                    )
-                ]
-            )
-            all_tokens.extend(
-                [token for segment in current_segments for token in segment["tokens"]]
-            )
 
-            if not condition_on_previous_text or result.temperature > 0.5:
-                # do not feed the prompt tokens if a high temperature was used
-                prompt_reset_since = len(all_tokens)
+                if not condition_on_previous_text or result.temperature > 0.5:
+                    # do not feed the prompt tokens if a high temperature was used
+                    prompt_reset_since = len(all_tokens)
 
-            # update progress bar
-            pbar.update(min(content_frames, seek) - previous_seek)
+                # update progress bar
+                pbar.update(min(content_frames, seek) - previous_seek)
 
     return dict(
         text=tokenizer.decode(all_tokens[len(initial_prompt_tokens) :]),
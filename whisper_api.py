@@ -1,16 +1,23 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, BackgroundTasks
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 import os
-import tempfile
+import asyncio
+import time
+import numpy as np
 import torch
 import whisper
-import shutil
 import logging
 from typing import Optional, Dict, Any, List
 import uvicorn
 import json
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
+from whisper.audio import N_SAMPLES, SAMPLE_RATE, VIDEO_FRAMES_PER_SECOND
+from utils import load_wave_bytes, load_video_bytes, preprocess_video_frames, preprocess_video_batch
+from noise_bank import load_noise_bank, mix_noise, parse_noise_banks, noise_bank_path
+from model_registry import ModelRegistry
+from batch_scheduler import BatchScheduler, collate_inputs
+from worker_pool import WorkerPool, ServerBusyError
 
 # Configure logging
 logging.basicConfig(
@@ -34,9 +41,7 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-# Global variables to store model instances
-whisper_model = None
-tokenizer = None
+# Global configuration
 model_type = "medium"  # Default model type
 device = "cuda" if torch.cuda.is_available() else "cpu"
 use_av_hubert_encoder = 1
@@ -44,6 +49,19 @@ av_fusion = "separate"
 whisper_path = "models/"
 av_hubert_path = "av_hubert/avhubert/"
 av_hubert_ckpt = "models/large_noise_pt_noise_ft_433h_only_weights.pt"  # Path to AV-HuBERT weights
+model_budget_gb = float(os.environ["MODEL_BUDGET_GB"]) if "MODEL_BUDGET_GB" in os.environ else None
+warm_languages = os.environ.get("WARM_LANGUAGES", "en,lrs2,multi").split(",")  # "multi" -> multi-all ckpt
+long_form_batch_size = int(os.environ.get("LONG_FORM_BATCH_SIZE", 1))  # 30 s windows decoded together
+batch_max_size = int(os.environ.get("BATCH_MAX_SIZE", 8))
+batch_max_wait_ms = float(os.environ.get("BATCH_MAX_WAIT_MS", 20))
+preprocess_workers = int(os.environ.get("PREPROCESS_WORKERS", 4))
+max_pending_requests = int(os.environ.get("MAX_PENDING_REQUESTS", 32))  # beyond this, 429
+request_timeout_s = float(os.environ.get("REQUEST_TIMEOUT_S", 60))  # beyond this, 503
+noise_banks = parse_noise_banks(os.environ.get("NOISE_BANKS", "babble=noise/babble/muavic/test.tsv"))  # name -> tsv
+
+# Resident models, keyed by (model_type, checkpoint, modality, fp16)
+model_registry = ModelRegistry(whisper_path, av_hubert_path, av_hubert_ckpt, use_av_hubert_encoder,
+                               av_fusion, device=device, budget_gb=model_budget_gb)
 
 # Multilingual support
 supported_languages = {
@@ -65,6 +83,7 @@ class TranscriptionRequest(BaseModel):
     task: str = "transcribe"  # Options: transcribe, En-X, X-En
     modalities: str = "avsr"  # Options: avsr (audio-visual), asr (audio-only), vsr (video-only)
     beam_size: int = 1
+    noise: Optional[str] = None  # name of a noise in NOISE_BANKS, used when noise_snr < 100
 
 class TranscriptionResponse(BaseModel):
     text: str
@@ -74,94 +93,170 @@ class TranscriptionResponse(BaseModel):
 @app.on_event("startup")
 async def startup_event():
     logger.info(f"Starting up Whisper-Flamingo API using device: {device}")
-    # Model will be loaded on demand to save resources
+    # Load the commonly served checkpoints in the background, others are loaded on demand
+    for language in warm_languages:
+        checkpoint_path = get_checkpoint_path(language, "avsr")
+        if os.path.exists(checkpoint_path):
+            model_registry.warm(model_type, checkpoint_path, "avsr", device == "cuda")
 
 def load_model(language="en", modalities="avsr", checkpoint_path=None):
-    """Load the appropriate Whisper-Flamingo model based on parameters"""
-    global whisper_model, tokenizer
-    
-    if whisper_model is not None:
-        # If model is already loaded, return it
-        return whisper_model, tokenizer
-    
-    logger.info(f"Loading Whisper model: {model_type}")
-    
-    # Determine if using multilingual tokenizer
-    multilingual = True if 'large' in model_type or 'en' not in model_type else False
-    logger.info(f"Using multilingual tokenizer: {multilingual}")
-    
-    # Determine task (transcribe or translate)
-    task = 'translate' if language == 'X-En' else 'transcribe'
-    
-    # Create tokenizer
-    tokenizer = whisper.tokenizer.get_tokenizer(multilingual=multilingual, task=task)
-    
-    # Load Whisper model with appropriate settings
-    whisper_model = whisper.load_model(
-        model_type, 
-        download_root=whisper_path,
-        video=True if modalities != "asr" else False,
-        video_model_path=av_hubert_ckpt if modalities != "asr" else None,
-        av_hubert_path=av_hubert_path if modalities != "asr" else None,
-        av_hubert_encoder=use_av_hubert_encoder if modalities != "asr" else 0,
-        av_fusion=av_fusion if modalities != "asr" else "None",
-        add_gated_x_attn=1 if av_fusion == 'separate' and modalities != "asr" else 0
+    """Get the Whisper-Flamingo model for the given parameters from the registry"""
+    return model_registry.get(model_type, checkpoint_path, modalities, device == "cuda")
+
+def load_audio_bytes(audio_bytes, noise_snr=1000, noise_fn=None):
+    """Decode an uploaded 16 kHz WAV in memory and optionally mix in noise, returns float32 samples"""
+    sample_rate, wav_data = load_wave_bytes(audio_bytes)
+    if sample_rate != SAMPLE_RATE:
+        raise ValueError(f"Sample rate must be {SAMPLE_RATE} Hz, got {sample_rate} Hz")
+    audio = wav_data.flatten().astype(np.float32) / 32768.0
+    if noise_snr < 100 and noise_fn and os.path.exists(noise_fn):
+        audio = mix_noise(audio, load_noise_bank(noise_fn), noise_snr)
+    return audio
+
+def preprocess_media(audio_bytes, video_bytes, modalities, noise_snr, noise_fn):
+    """
+    Decode the uploaded bytes into (audio, video, long_form, duration_s), runs on the preprocessing threads.
+    Inputs up to 30 s are padded to 30 s, as Whisper was trained on, and batched with the log-mels
+    computed for the whole batch on the device; longer inputs are transcribed in 30 s windows.
+    """
+    video = None
+    if modalities in ["avsr", "vsr"]:
+        video = load_video_bytes(video_bytes) # uint8 frames, center cropped and normalized for the decode
+
+    if audio_bytes is not None and modalities != "vsr":
+        audio = load_audio_bytes(audio_bytes, noise_snr, noise_fn)
+        if video is not None:
+            # Trim videos longer than the audio, as in the dataset
+            video = video[:round(len(audio) / SAMPLE_RATE * VIDEO_FRAMES_PER_SECOND)]
+    else:
+        # video-only: the encoder drops the audio features, silence only sets the duration
+        audio = np.zeros(len(video) * SAMPLE_RATE // VIDEO_FRAMES_PER_SECOND, dtype=np.float32)
+    duration_s = round(len(audio) / SAMPLE_RATE, 2)
+    if len(audio) > N_SAMPLES:
+        return audio, video, True, duration_s
+    return whisper.pad_or_trim(audio, length=N_SAMPLES), video, False, duration_s
+
+def decoding_options(language, task, beam_size):
+    return whisper.DecodingOptions(
+        task='translate' if task == 'X-En' else 'transcribe',
+        language=None if language == "auto" else language.replace('lrs2', 'en'),  # Handle LRS2 special case
+        fp16=device == "cuda",
+        without_timestamps=True,
+        beam_size=None if beam_size == 1 else beam_size,
     )
-    
-    # Load checkpoint if provided
-    if checkpoint_path:
-        logger.info(f"Loading checkpoint from {checkpoint_path}")
-        try:
-            state_dict = torch.load(checkpoint_path, map_location=torch.device(device))
-            if 'state_dict' in state_dict:
-                state_dict = state_dict['state_dict']
-                # Remove 'model.' prefix from keys
-                state_dict_updated = {k[6:]: v for k, v in state_dict.items()}
-                try:
-                    whisper_model.load_state_dict(state_dict_updated)
-                except Exception as e:
-                    logger.warning(f"Loading with strict=False due to: {str(e)}")
-                    whisper_model.load_state_dict(state_dict_updated, strict=False)
-            else:
-                try:
-                    whisper_model.load_state_dict(state_dict)
-                except Exception as e:
-                    logger.warning(f"Loading with strict=False due to: {str(e)}")
-                    whisper_model.load_state_dict(state_dict, strict=False)
-        except Exception as e:
-            logger.error(f"Failed to load checkpoint: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"Failed to load model checkpoint: {str(e)}")
-    
-    # Move model to appropriate device
-    whisper_model.to(device)
-    whisper_model.eval()
-    
-    return whisper_model, tokenizer
 
-def process_media(audio_file_path, video_file_path, language, noise_snr, task, modalities, beam_size):
+def decode_batch(key, items):
+    """Decode up to 30 s of audio/video of every request sharing `key` in one batch, on the inference thread"""
+    checkpoint_path, modalities, language, task, beam_size, _ = key
+    start = time.perf_counter()
+    model, tokenizer = load_model(language, modalities, checkpoint_path)
+    loaded = time.perf_counter()
+    options = decoding_options(language, task, beam_size)
+
+    audio, audio_lengths, video, padding_mask = collate_inputs(*zip(*items))
+    dtype = torch.float16 if options.fp16 else torch.float32
+    mel, mel_lengths = whisper.log_mel_spectrogram_batch(audio.to(device), audio_lengths, n_mels=model.dims.n_mels)
+    mel = mel.to(dtype)
+    if video is not None:
+        padding_mask = padding_mask.to(device)
+        video = preprocess_video_batch(video.to(device), padding_mask, dtype=dtype)
+    # the padding of the shorter requests is not attended to, each one decodes as it would alone
+    masks = dict(mel_lengths=mel_lengths, video_padding_mask=padding_mask)
+
+    with torch.no_grad():
+        if modalities == "avsr":
+            results = model.decode(mel, options, video, **masks)
+        elif modalities == "asr":
+            results = model.decode(mel, options, test_a=True, **masks)
+        elif modalities == "vsr":
+            results = model.decode(mel, options, video, test_v=True, **masks)
+        else:
+            raise ValueError(f"Unsupported modality: {modalities}")
+    decoded = time.perf_counter()
+
+    return [{
+        "text": result.text,
+        "language": result.language,
+        "avg_logprob": result.avg_logprob,
+        "no_speech_prob": result.no_speech_prob,
+        "compression_ratio": result.compression_ratio,
+        "num_tokens": len(result.tokens),
+        "batch_size": len(items),
+        "timings_ms": {
+            "load_model": round(1000 * (loaded - start), 2),
+            "decode": round(1000 * (decoded - loaded), 2),
+        },
+    } for result in results]
+
+def decode_long(key, audio, video):
+    """Decode audio/video longer than 30 s in windows, with the previous text as prompt, on the inference thread"""
+    checkpoint_path, modalities, language, task, beam_size, _ = key
+    start = time.perf_counter()
+    model, tokenizer = load_model(language, modalities, checkpoint_path)
+    loaded = time.perf_counter()
+    options = decoding_options(language, task, beam_size)
+    result = model.transcribe(
+        audio,
+        video=preprocess_video_frames(video).astype(np.float32) if video is not None else None,
+        test_a=modalities == "asr",
+        test_v=modalities == "vsr",
+        batch_size=long_form_batch_size,
+        temperature=0.0,
+        verbose=None,
+        language=options.language,
+        task=options.task,
+        fp16=options.fp16,
+        beam_size=options.beam_size,
+    )
+    decoded = time.perf_counter()
+    segments = result["segments"]
+    return {
+        "text": result["text"],
+        "language": result["language"],
+        "segments": [{k: seg[k] for k in ("start", "end", "text")} for seg in segments],
+        "avg_logprob": float(np.mean([seg["avg_logprob"] for seg in segments])) if segments else None,
+        "num_tokens": sum(len(seg["tokens"]) for seg in segments),
+        "timings_ms": {
+            "load_model": round(1000 * (loaded - start), 2),
+            "decode": round(1000 * (decoded - loaded), 2),
+        },
+    }
+
+# Preprocessing thread pool, dedicated inference thread and admission control
+worker_pool = WorkerPool(preprocess_workers, max_pending_requests, request_timeout_s)
+
+# Requests with the same checkpoint, modality, language, task, beam size and frame size are decoded together
+batch_scheduler = BatchScheduler(decode_batch, max_batch_size=batch_max_size, max_wait_ms=batch_max_wait_ms,
+                                 worker_pool=worker_pool)
+
+async def process_media(audio_bytes, video_bytes, language, noise_snr, task, modalities, beam_size, noise_fn=None):
     """Process audio/video and return transcription"""
+    start = time.perf_counter()
     # Determine the appropriate checkpoint path based on language and modalities
     checkpoint_path = get_checkpoint_path(language, modalities)
-    
-    # Load model
-    model, tokenizer = load_model(language, modalities, checkpoint_path)
-    
-    # Set up decoding options
-    task_type = 'translate' if task == 'X-En' else 'transcribe'
-    options = whisper.DecodingOptions(
-        task=task_type, 
-        language=language.replace('lrs2', 'en'),  # Handle LRS2 special case
-        fp16=(device == "cuda"),
-        without_timestamps=True,
-        beam_size=None if beam_size == 1 else beam_size,
-    )
-    
-    # TODO: Implement the actual media processing code
-    # This will depend on how your whisper_decode_video.py script processes inputs
-    
-    # Mock implementation - replace with actual implementation
-    result = {"text": "This is a mock transcription. Implement actual processing."}
-    
+
+    audio, video, long_form, duration_s = await worker_pool.preprocess(
+        preprocess_media, audio_bytes, video_bytes, modalities, noise_snr, noise_fn)
+    preprocessed = time.perf_counter()
+
+    # videos are only stacked with frames of the same size
+    key = (checkpoint_path, modalities, language, task, beam_size, None if video is None else video.shape[1:])
+    if long_form: # windows of 30 s, not batched
+        result = await worker_pool.infer(decode_long, key, audio, video)
+    else:
+        result = await batch_scheduler.submit(key, (audio, video))
+    decoded = time.perf_counter()
+
+    result.update({
+        "checkpoint": checkpoint_path,
+        "duration_s": duration_s,
+        "timings_ms": {
+            **result["timings_ms"],
+            "preprocess": round(1000 * (preprocessed - start), 2),
+            "queue_and_decode": round(1000 * (decoded - preprocessed), 2),
+            "total": round(1000 * (decoded - start), 2),
+        },
+    })
     return result
 
 def get_checkpoint_path(language, modalities):
@@ -169,7 +264,7 @@ def get_checkpoint_path(language, modalities):
     Determine the appropriate model checkpoint based on language and modality
     """
     # This is a simplified implementation - you'll need to expand this based on your models
-    if modalities == "avsr":
+    if modalities in ["avsr", "vsr"]:
         if language == "en":
             return "models/whisper-flamingo_en-x_medium.pt"
         elif language == "lrs2":
@@ -188,14 +283,18 @@ def get_checkpoint_path(language, modalities):
 
 @app.post("/transcribe/", response_model=TranscriptionResponse)
 async def transcribe_file(
-    background_tasks: BackgroundTasks,
     audio_file: UploadFile = File(None),
     video_file: UploadFile = File(None),
-    params: TranscriptionRequest = Form(...)
+    params: str = Form(...)
 ):
     """
     Transcribe audio/video file using Whisper-Flamingo
     """
+    try:
+        params = TranscriptionRequest(**json.loads(params))
+    except (json.JSONDecodeError, ValidationError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid params: {str(e)}")
+
     # Validate language
     if params.language not in supported_languages and params.language != "auto":
         raise HTTPException(
@@ -204,10 +303,13 @@ async def transcribe_file(
         )
     
     # Validate modality and files
-    if params.modalities == "avsr" and not video_file:
+    if params.modalities not in ["avsr", "asr", "vsr"]:
+        raise HTTPException(status_code=400, detail=f"Unsupported modality: {params.modalities}")
+
+    if params.modalities in ["avsr", "vsr"] and not video_file:
         raise HTTPException(
             status_code=400,
-            detail="Video file is required for audio-visual speech recognition mode"
+            detail="Video file is required for modes that use video"
         )
     
     if params.modalities in ["avsr", "asr"] and not audio_file:
@@ -216,58 +318,41 @@ async def transcribe_file(
             detail="Audio file is required for modes that use audio"
         )
     
-    # Create temporary directory
-    temp_dir = tempfile.mkdtemp()
-    audio_path = None
-    video_path = None
-    
     try:
-        # Save uploaded files
-        if audio_file:
-            audio_path = os.path.join(temp_dir, audio_file.filename)
-            with open(audio_path, "wb") as f:
-                content = await audio_file.read()
-                f.write(content)
-        
-        if video_file:
-            video_path = os.path.join(temp_dir, video_file.filename)
-            with open(video_path, "wb") as f:
-                content = await video_file.read()
-                f.write(content)
-        
-        # Process the files
-        result = process_media(
-            audio_path,
-            video_path,
-            params.language,
-            params.noise_snr,
-            params.task,
-            params.modalities,
-            params.beam_size
-        )
-        
-        # Add cleanup task
-        background_tasks.add_task(cleanup_temp_files, temp_dir)
-        
-        return TranscriptionResponse(
-            text=result["text"],
-            language=params.language,
-            metrics={"confidence": 0.95}  # Mock confidence score
-        )
-    
+        async with worker_pool.admit():
+            # Uploads are decoded in memory, nothing is written to disk
+            audio_bytes = await audio_file.read() if audio_file else None
+            video_bytes = await video_file.read() if video_file else None
+            result = await worker_pool.run(process_media(
+                audio_bytes,
+                video_bytes,
+                params.language,
+                params.noise_snr,
+                params.task,
+                params.modalities,
+                params.beam_size,
+                noise_bank_path(noise_banks, params.noise),
+            ))
+    except HTTPException:
+        raise
+    except ValueError as e:
+        logger.error(f"Invalid media: {str(e)}")
+        raise HTTPException(status_code=400, detail=str(e))
+    except ServerBusyError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail=f"Request timed out after {worker_pool.timeout_s} s",
+                            headers={"Retry-After": "5"})
     except Exception as e:
-        # Clean up on error
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-        
         logger.error(f"Error processing files: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-def cleanup_temp_files(temp_dir):
-    """Clean up temporary files"""
-    if os.path.exists(temp_dir):
-        shutil.rmtree(temp_dir)
-        logger.info(f"Cleaned up temporary directory: {temp_dir}")
+    logger.info(f"Transcribed {params.modalities} request in {result['timings_ms']['total']} ms")
+    return TranscriptionResponse(
+        text=result.pop("text"),
+        language=result.pop("language"),
+        metrics=result,
+    )
 
 @app.get("/languages/")
 async def get_languages():
@@ -291,7 +376,9 @@ async def get_models():
 @app.get("/health/")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "ok", "device": device}
+    return {"status": "ok", "device": device, "queued": batch_scheduler.queued,
+            **worker_pool.stats(), "models": model_registry.status()}
 
 if __name__ == "__main__":
-    uvicorn.run("whisper_api:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    port = int(os.environ.get("PORT", 8000))
+    uvicorn.run("whisper_api:app", host="0.0.0.0", port=port)
\ No newline at end of file
@@ -17,9 +17,11 @@ from spec_augment import spec_augment
 from utils import (
     load_data,
     WhisperVideoCollatorWithPadding,
+    VideoFeatureCache,
+    preprocess_video_batch,
 )
 from utils_batch_samplers import LengthBatchSampler
-from whisper_ft_muavic_video import MuavicVideoDataset
+from whisper_ft_muavic_video import MuavicVideoDataset, PackedMuavicVideoDataset
 from fairseq.scoring.wer import WerScorer, WerScorerConfig
 import sacrebleu
 
@@ -41,6 +43,10 @@ parser.add_argument('--av-hubert-ckpt', default="models/large_noise_pt_noise_ft_
                                         help='path to avhubert ckpt (needed to load the model architecture)')
 parser.add_argument('--task', default='transcribe', type=str, help='transcribe, En-X, X-En')
 parser.add_argument('--normalizer', default='fairseq', type=str, help='whisper OR fairseq')
+parser.add_argument('--video-feat-cache', default='', type=str, 
+                    help='video features from whisper_extract_video_feats.py, skips the video model')
+parser.add_argument('--packed-corpus', default='', type=str, 
+                    help='test split packed by whisper_pack_corpus.py, e.g. packed/en/test, instead of the tsv files')
 parser.add_argument('--use-original-whisper', default=0, type=int, 
                                         help='if 1, ignore checkpoint-path and use original whisper')
                                         
@@ -57,14 +63,15 @@ use_lrs2 = True if args.lang == 'lrs2' else False
 if args.lang == 'lrs2':
     args.lang = 'en'
 
-# audio_transcript_pair_list = load_data(480000, 350, [args.lang], muavic_root='/data/sls/scratch/roudi/datasets/muavic/', 
-audio_transcript_pair_list = load_data(480000, 350, [args.lang], muavic_root='', 
-                                       include_audio_lens=True, task=args.task, lrs2=use_lrs2)
+if not args.packed_corpus:
+    # audio_transcript_pair_list = load_data(480000, 350, [args.lang], muavic_root='/data/sls/scratch/roudi/datasets/muavic/', 
+    audio_transcript_pair_list = load_data(480000, 350, [args.lang], muavic_root='', 
+                                           include_audio_lens=True, task=args.task, lrs2=use_lrs2)
 
-test_dataset =  audio_transcript_pair_list['test']
-test_dataset = [[i[0], i[1].replace('/data/sls/scratch/roudi/datasets/muavic/', ''),
-                                    i[2], i[3]] for i in test_dataset] # fix paths
-# test_dataset = [[i[0], i[1], i[2], i[3]] for i in test_dataset] # use original paths
+    test_dataset =  audio_transcript_pair_list['test']
+    test_dataset = [[i[0], i[1].replace('/data/sls/scratch/roudi/datasets/muavic/', ''),
+                                        i[2], i[3]] for i in test_dataset] # fix paths
+    # test_dataset = [[i[0], i[1], i[2], i[3]] for i in test_dataset] # use original paths
 multilingual = True if 'large' in args.model_type or 'en' not in args.model_type else False
 print("Multilingual tokenizer : {}".format(multilingual))
 
@@ -75,29 +82,35 @@ special_token_set = set(tokenizer.special_tokens.values())
 
 args.checkpoint_path= None if args.use_original_whisper else args.checkpoint_path
 # If the original Whisper from OpenAI is used, crop / pad the audio to 30s
-dataset = MuavicVideoDataset(test_dataset, 
-                                tokenizer, 
-                                SAMPLE_RATE, 
-                                args.model_type,
-                                max_length=None if args.checkpoint_path else SAMPLE_RATE * 30,
-                                spec_augment="", # no spec augment
-                                noise_prob=1 if args.noise_snr != 1000 else 0,
-                                noise_fn = args.noise_fn,
-                                train=False, # video center crop, no flip
-                                noise_snr=args.noise_snr,)   
+dataset_kwargs = dict(max_length=None if args.checkpoint_path else SAMPLE_RATE * 30,
+                      noise_prob=1 if args.noise_snr != 1000 else 0,
+                      noise_fn = args.noise_fn,
+                      train=False, # video center crop, no flip
+                      noise_snr=args.noise_snr,
+                      noise_seed=SEED,) # same noise for every run
+if args.packed_corpus:
+    dataset = PackedMuavicVideoDataset(args.packed_corpus, tokenizer, SAMPLE_RATE, **dataset_kwargs)
+else:
+    dataset = MuavicVideoDataset(test_dataset, 
+                                    tokenizer, 
+                                    SAMPLE_RATE, 
+                                    video_feat_cache=VideoFeatureCache(args.video_feat_cache) if args.video_feat_cache else None,
+                                    **dataset_kwargs)   
 
 # For beam size of 1, use batch decoding with ~40s of audio per batch
 # For beam size >1, each audio sample is decoded separately
 length_sorter = LengthBatchSampler(batch_bins=SAMPLE_RATE * 40 if args.checkpoint_path and \
                                    args.beam_size == 1 else 1,
-                            shapes=[i[3] for i in test_dataset],
+                            shapes=dataset.shapes,
                             sort_in_batch='descending',
                             sort_batch='descending',
                             drop_last=False)
 
+# collated in this process: reuse the batch tensors, pinned for the non_blocking copies
 dataloader = torch.utils.data.DataLoader(dataset,
                     num_workers=0, #original: 8
-                    collate_fn=WhisperVideoCollatorWithPadding(),
+                    collate_fn=WhisperVideoCollatorWithPadding(dataset.noise_bank, reuse_buffers=True,
+                                                               pin_memory=torch.cuda.is_available()),
                     batch_sampler=length_sorter)
 
 print("Loading Whisper")
@@ -154,24 +167,30 @@ whisper_model.eval() # AV-HuBERT batch norm and dropout
 with open(os.path.join(out_path, 'pred.txt'), 'w+') as f:
     for i, b in enumerate(tqdm(dataloader)):
         if args.fp16:
-            input_ids = b["input_ids"].half().cuda()
-            video = b["video"].half().cuda()
+            audio, audio_lengths = b["audio"].cuda(non_blocking=True), b["audio_lengths"].cuda()
+            video = b["video"].cuda(non_blocking=True)
         else:
             if torch.cuda.is_available():
-              input_ids = b["input_ids"].cuda()
-              video = b["video"].cuda()
+              audio, audio_lengths = b["audio"].cuda(non_blocking=True), b["audio_lengths"].cuda()
+              video = b["video"].cuda(non_blocking=True)
             else:
-              input_ids = b["input_ids"]
+              audio, audio_lengths = b["audio"], b["audio_lengths"]
               video = b["video"]
+        input_ids, mel_lengths = whisper.log_mel_spectrogram_batch(audio, audio_lengths, n_mels=whisper_model.dims.n_mels)
+        padding_mask = b["padding_mask"].to(video.device)
+        # uint8 frames are center cropped and normalized here, cached features only cast
+        video = preprocess_video_batch(video, padding_mask, dtype=torch.float16 if args.fp16 else torch.float32)
+        if args.fp16:
+            input_ids = input_ids.half()
         labels = b["labels"]
         with torch.no_grad():
-            # NOTE: haven't implemented padding mask for AV-HuBERT, but it seems to work fine without it
+            masks = dict(mel_lengths=mel_lengths, video_padding_mask=padding_mask)
             if args.modalities == "avsr":
-                results = whisper_model.decode(input_ids, options, video)
+                results = whisper_model.decode(input_ids, options, video, **masks)
             elif args.modalities == "asr": 
-                results = whisper_model.decode(input_ids, options, video, test_a=True)
+                results = whisper_model.decode(input_ids, options, video, test_a=True, **masks)
             elif args.modalities == "vsr": 
-                results = whisper_model.decode(input_ids, options, video, test_v=True)
+                results = whisper_model.decode(input_ids, options, video, test_v=True, **masks)
             else:
                 raise NotImplementedError
             
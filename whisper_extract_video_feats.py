@@ -0,0 +1,83 @@
+import yaml
+import types
+import argparse
+import numpy as np
+import torch
+import whisper
+from tqdm import tqdm
+from utils import load_video_feats, VideoFeatureWriter
+from whisper_ft_muavic_video import load_cfg_data
+
+# Dump the frozen video model features (before video_projection) of every utterance of a
+# training config into a VideoFeatureCache, set `video_feat_cache` in the config to use them.
+# Features are extracted with the eval transform (center crop, no flip) and the video model in
+# eval mode, so training on the cache has no video augmentation.
+parser = argparse.ArgumentParser()
+parser.add_argument('config', type=str, help='training config, for the data and the video model')
+parser.add_argument('out_dir', type=str, help='directory of the feature store')
+parser.add_argument('--splits', default='train,valid,test', type=str, help='comma separated splits to extract')
+parser.add_argument('--whisper-path', default="models/", help='path to download OpenAI whisper weights')
+parser.add_argument('--av-hubert-path', default="av_hubert/avhubert/", help='path to avhubert code')
+parser.add_argument('--strip-prefix', default='', type=str,
+                    help='remove this prefix from the video paths, e.g. to match the paths in whisper_decode_video.py')
+parser.add_argument('--shard-frames', default=1000000, type=int, help='max number of frames per shard (~2 GB for fp16)')
+parser.add_argument('--num-worker', default=8, type=int, help='video loading workers')
+parser.add_argument('--fp16', default=1, type=int, help='if 1, run the video model in fp16')
+args = parser.parse_args()
+
+class VideoDataset(torch.utils.data.Dataset):
+    def __init__(self, audio_info_list, strip_prefix=''):
+        self.audio_info_list = audio_info_list
+        self.strip_prefix = strip_prefix
+
+    def __len__(self):
+        return len(self.audio_info_list)
+
+    def __getitem__(self, id):
+        _, audio_path, _, audio_len = self.audio_info_list[id]
+        video_path = audio_path.replace('audio', 'video').replace('.wav', '.mp4')
+        video = load_video_feats(video_path, train=False).astype(np.float32)
+        # Trim some videos longer than the audio, same as MuavicVideoDataset
+        max_video_len = round(audio_len / 16000 * 25)
+        video = video[:max_video_len]
+        key = video_path[len(self.strip_prefix):] if video_path.startswith(self.strip_prefix) else video_path
+        return key, torch.from_numpy(video).permute(3, 0, 1, 2) # T, H, W, C -> C, T, H, W
+
+with open(args.config, 'r') as file:
+    cfg = types.SimpleNamespace(**yaml.safe_load(file))
+assert cfg.freeze_video_model, "cached video features need a frozen video model"
+
+print("Loading video model")
+model = whisper.load_model(cfg.model_name,
+                           device='cpu',
+                           download_root=args.whisper_path,
+                           video=True,
+                           video_model_path=cfg.video_model_ckpt,
+                           av_hubert_path=args.av_hubert_path,
+                           av_hubert_encoder=cfg.use_av_hubert_encoder,
+                           av_fusion=cfg.av_fusion,
+                           add_gated_x_attn=cfg.add_gated_x_attn)
+encoder = model.encoder
+del model.decoder
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+dtype = torch.float16 if args.fp16 and device == 'cuda' else torch.float32
+encoder.video_model.to(device=device, dtype=dtype).eval() # AV-HuBERT batch norm and dropout
+dim = encoder.video_projection.weight.shape[1]
+
+audio_transcript_pair_list = load_cfg_data(cfg)
+utterances, seen = [], set()
+for split in args.splits.split(','):
+    for utt in audio_transcript_pair_list[split]:
+        if utt[1] not in seen: # valid / test are shared between configs and noisy / clean sets
+            seen.add(utt[1])
+            utterances.append(utt)
+print("Extracting video features of {} utterances".format(len(utterances)))
+
+dataloader = torch.utils.data.DataLoader(VideoDataset(utterances, args.strip_prefix),
+                                         batch_size=None, # one utterance at a time, no padding
+                                         num_workers=args.num_worker)
+with VideoFeatureWriter(args.out_dir, dim, shard_frames=args.shard_frames) as writer, torch.no_grad():
+    for key, video in tqdm(dataloader):
+        x_v = encoder.encode_video(video.unsqueeze(0).to(device=device, dtype=dtype))
+        writer.add(key, x_v[0].float().cpu().numpy())
+print("Wrote video features to {}".format(args.out_dir))
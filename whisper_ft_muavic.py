@@ -13,11 +13,10 @@ from pytorch_lightning import LightningModule
 from pytorch_lightning import Trainer, seed_everything
 # from pytorch_lightning.cli import LightningCLI
 from tqdm import tqdm
-from spec_augment import spec_augment
+from spec_augment import spec_augment_batch
 from utils import (
     load_data,
     load_wave,
-    add_noise,
     WhisperDataCollatorWhithPadding,
     whisper_optimizer,
     setup_logging_and_checkpoint,
@@ -25,26 +24,27 @@ from utils import (
     DistributedSamplerWrapper,
 )
 from utils_batch_samplers import LengthBatchSampler
+from noise_bank import load_noise_bank, sample_noise
 
 SAMPLE_RATE = 16000
 SEED = 3407
 seed_everything(SEED, workers=True)
 
 class MuavicSpeechDataset(torch.utils.data.Dataset):
-    def __init__(self, audio_info_list, tokenizer, sample_rate, model_name, max_length, 
-                 spec_augment, noise_prob=0, noise_fn=None) -> None:
+    def __init__(self, audio_info_list, tokenizer, sample_rate, max_length, 
+                 noise_prob=0, noise_fn=None, noise_seed=None) -> None:
         super().__init__()
 
         self.audio_info_list = audio_info_list
         self.sample_rate = sample_rate
         self.tokenizer = tokenizer
-        self.model_name = model_name
         self.max_length = max_length
-        self.spec_augment = spec_augment
         self.noise_prob = noise_prob
-        self.noise_fn = [ln.strip() for ln in open(noise_fn).readlines()] if noise_fn is not None else []
+        # noise is drawn here and mixed per batch by the collator, pass it the noise_bank
+        self.noise_bank = load_noise_bank(noise_fn) if noise_fn is not None else None
+        # if not None, the noise of every utterance only depends on it and the utterance (eval sets)
+        self.noise_seed = noise_seed
         print("Dataloader max length : {}".format(max_length))
-        print("Loaded {} noise wavs".format(len(self.noise_fn)))
 
     def __len__(self):
         return len(self.audio_info_list)
@@ -52,27 +52,18 @@ class MuavicSpeechDataset(torch.utils.data.Dataset):
     def __getitem__(self, id):
         lang, audio_path, text, _ = self.audio_info_list[id]
         # audio = load_wave(audio_path, sample_rate=self.sample_rate)
-        if np.random.rand() > self.noise_prob: # disable noise
-            sample_rate, wav_data = wavfile.read(audio_path)
-            audio = wav_data.flatten().astype(np.float32) / 32768.0
-        else: # add noise
-            sample_rate, wav_data = wavfile.read(audio_path)
-            audio = add_noise(wav_data, self.noise_fn, noise_snr=0).flatten().astype(np.float32) / 32768.0
-
-        audio_frames = len(audio.flatten()) // 160
+        sample_rate, wav_data = wavfile.read(audio_path)
+        audio = wav_data.flatten().astype(np.float32) / 32768.0
+        n_samples = len(audio)
+        if self.noise_seed is not None:
+            rng = np.random.default_rng((self.noise_seed, id))
+        else: # follows the seeded global state of the worker
+            rng = np.random.default_rng(np.random.randint(2**31))
+        noise_id, snr = sample_noise(rng, self.noise_bank, self.noise_prob, 0)
+
         # pad audio to cfg.audio_max_length (longer samples filtered out already)
         if self.max_length != None:
             audio = whisper.pad_or_trim(audio.flatten(), length=self.max_length)
-        n_mels = 80 if self.model_name != 'large-v3' else 128
-        mel = whisper.log_mel_spectrogram(audio, n_mels=n_mels) # freq by time
-    
-        if self.spec_augment:
-            if self.spec_augment == "ls-double":
-                mel = torch.from_numpy(spec_augment(mel.T.numpy(), audio_frames)).T # expects time by freq
-            elif self.spec_augment == "ls-basic":
-                mel = torch.from_numpy(spec_augment(mel.T.numpy(), audio_frames, n_freq_mask=1, n_time_mask=1)).T # expects time by freq
-            else:
-                raise NotImplementedError 
 
         # Seems like Whisper decode always predicts first token with space, so add a space in the beginning
         # dec_input_ids = [*self.tokenizer.sot_sequence_including_notimestamps] + self.tokenizer.encode(" " + text)
@@ -84,7 +75,9 @@ class MuavicSpeechDataset(torch.utils.data.Dataset):
         labels = dec_input_ids[1:] + [self.tokenizer.eot]
 
         return {
-            "input_ids": mel,
+            "audio": audio, # log-mels are computed on the device, see WhisperModelModule.log_mel
+            "n_samples": n_samples, # before padding to max_length, noise is only added there
+            "noise": (noise_id, snr), # mixed by the collator
             "labels": labels,
             "dec_input_ids": dec_input_ids
         }
@@ -98,6 +91,9 @@ class WhisperModelModule(LightningModule):
                                         device='cpu', # avoid OOM on gpu 0 for distributed
                                         download_root='/data/sls/scratch/roudi/experiments/whisper/',
                                         dropout_rate=cfg.dropout_rate)
+        # '' (off), 'encoder', 'decoder' or 'all', every activation_checkpointing_every-th block
+        self.model.checkpoint_activations(getattr(cfg, 'activation_checkpointing', ''),
+                                          getattr(cfg, 'activation_checkpointing_every', 1))
         multilingual = True if 'large' in model_name or 'en' not in model_name else False
         print("Multilingual tokenizer : {}".format(multilingual))
         self.tokenizer = whisper.tokenizer.get_tokenizer(multilingual=multilingual, task='transcribe')
@@ -118,8 +114,16 @@ class WhisperModelModule(LightningModule):
     def forward(self, x):
         return self.model(x)
 
+    def log_mel(self, batch, train=False):
+        """Log-mels of the padded audio of a batch in one pass on the device and their lengths, SpecAugment when training"""
+        mel, mel_lengths = whisper.log_mel_spectrogram_batch(batch["audio"], batch["audio_lengths"],
+                                                             n_mels=self.model.dims.n_mels)
+        if train and self.cfg.spec_augment:
+            mel = spec_augment_batch(mel, mel_lengths, self.cfg.spec_augment)
+        return mel, mel_lengths
+
     def training_step(self, batch, batch_id):
-        input_ids = batch["input_ids"]
+        input_ids, mel_lengths = self.log_mel(batch, train=True)
         labels = batch["labels"].long()
         dec_input_ids = batch["dec_input_ids"].long()
 
@@ -127,20 +131,22 @@ class WhisperModelModule(LightningModule):
         #     with torch.no_grad():
         #         audio_features, x_v = self.model.encoder(input_ids)
         # else:
-        audio_features, x_v = self.model.encoder(input_ids)
+        audio_features, x_v = self.model.encoder(input_ids, x_lengths=mel_lengths)
 
-        out = self.model.decoder(dec_input_ids, audio_features)
+        out = self.model.decoder(dec_input_ids, audio_features,
+                                 xa_padding_mask=whisper.encoder_padding_mask(mel_lengths, audio_features.shape[1]))
         loss = self.loss_fn(out.view(-1, out.size(-1)), labels.view(-1))
         self.log("train/loss", loss, on_step=True, prog_bar=True, logger=True, sync_dist=True)
         return loss
 
     def validation_step(self, batch, batch_id, dataloader_idx=None):
-        input_ids = batch["input_ids"]
+        input_ids, mel_lengths = self.log_mel(batch)
         labels = batch["labels"].long()
         dec_input_ids = batch["dec_input_ids"].long()
 
-        audio_features, x_v = self.model.encoder(input_ids)
-        out = self.model.decoder(dec_input_ids, audio_features)
+        audio_features, x_v = self.model.encoder(input_ids, x_lengths=mel_lengths)
+        out = self.model.decoder(dec_input_ids, audio_features,
+                                 xa_padding_mask=whisper.encoder_padding_mask(mel_lengths, audio_features.shape[1]))
 
         loss = self.loss_fn(out.view(-1, out.size(-1)), labels.view(-1))
 
@@ -208,14 +214,12 @@ class WhisperModelModule(LightningModule):
         dataset = MuavicSpeechDataset(self.__train_dataset, 
                                       self.tokenizer, 
                                       SAMPLE_RATE,
-                                      self.model_name,
                                       max_length=None,
-                                      spec_augment=self.cfg.spec_augment,
                                       noise_prob=cfg.noise_prob,
                                       noise_fn=cfg.noise_fn,
                                     )   
         length_sorter = LengthBatchSampler(batch_bins=self.cfg.audio_max_length * self.cfg.batch_size,
-                    shapes=[i[3] for i in self.__train_dataset],
+                    shapes=self.__train_dataset.audio_lens.tolist(),
                     sort_in_batch='descending',
                     sort_batch='shuffle',
                     drop_last=True,)
@@ -225,88 +229,83 @@ class WhisperModelModule(LightningModule):
         return torch.utils.data.DataLoader(dataset,
                         batch_sampler=length_sorter,
                         num_workers=self.cfg.num_worker,
-                        collate_fn=WhisperDataCollatorWhithPadding())
+                        collate_fn=WhisperDataCollatorWhithPadding(dataset.noise_bank),
+                        pin_memory=True)
 
     def val_dataloader_clean(self):
         dataset = MuavicSpeechDataset(self.__val_dataset, 
                                       self.tokenizer, 
                                       SAMPLE_RATE,
-                                      self.model_name,
                                       max_length=None,
-                                      spec_augment=False,
                                       noise_prob=0
                                     )
         length_sorter = LengthBatchSampler(batch_bins=self.cfg.audio_max_length * 8,
-                    shapes=[i[3] for i in self.__val_dataset],
+                    shapes=self.__val_dataset.audio_lens.tolist(),
                     sort_in_batch='descending',
                     sort_batch='descending',
                     drop_last=False)
         return torch.utils.data.DataLoader(dataset,
                           batch_sampler=length_sorter,
                           num_workers=self.cfg.num_worker,
-                          collate_fn=WhisperDataCollatorWhithPadding()
-                          )
+                          collate_fn=WhisperDataCollatorWhithPadding(dataset.noise_bank),
+                          pin_memory=True)
     
     def val_dataloader_noisy(self):
         dataset = MuavicSpeechDataset(self.__val_dataset, 
                                       self.tokenizer, 
                                       SAMPLE_RATE,
-                                      self.model_name,
                                       max_length=None,
-                                      spec_augment=False,
                                       noise_prob=1,
                                       noise_fn=cfg.noise_fn_val,
+                                      noise_seed=SEED, # same noise every validation
                                     )
         length_sorter = LengthBatchSampler(batch_bins=self.cfg.audio_max_length * 8,
-                    shapes=[i[3] for i in self.__val_dataset],
+                    shapes=self.__val_dataset.audio_lens.tolist(),
                     sort_in_batch='descending',
                     sort_batch='descending',
                     drop_last=False)
         return torch.utils.data.DataLoader(dataset,
                           batch_sampler=length_sorter,
                           num_workers=self.cfg.num_worker,
-                          collate_fn=WhisperDataCollatorWhithPadding()
-                          )
+                          collate_fn=WhisperDataCollatorWhithPadding(dataset.noise_bank),
+                          pin_memory=True)
     def test_dataloader_clean(self):
         dataset = MuavicSpeechDataset(self.__test_dataset, 
                                       self.tokenizer, 
                                       SAMPLE_RATE,
-                                      self.model_name,
                                       max_length=None,
-                                      spec_augment=False,
                                       noise_prob=0
                                     )
         length_sorter = LengthBatchSampler(batch_bins=self.cfg.audio_max_length * 8,
-                    shapes=[i[3] for i in self.__test_dataset],
+                    shapes=self.__test_dataset.audio_lens.tolist(),
                     sort_in_batch='descending',
                     sort_batch='descending',
                     drop_last=False)
         return torch.utils.data.DataLoader(dataset,
                           batch_sampler=length_sorter,
                           num_workers=self.cfg.num_worker,
-                          collate_fn=WhisperDataCollatorWhithPadding()
-                          )
+                          collate_fn=WhisperDataCollatorWhithPadding(dataset.noise_bank),
+                          pin_memory=True)
     
     def test_dataloader_noisy(self):
         dataset = MuavicSpeechDataset(self.__test_dataset, 
                                       self.tokenizer, 
                                       SAMPLE_RATE,
-                                      self.model_name,
                                       max_length=None,
-                                      spec_augment=False,
                                       noise_prob=1,
                                       noise_fn=cfg.noise_fn_test,
+                                      noise_seed=SEED, # same noise every validation
                                     )
         length_sorter = LengthBatchSampler(batch_bins=self.cfg.audio_max_length * 8,
-                    shapes=[i[3] for i in self.__test_dataset],
+                    shapes=self.__test_dataset.audio_lens.tolist(),
                     sort_in_batch='descending',
                     sort_batch='descending',
                     drop_last=False)
         return torch.utils.data.DataLoader(dataset,
                           batch_sampler=length_sorter,
                           num_workers=self.cfg.num_worker,
-                          collate_fn=WhisperDataCollatorWhithPadding()
-                          )
+                          collate_fn=WhisperDataCollatorWhithPadding(dataset.noise_bank),
+                          pin_memory=True)
 
 cfg_yaml = sys.argv[1]
 with open(cfg_yaml, 'r') as file:
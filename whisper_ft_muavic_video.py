@@ -14,85 +14,103 @@ from pytorch_lightning import Trainer, seed_everything
 # from pytorch_lightning.cli import LightningCLI
 from pytorch_lightning.strategies import DDPStrategy
 from tqdm import tqdm
-from spec_augment import spec_augment
+from spec_augment import spec_augment_batch
 from utils import (
     load_data,
     load_wave,
-    load_video_feats,
-    add_noise,
+    load_video_av_hubert,
+    preprocess_video_batch,
+    VideoFeatureCache,
     WhisperVideoCollatorWithPadding,
     whisper_optimizer,
     whisper_video_projection_optimizer,
     whisper_flamingo_projection_optimizer,
+    whisper_flamingo_trainable_layers,
     setup_logging_and_checkpoint,
     wer_cer,
-    DistributedSamplerWrapper,
 )
-from utils_batch_samplers import LengthBatchSampler
+from utils_batch_samplers import LengthBatchSampler, CostBatchSampler
+from packed_corpus import PackedCorpus
+from manifest import ManifestList
+from noise_bank import load_noise_bank, sample_noise
 
 SAMPLE_RATE = 16000
 SEED = 3407
 seed_everything(SEED, workers=True)
 
 class MuavicVideoDataset(torch.utils.data.Dataset):
-    def __init__(self, audio_info_list, tokenizer, sample_rate, model_name, max_length, 
-                 spec_augment, noise_prob=0, noise_fn=None, train=False, noise_snr=0) -> None:
+    def __init__(self, audio_info_list, tokenizer, sample_rate, max_length, 
+                 noise_prob=0, noise_fn=None, train=False, noise_snr=0, video_feat_cache=None, noise_seed=None) -> None:
         super().__init__()
 
         self.audio_info_list = audio_info_list
         self.sample_rate = sample_rate
         self.tokenizer = tokenizer
-        self.model_name = model_name
         self.max_length = max_length
-        self.spec_augment = spec_augment
         self.noise_prob = noise_prob
-        self.noise_fn = [ln.strip() for ln in open(noise_fn).readlines()] if noise_fn is not None else []
+        # noise is drawn here and mixed per batch by the collator, pass it the noise_bank
+        self.noise_bank = load_noise_bank(noise_fn) if noise_fn is not None else None
         self.train = train
         self.noise_snr = noise_snr
+        # if not None, the noise and SNR of every utterance only depend on it and the utterance (eval sets)
+        self.noise_seed = noise_seed
+        # VideoFeatureCache of video_model features, returned instead of the raw frames
+        self.video_feat_cache = video_feat_cache
         print("Dataloader max length : {}".format(max_length))
-        print("Loaded {} noise wavs".format(len(self.noise_fn)))
 
     def __len__(self):
         return len(self.audio_info_list)
 
+    @property
+    def shapes(self):
+        """Audio lengths in samples, for LengthBatchSampler"""
+        if isinstance(self.audio_info_list, ManifestList): # without building the tuples
+            return self.audio_info_list.audio_lens.tolist()
+        return [i[3] for i in self.audio_info_list]
+
+    def costs(self, video_frame_cost, text_char_cost):
+        """Cost of every utterance for CostBatchSampler, in audio samples: audio + weighted video frames and transcript characters"""
+        return self.audio_info_list.audio_lens + video_frame_cost * self.audio_info_list.video_lens \
+            + text_char_cost * self.audio_info_list.text_lens
+
     def __getitem__(self, id):
         lang, audio_path, text, _ = self.audio_info_list[id]
         # audio = load_wave(audio_path, sample_rate=self.sample_rate)
-        if np.random.rand() > self.noise_prob: # disable noise
-            sample_rate, wav_data = wavfile.read(audio_path)
-            audio = wav_data.flatten().astype(np.float32) / 32768.0
-        else: # add noise
-            SNR = self.noise_snr            
-            sample_rate, wav_data = wavfile.read(audio_path)
-            audio = add_noise(wav_data, self.noise_fn, noise_snr=SNR).flatten().astype(np.float32) / 32768.0
-
-        audio_frames = len(audio.flatten()) // 160
+        sample_rate, wav_data = wavfile.read(audio_path)
+        # Seems like Whisper decode always predicts first token with space, so add a space in the beginning
+        tokens = self.tokenizer.encode(" " + text)
+
+        video_path = audio_path.replace('audio', 'video').replace('.wav', '.mp4')
+        if self.video_feat_cache is not None: # center crop, no flip, see whisper_extract_video_feats.py
+            video = self.video_feat_cache[video_path]
+        else: # uint8 frames, cropped and normalized on the device, see WhisperVideoModule.video_input
+            video = load_video_av_hubert(video_path)
+        return self.make_sample(id, lang, wav_data, tokens, video)
+
+    def make_sample(self, id, lang, wav_data, tokens, video):
+        """Inputs and labels of one utterance from its int16 audio, text tokens and uint8 frames or cached video features"""
+        audio = wav_data.flatten().astype(np.float32) / 32768.0
+        n_samples = len(audio)
+        if self.noise_seed is not None:
+            rng = np.random.default_rng((self.noise_seed, id))
+        else: # follows the seeded global state of the worker
+            rng = np.random.default_rng(np.random.randint(2**31))
+        noise_id, snr = sample_noise(rng, self.noise_bank, self.noise_prob, self.noise_snr)
+
         # pad audio to cfg.audio_max_length (longer samples filtered out already)
         if self.max_length != None:
             audio = whisper.pad_or_trim(audio.flatten(), length=self.max_length)
-        n_mels = 80 if self.model_name != 'large-v3' else 128
-        mel = whisper.log_mel_spectrogram(audio, n_mels=n_mels) # freq by time
-    
-        if self.spec_augment:
-            if self.spec_augment == "ls-double":
-                mel = torch.from_numpy(spec_augment(mel.T.numpy(), audio_frames)).T # expects time by freq
-            elif self.spec_augment == "ls-basic":
-                mel = torch.from_numpy(spec_augment(mel.T.numpy(), audio_frames, n_freq_mask=1, n_time_mask=1)).T # expects time by freq
-            else:
-                raise NotImplementedError 
 
-        # Seems like Whisper decode always predicts first token with space, so add a space in the beginning
         # dec_input_ids = [*self.tokenizer.sot_sequence_including_notimestamps] + self.tokenizer.encode(" " + text)
         dec_input_ids = [self.tokenizer.sot, 
                         self.tokenizer.special_tokens["<|{}|>".format(lang)], 
                         self.tokenizer.transcribe, 
                         self.tokenizer.no_timestamps] + \
-                        self.tokenizer.encode(" " + text)
+                        list(tokens)
         labels = dec_input_ids[1:] + [self.tokenizer.eot]
 
-        video_path = audio_path.replace('audio', 'video').replace('.wav', '.mp4')
-        video = load_video_feats(video_path, train=self.train)
-        video = video.astype(np.float32)
+        if video.dtype != np.uint8:
+            video = video.astype(np.float32)
 
         # Trim some videos longer than the audio
         max_video_len = round(len(audio.flatten()) / 16000 * 25)
@@ -100,12 +118,101 @@ class MuavicVideoDataset(torch.utils.data.Dataset):
             video = video[:max_video_len]
 
         return {
-            "input_ids": mel,
+            "audio": audio, # log-mels are computed on the device, see WhisperVideoModule.log_mel
+            "n_samples": n_samples, # before padding to max_length, noise is only added there
+            "noise": (noise_id, snr), # mixed by the collator
             "labels": labels,
             "dec_input_ids": dec_input_ids,
             "video": video
         }
 
+class PackedMuavicVideoDataset(MuavicVideoDataset):
+    """
+    MuavicVideoDataset over a corpus written by whisper_pack_corpus.py: audio, mouth ROIs and
+    tokenized text are read zero-copy from a few memory-mapped shards instead of one WAV and
+    one MP4 per utterance
+    """
+    def __init__(self, corpus_dir, tokenizer, sample_rate, max_length, 
+                 noise_prob=0, noise_fn=None, train=False, noise_snr=0, noise_seed=None) -> None:
+        super().__init__([], tokenizer, sample_rate, max_length, noise_prob=noise_prob, noise_fn=noise_fn,
+                         train=train, noise_snr=noise_snr, noise_seed=noise_seed)
+        self.corpus = PackedCorpus(corpus_dir)
+        assert self.corpus.encoding == tokenizer.encoding.name, \
+            "corpus tokenized with {}, not {}".format(self.corpus.encoding, tokenizer.encoding.name)
+
+    def __len__(self):
+        return len(self.corpus)
+
+    @property
+    def shapes(self):
+        return self.corpus.audio_lengths.tolist()
+
+    def __getitem__(self, id):
+        sample = self.corpus[id]
+        return self.make_sample(id, sample['lang'], sample['audio'], sample['tokens'], sample['video'])
+
+class PackedMuavicVideoStream(torch.utils.data.IterableDataset):
+    """
+    Stream length-bucketed batches of a PackedMuavicVideoDataset for training. Every epoch the
+    shards are shuffled, and every shard's samples are split into one contiguous slice per DDP rank,
+    so all ranks get the same amount of data whatever the number of shards. Each rank reads its
+    slices in shard order into a buffer of `shuffle_buffer` samples, which is shuffled, sorted by
+    length and cut into batches of at most `batch_bins` audio samples (as LengthBatchSampler does),
+    and the batch order is shuffled. The batches are only planned from the index, so every rank can
+    plan all ranks and stop after the same number of batches, as DDP requires; the few batches beyond
+    that are dropped. DataLoader workers take every num_workers-th batch.
+    Use with batch_size=None, a new stream per epoch is created by train_dataloader.
+    """
+    def __init__(self, dataset, batch_bins, shuffle_buffer=2000, seed=SEED, epoch=0, num_replicas=1, rank=0):
+        super().__init__()
+        self.dataset = dataset
+        self.batch_bins = batch_bins
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = epoch
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def plan(self, rank):
+        corpus = self.dataset.corpus
+        lengths = corpus.audio_lengths
+        rng = np.random.default_rng((self.seed, self.epoch, rank))
+        shards = np.random.default_rng((self.seed, self.epoch)).permutation(corpus.n_shards)
+        batches, buffer = [], []
+        for shard in list(shards) + [None]:
+            if shard is not None:
+                buffer += np.array_split(corpus.shard_samples(shard), self.num_replicas)[rank].tolist()
+            if len(buffer) >= self.shuffle_buffer or (shard is None and buffer):
+                rng.shuffle(buffer)
+                buffer = sorted(buffer, key=lambda i: lengths[i], reverse=True)
+                batch, batch_max = [], 0
+                for i in buffer:
+                    # descending lengths, the first sample of a batch is its longest
+                    batch_max = batch_max or lengths[i]
+                    if batch and (len(batch) + 1) * batch_max > self.batch_bins:
+                        batches.append(batch)
+                        batch, batch_max = [], lengths[i]
+                    batch.append(i)
+                batches.append(batch) # drop_last is applied to the whole epoch below
+                buffer = []
+        order = rng.permutation(len(batches))
+        return [batches[i] for i in order]
+
+    def __iter__(self):
+        plans = [self.plan(rank) for rank in range(self.num_replicas)]
+        n_batches = min(len(plan) for plan in plans)
+        assert n_batches > 0, "no batches for {} ranks from {} samples".format(self.num_replicas, len(self.dataset))
+        worker_info = torch.utils.data.get_worker_info()
+        dropped = sum(len(plan) for plan in plans) - n_batches * self.num_replicas
+        if dropped and self.rank == 0 and (worker_info is None or worker_info.id == 0):
+            print("Dropping {} of {} batches to keep {} ranks in step".format(
+                dropped, sum(len(plan) for plan in plans), self.num_replicas))
+        batches = plans[self.rank][:n_batches]
+        if worker_info is not None:
+            batches = batches[worker_info.id::worker_info.num_workers]
+        for batch in batches:
+            yield [self.dataset[i] for i in batch]
+
 class WhisperVideoModule(LightningModule):
     def __init__(self, cfg, model_name, lang, train_dataset, val_dataset, test_dataset) -> None:
         super().__init__()
@@ -134,7 +241,20 @@ class WhisperVideoModule(LightningModule):
                 print("Loading weights with strict=False")
                 self.model.load_state_dict(state_dict_updated, strict=False) 
         self.freeze_video_model = cfg.freeze_video_model
+        self.freeze_parameters(cfg)
+        # '' (off), 'encoder', 'decoder' or 'all', every activation_checkpointing_every-th block
+        self.model.checkpoint_activations(getattr(cfg, 'activation_checkpointing', ''),
+                                          getattr(cfg, 'activation_checkpointing_every', 1))
+        # features from whisper_extract_video_feats.py, the video model is then never run
+        self.video_feat_cache = VideoFeatureCache(cfg.video_feat_cache) if getattr(cfg, 'video_feat_cache', '') else None
+        assert self.video_feat_cache is None or self.freeze_video_model, "cached video features need a frozen video model"
+        # output of whisper_pack_corpus.py, with one packed corpus per split in train/, valid/ and test/
+        self.packed_corpus = getattr(cfg, 'packed_corpus', '')
+        assert not (self.packed_corpus and self.video_feat_cache), "packed_corpus stores frames, not cached features"
         self.freeze_video_batch_norm_stats = cfg. freeze_video_batch_norm_stats
+        # training utterances packed into windows of pack_frames encoder frames (1500 is 30 s), 0 for none
+        self.pack_frames = getattr(cfg, 'pack_frames', 0)
+        assert not self.pack_frames or cfg.av_fusion == "separate", "packing needs the audio and video encoded separately"
         multilingual = True if 'large' in model_name or 'en' not in model_name else False
         print("Multilingual tokenizer : {}".format(multilingual))
         self.tokenizer = whisper.tokenizer.get_tokenizer(multilingual=multilingual, task='transcribe')
@@ -144,6 +264,8 @@ class WhisperVideoModule(LightningModule):
         #         p.requires_grad = False
 
         self.loss_fn = nn.CrossEntropyLoss(ignore_index=-100)
+        # CostBatchSampler of the current epoch and its progress, to resume mid-epoch
+        self.train_sampler, self.train_batches_done, self.sampler_state = None, 0, None
 
         self.cfg = cfg
         self.__train_dataset = train_dataset
@@ -152,52 +274,99 @@ class WhisperVideoModule(LightningModule):
         self.__test_dataset = test_dataset
         self.special_token_set = set(self.tokenizer.special_tokens.values())
 
+    def freeze_parameters(self, cfg):
+        """
+        Freeze the video model (freeze_video_model) and, for gated x-attn, all of Whisper but the gated
+        x-attn layers and the video projection, once. DDP then only reduces the trainable parameters. With frozen_backbone ('fp16' or 'bf16') the frozen encoder parts are
+        also stored and run in that precision under inference_mode, see AudioEncoder.freeze
+        """
+        if self.freeze_video_model:
+            for param in self.model.encoder.video_model.parameters():
+                param.requires_grad = False
+        if cfg.add_gated_x_attn != 0: # freeze whisper gradients for x-attn, as optimized
+            trainable_layers = whisper_flamingo_trainable_layers(cfg)
+            for n, p in self.model.named_parameters():
+                if not any(nd in n for nd in trainable_layers):
+                    p.requires_grad = False
+        frozen_backbone = getattr(cfg, 'frozen_backbone', '')
+        if frozen_backbone:
+            dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}[frozen_backbone]
+            self.model.encoder.freeze(audio=cfg.add_gated_x_attn != 0, video=cfg.freeze_video_model, dtype=dtype)
+
     def forward(self, x):
         return self.model(x)
 
+    def on_train_batch_end(self, outputs, batch, batch_id):
+        self.train_batches_done += 1
+
+    def on_save_checkpoint(self, checkpoint):
+        if self.train_sampler is not None:
+            checkpoint['train_sampler'] = self.train_sampler.state_dict(self.train_batches_done)
+
+    def on_load_checkpoint(self, checkpoint):
+        self.sampler_state = checkpoint.get('train_sampler') # applied by train_dataloader
+
+    def log_mel(self, batch, train=False):
+        """Log-mels of the padded audio of a batch in one pass on the device and their lengths, SpecAugment when training"""
+        mel, mel_lengths = whisper.log_mel_spectrogram_batch(batch["audio"], batch["audio_lengths"],
+                                                             n_mels=self.model.dims.n_mels)
+        if train and self.cfg.spec_augment:
+            mel = spec_augment_batch(mel, mel_lengths, self.cfg.spec_augment)
+        return mel, mel_lengths
+
+    @staticmethod
+    def cross_attn_masks(features, x_v, mel_lengths, padding_mask):
+        """Decoder masks of the padded audio features and video frames, none for video-only / audio-only features"""
+        return {"xa_padding_mask": whisper.encoder_padding_mask(mel_lengths, features.shape[1]),
+                "xv_padding_mask": padding_mask if torch.is_tensor(x_v) and x_v.shape[1] == padding_mask.shape[1] else None}
+
+    def video_input(self, batch, train=False):
+        """Crop, flip (train) and normalize the uint8 frames of a batch on the device, cached features are only cast"""
+        return preprocess_video_batch(batch["video"], batch["padding_mask"], train=train, dtype=self.dtype)
+
     def training_step(self, batch, batch_id):
-        video = batch["video"]
-        input_ids = batch["input_ids"]
+        video = self.video_input(batch, train=True)
+        input_ids, mel_lengths = self.log_mel(batch, train=True)
         labels = batch["labels"].long()
         dec_input_ids = batch["dec_input_ids"].long()
         padding_mask = batch["padding_mask"]
 
-        if self.freeze_video_model: # freeze video encoder
-            for param in self.model.encoder.video_model.parameters():
-                param.requires_grad = False
         if self.freeze_video_batch_norm_stats: # use batch stats from ckpt (do not estimate on batch)
             self.model.encoder.video_model.eval()
-
-        if self.cfg.add_gated_x_attn != 0: # freeze whisper encoder gradients for x-attn
-            video_projection_layers = ["video_projection"] if self.cfg.freeze_video_model else ["video"]
-            for n, p in self.model.encoder.named_parameters():
-                if not any(nd in n for nd in video_projection_layers):
-                    p.requires_grad = False
         # if 'large' in self.model_name: # only decoder training, NOTE: be careful with linear layer here
         #     with torch.no_grad():
         #         features, x_v = self.model.encoder(input_ids, video, training=True, padding_mask=padding_mask)
         # else:
-        features, x_v = self.model.encoder(input_ids, video, training=True, padding_mask=padding_mask)
-
-        out = self.model.decoder(dec_input_ids, features, xv=x_v)
+        x_lengths, segments = mel_lengths, batch.get("segments")
+        if segments is not None: # short utterances packed into windows, features come back per utterance
+            input_ids, x_lengths = whisper.pack_mel(input_ids, segments)
+        features, x_v = self.model.encoder(input_ids, video, training=True, padding_mask=padding_mask,
+                                           x_lengths=x_lengths, segments=segments)
+
+        out = self.model.decoder(dec_input_ids, features, xv=x_v,
+                                 **self.cross_attn_masks(features, x_v, mel_lengths, padding_mask))
         loss = self.loss_fn(out.view(-1, out.size(-1)), labels.view(-1))
         self.log("train/loss", loss, on_step=True, prog_bar=True, logger=True, sync_dist=True)
         return loss
             
     def validation_step(self, batch, batch_id, dataloader_idx=None):
-        video = batch["video"]
-        input_ids = batch["input_ids"]
+        video = self.video_input(batch)
+        input_ids, mel_lengths = self.log_mel(batch)
         labels = batch["labels"].long()
         dec_input_ids = batch["dec_input_ids"].long()
         padding_mask = batch["padding_mask"]
 
         features_av, x_norm, x_v_norm_pre, x_v_norm_post, x_v = self.model.encoder(input_ids, video, track_norm=True,
-                                                                              padding_mask=padding_mask)
-        out_av = self.model.decoder(dec_input_ids, features_av, xv=x_v)
+                                                                              padding_mask=padding_mask,
+                                                                              x_lengths=mel_lengths)
+        out_av = self.model.decoder(dec_input_ids, features_av, xv=x_v,
+                                    **self.cross_attn_masks(features_av, x_v, mel_lengths, padding_mask))
 
         if cfg.add_gated_x_attn == 0:
-            features_a, x_v = self.model.encoder(input_ids, video, test_a=True, padding_mask=padding_mask)
-            out_a = self.model.decoder(dec_input_ids, features_a)
+            features_a, x_v = self.model.encoder(input_ids, video, test_a=True, padding_mask=padding_mask,
+                                                 x_lengths=mel_lengths)
+            out_a = self.model.decoder(dec_input_ids, features_a,
+                                       xa_padding_mask=whisper.encoder_padding_mask(mel_lengths, features_a.shape[1]))
 
             features_v, x_v = self.model.encoder(input_ids, video, test_v=True, padding_mask=padding_mask)
             out_v = self.model.decoder(dec_input_ids, features_v)
@@ -271,111 +440,142 @@ class WhisperVideoModule(LightningModule):
         self.optimizer, self.scheduler = optimizer, scheduler
         return [optimizer], [{"scheduler": scheduler, "interval": "step", "frequency": 1}]
 
+    def video_dataset(self, split, **kwargs):
+        """Dataset of `split` ('train', 'valid' or 'test'), read from the packed corpus if there is one"""
+        if self.packed_corpus:
+            return PackedMuavicVideoDataset(os.path.join(self.packed_corpus, split), self.tokenizer, SAMPLE_RATE,
+                                            max_length=None, **kwargs)
+        audio_info_list = {'train': self.__train_dataset, 'valid': self.__val_dataset, 'test': self.__test_dataset}[split]
+        return MuavicVideoDataset(audio_info_list, self.tokenizer, SAMPLE_RATE, max_length=None,
+                                  video_feat_cache=self.video_feat_cache, **kwargs)
+
     def setup(self, stage=None):
         if stage == 'fit' or stage is None:
             self.t_total = self.cfg.num_train_steps
 
     def train_dataloader(self):
-        dataset = MuavicVideoDataset(self.__train_dataset, 
-                                      self.tokenizer, 
-                                      SAMPLE_RATE,
-                                      self.model_name,
-                                      max_length=None,
-                                      spec_augment=self.cfg.spec_augment,
+        dataset = self.video_dataset('train',
                                       noise_prob=cfg.noise_prob,
                                       noise_fn=cfg.noise_fn,
                                       train=True,
-                                      noise_snr=cfg.noise_snr_train,)  
-        length_sorter = LengthBatchSampler(batch_bins=int(self.cfg.audio_max_length * self.cfg.batch_size),
-                            shapes=[i[3] for i in self.__train_dataset],
-                            sort_in_batch='descending',
-                            sort_batch='shuffle',
-                            drop_last=True,)
-        if cfg.num_devices > 1:
-            print("Using distributed sampler")
-            length_sorter = DistributedSamplerWrapper(length_sorter)
+                                      noise_snr=cfg.noise_snr_train)
+        if self.packed_corpus: # stream the shards, length-bucketed in a shuffle buffer
+            stream = PackedMuavicVideoStream(dataset,
+                                             batch_bins=int(self.cfg.audio_max_length * self.cfg.batch_size),
+                                             shuffle_buffer=getattr(self.cfg, 'shuffle_buffer', 2000),
+                                             epoch=self.current_epoch,
+                                             num_replicas=self.trainer.world_size,
+                                             rank=self.global_rank)
+            return torch.utils.data.DataLoader(stream,
+                              batch_size=None,
+                              num_workers=self.cfg.num_worker,
+                              collate_fn=WhisperVideoCollatorWithPadding(dataset.noise_bank, pack_frames=self.pack_frames),
+                              pin_memory=True)
+        # batches cost at most batch_size utterances of max length, with as many video frames as audio
+        # (a frame costs video_frame_cost audio samples) and text_max_length characters
+        video_frame_cost = getattr(self.cfg, 'video_frame_cost', 640)
+        text_char_cost = getattr(self.cfg, 'text_char_cost', 160)
+        max_cost = self.cfg.audio_max_length * (1 + video_frame_cost / 640) + text_char_cost * self.cfg.text_max_length
+        sampler = CostBatchSampler(dataset.costs(video_frame_cost, text_char_cost),
+                                   batch_cost=max_cost * self.cfg.batch_size,
+                                   num_replicas=self.trainer.world_size,
+                                   rank=self.global_rank,
+                                   seed=SEED,
+                                   epoch=self.current_epoch,
+                                   drop_last=True)
+        if self.sampler_state is not None and self.sampler_state['epoch'] == self.current_epoch: # resumed mid-epoch
+            sampler.load_state_dict(self.sampler_state)
+        self.sampler_state = None
+        self.train_sampler, self.train_batches_done = sampler, sampler.start
         return torch.utils.data.DataLoader(dataset,
-                          batch_sampler=length_sorter,
+                          batch_sampler=sampler,
                           num_workers=self.cfg.num_worker,
-                          collate_fn=WhisperVideoCollatorWithPadding())
+                          collate_fn=WhisperVideoCollatorWithPadding(dataset.noise_bank, pack_frames=self.pack_frames),
+                          pin_memory=True)
 
     def val_dataloader_clean(self):
-        dataset = MuavicVideoDataset(self.__val_dataset, 
-                                self.tokenizer, 
-                                SAMPLE_RATE,
-                                self.model_name,
-                                max_length=None,
-                                spec_augment=False,
+        dataset = self.video_dataset('valid',
                                 noise_prob=0,
-                                train=False,)
+                                train=False)
         length_sorter = LengthBatchSampler(batch_bins=int(self.cfg.audio_max_length * 16),
-                            shapes=[i[3] for i in self.__val_dataset],
+                            shapes=dataset.shapes,
                             sort_in_batch='descending',
                             sort_batch='descending',
                             drop_last=False)
         return torch.utils.data.DataLoader(dataset,
                           batch_sampler=length_sorter,
                           num_workers=self.cfg.num_worker,
-                          collate_fn=WhisperVideoCollatorWithPadding())
+                          collate_fn=WhisperVideoCollatorWithPadding(dataset.noise_bank),
+                          pin_memory=True)
 
     def val_dataloader_noisy(self):
-        dataset = MuavicVideoDataset(self.__val_dataset, 
-                                self.tokenizer, 
-                                SAMPLE_RATE,
-                                self.model_name,
-                                max_length=None,
-                                spec_augment=False,
+        dataset = self.video_dataset('valid',
                                 noise_prob=1,
                                 noise_fn=cfg.noise_fn_val,
-                                train=False,)
+                                train=False,
+                                noise_seed=SEED) # same noise every validation
         length_sorter = LengthBatchSampler(batch_bins=int(self.cfg.audio_max_length * 16),
-                            shapes=[i[3] for i in self.__val_dataset],
+                            shapes=dataset.shapes,
                             sort_in_batch='descending',
                             sort_batch='descending',
                             drop_last=False)
         return torch.utils.data.DataLoader(dataset,
                           batch_sampler=length_sorter,
                           num_workers=self.cfg.num_worker,
-                          collate_fn=WhisperVideoCollatorWithPadding())
+                          collate_fn=WhisperVideoCollatorWithPadding(dataset.noise_bank),
+                          pin_memory=True)
     
     def test_dataloader_clean(self):
-        dataset = MuavicVideoDataset(self.__test_dataset, 
-                                self.tokenizer, 
-                                SAMPLE_RATE,
-                                self.model_name,
-                                max_length=None,
-                                spec_augment=False,
+        dataset = self.video_dataset('test',
                                 noise_prob=0,
-                                train=False,)
+                                train=False)
         length_sorter = LengthBatchSampler(batch_bins=int(self.cfg.audio_max_length * 16),
-                            shapes=[i[3] for i in self.__test_dataset],
+                            shapes=dataset.shapes,
                             sort_in_batch='descending',
                             sort_batch='descending',
                             drop_last=False)
         return torch.utils.data.DataLoader(dataset,
                           batch_sampler=length_sorter,
                           num_workers=self.cfg.num_worker,
-                          collate_fn=WhisperVideoCollatorWithPadding())
+                          collate_fn=WhisperVideoCollatorWithPadding(dataset.noise_bank),
+                          pin_memory=True)
 
     def test_dataloader_noisy(self):
-        dataset = MuavicVideoDataset(self.__test_dataset, 
-                                self.tokenizer, 
-                                SAMPLE_RATE,
-                                self.model_name,
-                                max_length=None,
-                                spec_augment=False,
+        dataset = self.video_dataset('test',
                                 noise_prob=1,
                                 noise_fn=cfg.noise_fn_test,
-                                train=False,)
+                                train=False,
+                                noise_seed=SEED) # same noise every validation
         length_sorter = LengthBatchSampler(batch_bins=int(self.cfg.audio_max_length * 16),
-                            shapes=[i[3] for i in self.__test_dataset],
+                            shapes=dataset.shapes,
                             sort_in_batch='descending',
                             sort_batch='descending',
                             drop_last=False)
         return torch.utils.data.DataLoader(dataset,
                           batch_sampler=length_sorter,
                           num_workers=self.cfg.num_worker,
-                          collate_fn=WhisperVideoCollatorWithPadding())
+                          collate_fn=WhisperVideoCollatorWithPadding(dataset.noise_bank),
+                          pin_memory=True)
+
+def load_cfg_data(cfg):
+    if cfg.lang == 'multi-all':
+        return load_data(cfg.audio_max_length, cfg.text_max_length, 
+                                            ['en', 'ar', 'de', 'el', 'es', 'fr', 'it', 'pt', 'ru'],
+                                            reduce_val=300, include_audio_lens=True)
+    elif cfg.lang == 'multi':
+        return load_data(cfg.audio_max_length, cfg.text_max_length, 
+                                            ['en', 'es', 'fr', 'it', 'pt'],
+                                            reduce_val=300, include_audio_lens=True)
+    elif cfg.lang == 'multi_en-st':
+        return load_data(cfg.audio_max_length, cfg.text_max_length, 
+                                           ['en', 'el', 'es', 'fr', 'it', 'pt', 'ru'],
+                                           reduce_val=200, include_audio_lens=True, task='En-X')
+    elif 'lrs2' in cfg.lang:
+        return load_data(cfg.audio_max_length, cfg.text_max_length, ['en'], 
+                                            include_audio_lens=True, lrs2=True)
+    else:
+        return load_data(cfg.audio_max_length, cfg.text_max_length, 
+                                               [cfg.lang], include_audio_lens=True, vc2=cfg.vc2, vc2_path=cfg.vc2_path)
 
 if __name__ == "__main__":
     cfg_yaml = sys.argv[1]
@@ -391,31 +591,25 @@ if __name__ == "__main__":
                                                                                 cfg.train_name, 
                                                                                 cfg.train_id,
                                                                                 cfg.monitor,)
-    if cfg.lang == 'multi-all':
-        audio_transcript_pair_list = load_data(cfg.audio_max_length, cfg.text_max_length, 
-                                            ['en', 'ar', 'de', 'el', 'es', 'fr', 'it', 'pt', 'ru'],
-                                            reduce_val=300, include_audio_lens=True)
-    elif cfg.lang == 'multi':
-        audio_transcript_pair_list = load_data(cfg.audio_max_length, cfg.text_max_length, 
-                                            ['en', 'es', 'fr', 'it', 'pt'],
-                                            reduce_val=300, include_audio_lens=True)
-    elif cfg.lang == 'multi_en-st':
-        audio_transcript_pair_list = load_data(cfg.audio_max_length, cfg.text_max_length, 
-                                           ['en', 'el', 'es', 'fr', 'it', 'pt', 'ru'],
-                                           reduce_val=200, include_audio_lens=True, task='En-X')
-    elif 'lrs2' in cfg.lang:
-        audio_transcript_pair_list = load_data(cfg.audio_max_length, cfg.text_max_length, ['en'], 
-                                            include_audio_lens=True, lrs2=True)
+    if getattr(cfg, 'packed_corpus', ''): # the packed corpus already holds the filtered splits
+        audio_transcript_pair_list = {'train': None, 'valid': None, 'test': None}
     else:
-        audio_transcript_pair_list = load_data(cfg.audio_max_length, cfg.text_max_length, 
-                                               [cfg.lang], include_audio_lens=True, vc2=cfg.vc2, vc2_path=cfg.vc2_path)
+        audio_transcript_pair_list = load_cfg_data(cfg)
 
     model = WhisperVideoModule(cfg, cfg.model_name, cfg.lang, 
                                audio_transcript_pair_list['train'], 
                                audio_transcript_pair_list['valid'],
                                audio_transcript_pair_list['test'])
     
-    strategy = DDPStrategy(find_unused_parameters=True) if cfg.num_devices > 1 else "auto"
+    if cfg.num_devices > 1 and getattr(cfg, 'ddp_static_graph', False):
+        # DDP buckets only the parameters which require grad and all-reduces them during the backward
+        # pass; a static graph needs the same parameters used every step, so no modality dropout
+        assert cfg.prob_use_av >= 1.0, "modality dropout can skip the video projection, use ddp_static_graph: False"
+        strategy = DDPStrategy(static_graph=True, gradient_as_bucket_view=True)
+    else:
+        strategy = DDPStrategy(find_unused_parameters=True) if cfg.num_devices > 1 else "auto"
+    # a frozen_backbone video model runs in eval mode, the trainable modules have no batch norm
+    sync_batchnorm = not (getattr(cfg, 'frozen_backbone', '') and cfg.freeze_video_model)
     trainer = Trainer(
         precision=16,
         strategy=strategy,
@@ -432,7 +626,7 @@ if __name__ == "__main__":
         reload_dataloaders_every_n_epochs=1, # shuffle the dataloader after an epoch
         # gradient_clip_val=1, # TODO: add as config variable?
         use_distributed_sampler=False, # implemented custom distributed trainer
-        sync_batchnorm=True,
+        sync_batchnorm=sync_batchnorm,
     )
 
     # TODO: save config file tp the checkpoint dir, also for pre-trained model
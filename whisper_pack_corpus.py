@@ -0,0 +1,63 @@
+import os
+import yaml
+import types
+import argparse
+import numpy as np
+import torch
+import whisper
+from scipy.io import wavfile
+from tqdm import tqdm
+from utils import load_video_av_hubert
+from packed_corpus import PackedCorpusWriter
+from whisper_ft_muavic_video import load_cfg_data
+
+# Pack the utterances of a training config into memory-mappable shards (int16 audio, uint8 mouth ROIs,
+# tokenized text), one packed corpus per split in <out_dir>/<split>. Set `packed_corpus: <out_dir>`
+# in the config, or pass --packed-corpus <out_dir>/test to whisper_decode_video.py, to use them.
+parser = argparse.ArgumentParser()
+parser.add_argument('config', type=str, help='training config, for the data and the tokenizer')
+parser.add_argument('out_dir', type=str, help='directory of the packed corpus')
+parser.add_argument('--splits', default='train,valid,test', type=str, help='comma separated splits to pack')
+parser.add_argument('--video-size', default=96, type=int, help='height and width of the mouth ROIs')
+parser.add_argument('--shard-gb', default=2, type=float, help='max size of a shard')
+parser.add_argument('--num-worker', default=16, type=int, help='media loading workers')
+args = parser.parse_args()
+
+class MediaDataset(torch.utils.data.Dataset):
+    def __init__(self, audio_info_list, tokenizer):
+        self.audio_info_list = audio_info_list
+        self.tokenizer = tokenizer
+
+    def __len__(self):
+        return len(self.audio_info_list)
+
+    def __getitem__(self, id):
+        lang, audio_path, text, _ = self.audio_info_list[id]
+        sample_rate, wav_data = wavfile.read(audio_path)
+        assert sample_rate == 16000, "{} is not 16 kHz".format(audio_path)
+        video_path = audio_path.replace('audio', 'video').replace('.wav', '.mp4')
+        video = load_video_av_hubert(video_path)
+        # Trim some videos longer than the audio, same as MuavicVideoDataset
+        video = video[:round(len(wav_data.flatten()) / 16000 * 25)]
+        # Seems like Whisper decode always predicts first token with space, so add a space in the beginning
+        tokens = np.array(self.tokenizer.encode(" " + text), dtype=np.int32)
+        return audio_path, lang, wav_data.flatten(), video, tokens
+
+with open(args.config, 'r') as file:
+    cfg = types.SimpleNamespace(**yaml.safe_load(file))
+multilingual = True if 'large' in cfg.model_name or 'en' not in cfg.model_name else False
+tokenizer = whisper.tokenizer.get_tokenizer(multilingual=multilingual, task='transcribe')
+
+audio_transcript_pair_list = load_cfg_data(cfg)
+for split in args.splits.split(','):
+    utterances = audio_transcript_pair_list[split]
+    out_dir = os.path.join(args.out_dir, split)
+    print("Packing {} {} utterances into {}".format(len(utterances), split, out_dir))
+    dataloader = torch.utils.data.DataLoader(MediaDataset(utterances, tokenizer),
+                                             batch_size=None,
+                                             num_workers=args.num_worker,
+                                             collate_fn=lambda x: x)
+    with PackedCorpusWriter(out_dir, tokenizer.encoding.name, video_size=(args.video_size, args.video_size),
+                            shard_bytes=int(args.shard_gb * 1024 ** 3)) as writer:
+        for key, lang, audio, video, tokens in tqdm(dataloader):
+            writer.add(key, lang, audio, video, tokens)
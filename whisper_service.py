@@ -1,13 +1,20 @@
 import os
 import json
+import asyncio
+import time
 import torch
 import numpy as np
-from fastapi import FastAPI, File, UploadFile, Form
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
 from typing import Optional
-from scipy.io import wavfile
 import whisper
-from utils import load_video_feats, add_noise  # Assuming these are available in your utils module
+from whisper.audio import N_SAMPLES, VIDEO_FRAMES_PER_SECOND
+from noise_bank import load_noise_bank, mix_noise, parse_noise_banks, noise_bank_path
+from utils import load_video_bytes, load_wave_bytes, preprocess_video_frames, preprocess_video_batch  # Assuming these are available in your utils module
+from model_registry import ModelRegistry
+from batch_scheduler import BatchScheduler, collate_inputs
+from worker_pool import WorkerPool, ServerBusyError
+from streaming import StreamingSession
 import sys
 import uvicorn
 
@@ -39,6 +46,15 @@ whisper_path = "models/"  # Matches --whisper-path (default in script)
 av_hubert_path = "av_hubert/avhubert/"  # Matches --av-hubert-path
 av_hubert_ckpt = "models/large_noise_pt_noise_ft_433h_only_weights.pt"  # Matches --av-hubert-ckpt
 SAMPLE_RATE = 16000
+model_budget_gb = float(os.environ["MODEL_BUDGET_GB"]) if "MODEL_BUDGET_GB" in os.environ else None
+batch_max_size = int(os.environ.get("BATCH_MAX_SIZE", 8))
+batch_max_wait_ms = float(os.environ.get("BATCH_MAX_WAIT_MS", 20))
+preprocess_workers = int(os.environ.get("PREPROCESS_WORKERS", 4))
+max_pending_requests = int(os.environ.get("MAX_PENDING_REQUESTS", 32))  # beyond this, 429
+request_timeout_s = float(os.environ.get("REQUEST_TIMEOUT_S", 60))  # beyond this, 503
+long_form_batch_size = int(os.environ.get("LONG_FORM_BATCH_SIZE", 1))  # 30 s windows decoded together
+max_streams = int(os.environ.get("MAX_STREAMS", 4))  # concurrent WebSocket sessions
+noise_banks = parse_noise_banks(os.environ.get("NOISE_BANKS", "babble=noise/babble/muavic/test.tsv"))  # name -> tsv
 
 # Model request parameters
 class TranscriptionRequest(BaseModel):
@@ -49,43 +65,74 @@ class TranscriptionRequest(BaseModel):
     beam_size: int = 1  # Default, matches --beam-size 1
     fp16: int = 0  # Matches --fp16 0
     checkpoint_path: Optional[str] = "models/whisper-flamingo_en-x_small.pt"  # Matches --checkpoint-path
-    noise_fn: Optional[str] = "noise/babble/muavic/test.tsv"  # Matches --noise-fn
+    noise: Optional[str] = "babble"  # name of a noise in NOISE_BANKS, matches --noise-fn
 
-# Load the Whisper-Flamingo model
+# Resident models, keyed by (model_type, checkpoint, modality, fp16)
+model_registry = ModelRegistry(whisper_path, av_hubert_path, av_hubert_ckpt, use_av_hubert_encoder,
+                               av_fusion, device=device, budget_gb=model_budget_gb)
+
+@app.on_event("startup")
+async def warm_default_model():
+    # Load the default checkpoint in the background so the first request does not pay for it
+    default = TranscriptionRequest()
+    if default.checkpoint_path and os.path.exists(default.checkpoint_path):
+        model_registry.warm(model_type, default.checkpoint_path, default.modalities, device == "cuda" and default.fp16)
+
+# Get the Whisper-Flamingo model from the registry, loading it on first use
 def load_model(language="en", modalities="avsr", checkpoint_path=None, fp16=0):
-    print(f"Loading model with checkpoint: {checkpoint_path}")
-    try:
-        model = whisper.load_model(
-            model_type,
-            download_root=whisper_path,
-            video=True if modalities in ["avsr", "vsr"] else False,
-            video_model_path=av_hubert_ckpt,
-            av_hubert_path=av_hubert_path,
-            av_hubert_encoder=use_av_hubert_encoder,
-            av_fusion=av_fusion,
-            add_gated_x_attn=1 if av_fusion == "separate" else 0
-        )
-    except Exception as e:
-        print(f"Error loading model at whisper.load_model: {e}")
-        raise
-    
-    if checkpoint_path:
-        state_dict = torch.load(checkpoint_path, map_location=torch.device('cpu'))
-        state_dict = state_dict.get('state_dict', state_dict)  # Handle case where 'state_dict' key exists
-        state_dict_updated = {k[6:]: v for k, v in state_dict.items() if k.startswith('model.')} or state_dict
-        try:
-            model.load_state_dict(state_dict_updated)
-        except RuntimeError:
-            model.load_state_dict(state_dict_updated, strict=False)
-    if device == "cuda" and fp16:
-        model = model.cuda().half()
+    return model_registry.get(model_type, checkpoint_path, modalities, device == "cuda" and fp16)
+
+# Load and preprocess the media of one request, runs outside the event loop
+def preprocess_media(audio_bytes, video_bytes, modalities, noise_snr, noise_fn=None):
+    """
+    Returns (audio, video, False) for inputs up to 30 s, which are batched (the log-mels
+    are computed for the whole batch on the device), and (audio, video, True) for longer
+    inputs, which are transcribed in 30 s windows
+    """
+    # Load and preprocess video
+    if video_bytes and modalities in ["avsr", "vsr"]:
+        video = load_video_bytes(video_bytes)  # uint8 frames, center cropped and normalized for the decode
     else:
-        model = model.to(device)
-    tokenizer = whisper.tokenizer.get_tokenizer(multilingual=False, task="transcribe")
-    return model, tokenizer
+        video = None
+
+    # Load and preprocess audio
+    if audio_bytes:
+        sample_rate, wav_data = load_wave_bytes(audio_bytes)
+        if sample_rate != SAMPLE_RATE:
+            raise ValueError(f"Sample rate must be {SAMPLE_RATE} Hz")
+        audio = wav_data.flatten().astype(np.float32) / 32768.0
+        if noise_snr < 100 and noise_fn and os.path.exists(noise_fn):
+            audio = mix_noise(audio, load_noise_bank(noise_fn), noise_snr)
+    else: # video-only: the encoder drops the audio features, silence only sets the duration
+        if video is None:
+            raise ValueError("Audio or video file is required")
+        audio = np.zeros(len(video) * SAMPLE_RATE // VIDEO_FRAMES_PER_SECOND, dtype=np.float32)
+    if len(audio) > N_SAMPLES:
+        return audio, video, True
+    return whisper.pad_or_trim(audio, length=N_SAMPLES), video, False
+
+# Transcribe one input longer than 30 s in windows, on the inference thread
+def decode_long(key, audio, video):
+    checkpoint_path, modalities, language, task, beam_size, fp16, _ = key
+    model, tokenizer = load_model(language, modalities, checkpoint_path, fp16)
+    result = model.transcribe(
+        audio,
+        video=preprocess_video_frames(video).astype(np.float32) if video is not None else None,
+        test_a=modalities == "asr",
+        test_v=modalities == "vsr",
+        batch_size=long_form_batch_size,
+        temperature=0.0,
+        verbose=None,
+        language=language,
+        task='translate' if task == 'X-En' else 'transcribe',
+        fp16=bool(device == "cuda" and fp16),
+        beam_size=None if beam_size == 1 else beam_size,
+    )
+    return {"text": result["text"], "segments": [{k: seg[k] for k in ("start", "end", "text")} for seg in result["segments"]]}
 
-# Process media files
-def process_media(audio_file_path, video_file_path, language, noise_snr, task, modalities, beam_size, fp16, checkpoint_path=None, noise_fn=None):
+# Run one batched decode for requests sharing the same batch key, on the scheduler's decode thread
+def decode_batch(key, items):
+    checkpoint_path, modalities, language, task, beam_size, fp16, _ = key
     model, tokenizer = load_model(language, modalities, checkpoint_path, fp16)
     task_type = 'translate' if task == 'X-En' else 'transcribe'
     options = whisper.DecodingOptions(
@@ -96,51 +143,56 @@ def process_media(audio_file_path, video_file_path, language, noise_snr, task, m
         beam_size=None if beam_size == 1 else beam_size,
     )
 
-    # Load and preprocess audio
-    if audio_file_path:
-        sample_rate, wav_data = wavfile.read(audio_file_path)
-        assert sample_rate == SAMPLE_RATE, f"Sample rate must be {SAMPLE_RATE} Hz"
-        audio = wav_data.flatten().astype(np.float32) / 32768.0
-        if noise_snr < 100 and noise_fn and os.path.exists(noise_fn):
-            with open(noise_fn, 'r') as f:
-                noise_files = [ln.strip() for ln in f.readlines()]
-            audio = add_noise(wav_data, noise_files, noise_snr=noise_snr).flatten().astype(np.float32) / 32768.0
-        audio = whisper.pad_or_trim(audio, length=SAMPLE_RATE * 30)
-        n_mels = 80 if model_type != 'large-v3' else 128
-        mel = whisper.log_mel_spectrogram(audio, n_mels=n_mels)
-        mel = torch.tensor(mel, dtype=torch.float32).unsqueeze(0)
-        if device == "cuda" and fp16:
-            mel = mel.half().cuda()
-        elif device == "cuda":
-            mel = mel.cuda()
-    else:
-        mel = None
-
-    # Load and preprocess video
-    if video_file_path and modalities in ["avsr", "vsr"]:
-        video = load_video_feats(video_file_path, train=False)  # Assumes center crop, no flip
-        video = torch.tensor(video, dtype=torch.float32).unsqueeze(0)  # Ensure float32
-        video = video.permute(0, 4, 1, 2, 3)  # Shape: [1, channels, num_frames, height, width]
-        if device == "cuda" and fp16:
-            video = video.half().cuda()  # Converts to torch.float16
-        elif device == "cuda":
-            video = video.cuda()
-    else:
-        video = None
+    audio, audio_lengths, video, padding_mask = collate_inputs(*zip(*items))
+    dtype = torch.float16 if device == "cuda" and fp16 else torch.float32
+    mel, mel_lengths = whisper.log_mel_spectrogram_batch(audio.to(device), audio_lengths, n_mels=model.dims.n_mels)
+    mel = mel.to(dtype)
+    if video is not None:
+        padding_mask = padding_mask.to(device)
+        video = preprocess_video_batch(video.to(device), padding_mask, dtype=dtype)
+    # the padding of the shorter requests is not attended to, each one decodes as it would alone
+    masks = dict(mel_lengths=mel_lengths, video_padding_mask=padding_mask)
 
     # Perform decoding
     with torch.no_grad():
         if modalities == "avsr":
-            result = model.decode(mel, options, video)
+            results = model.decode(mel, options, video, **masks)
         elif modalities == "asr":
-            result = model.decode(mel, options, video, test_a=True)
+            results = model.decode(mel, options, video, test_a=True, **masks)
         elif modalities == "vsr":
-            result = model.decode(mel, options, video, test_v=True)
+            results = model.decode(mel, options, video, test_v=True, **masks)
         else:
             raise ValueError(f"Unsupported modality: {modalities}")
     
-    transcription = result[0].text
-    return {"text": transcription}
+    return [{"text": result.text} for result in results]
+
+# Preprocessing thread pool, dedicated inference thread and admission control
+worker_pool = WorkerPool(preprocess_workers, max_pending_requests, request_timeout_s)
+
+# Requests with the same checkpoint, modality, language, task, beam size, fp16 and frame size are decoded together
+batch_scheduler = BatchScheduler(decode_batch, max_batch_size=batch_max_size, max_wait_ms=batch_max_wait_ms,
+                                 worker_pool=worker_pool)
+
+async def handle_request(audio_file, video_file, params):
+    # Uploads are decoded in memory, nothing is written to disk
+    audio_bytes = await audio_file.read() if audio_file else None
+    video_bytes = await video_file.read() if video_file else None
+    audio, video, long_form = await worker_pool.preprocess(
+        preprocess_media,
+        audio_bytes,
+        video_bytes,
+        params.modalities,
+        params.noise_snr,
+        noise_bank_path(noise_banks, params.noise)
+    )
+
+    # videos are only stacked with frames of the same size
+    frame_shape = None if video is None else video.shape[1:]
+    key = (params.checkpoint_path, params.modalities, params.language, params.task, params.beam_size, params.fp16,
+           frame_shape)
+    if long_form: # not batched
+        return await worker_pool.infer(decode_long, key, audio, video)
+    return await batch_scheduler.submit(key, (audio, video))
 
 # API endpoint
 @app.post("/transcribe/")
@@ -150,39 +202,88 @@ async def transcribe_file(
     params: str = Form(...)
 ):
     params = TranscriptionRequest(**json.loads(params))
-    
-    # Save uploaded files temporarily
-    audio_file_path = video_file_path = None
-    if audio_file:
-        audio_file_path = f"temp_audio_{audio_file.filename}"
-        with open(audio_file_path, "wb") as f:
-            f.write(await audio_file.read())
-    if video_file:
-        video_file_path = f"temp_video_{video_file.filename}"
-        with open(video_file_path, "wb") as f:
-            f.write(await video_file.read())
-    
+    if params.modalities not in ["avsr", "asr", "vsr"]:
+        raise HTTPException(status_code=400, detail=f"Unsupported modality: {params.modalities}")
+
     try:
-        result = process_media(
-            audio_file_path,
-            video_file_path,
-            params.language,
-            params.noise_snr,
-            params.task,
-            params.modalities,
-            params.beam_size,
-            params.fp16,
-            params.checkpoint_path,
-            params.noise_fn
+        async with worker_pool.admit():
+            return await worker_pool.run(handle_request(audio_file, video_file, params))
+    except ValueError as e: # undecodable media
+        raise HTTPException(status_code=400, detail=str(e))
+    except ServerBusyError as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail=f"Request timed out after {worker_pool.timeout_s} s",
+                            headers={"Retry-After": "5"})
+
+# Live captioning parameters, sent as the first (JSON text) message of the WebSocket
+class StreamingRequest(TranscriptionRequest):
+    step_ms: int = 1000  # decode every step_ms of new media
+    max_window_s: float = 20.0  # rolling encoder window, cut and finalized beyond this
+    video_height: int = 96  # size of the raw grayscale mouth frames
+    video_width: int = 96
+
+active_streams = 0
+
+@app.websocket("/ws/transcribe/")
+async def transcribe_stream(websocket: WebSocket):
+    """
+    Incremental transcription. After the JSON parameters, the client sends binary messages
+    b"a" + 16 kHz mono int16 PCM or b"v" + one uint8 grayscale video frame (25 fps), and
+    finally the text message {"event": "end"}. The server answers with "partial", "commit"
+    and "final" JSON events carrying latency_ms, and a "summary" with time-to-first-token
+    and per-chunk latency before closing.
+    """
+    global active_streams
+    await websocket.accept()
+    if active_streams >= max_streams:
+        await websocket.close(code=1013, reason="Too many active streams, try again later")
+        return
+    active_streams += 1
+    try:
+        params = StreamingRequest(**json.loads(await websocket.receive_text()))
+        model, tokenizer = await worker_pool.infer(load_model, params.language, params.modalities,
+                                                   params.checkpoint_path, params.fp16)
+        options = whisper.DecodingOptions(
+            task='translate' if params.task == 'X-En' else 'transcribe',
+            language=params.language,
+            fp16=bool(device == "cuda" and params.fp16),
+            without_timestamps=True,
+            beam_size=None if params.beam_size == 1 else params.beam_size,
         )
+        session = StreamingSession(model, options, params.modalities, step_s=params.step_ms / 1000,
+                                   max_window_s=params.max_window_s, video_height=params.video_height,
+                                   video_width=params.video_width)
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            received = time.perf_counter()
+            if message.get("bytes"):
+                data = message["bytes"]
+                if data[:1] == b"a":
+                    session.add_audio(data[1:])
+                elif data[:1] == b"v":
+                    session.add_video_frame(data[1:])
+                if session.ready():
+                    for event in await worker_pool.infer(session.update, received):
+                        await websocket.send_json(event)
+            elif message.get("text") and json.loads(message["text"]).get("event") == "end":
+                for event in await worker_pool.infer(session.finish, received):
+                    await websocket.send_json(event)
+                await websocket.close()
+                return
+    except WebSocketDisconnect:
+        pass
+    except ValueError as e: # bad parameters or frame sizes, or a lagging modality
+        await websocket.close(code=1003, reason=str(e)[:120])
     finally:
-        # Clean up temporary files
-        if audio_file_path and os.path.exists(audio_file_path):
-            os.remove(audio_file_path)
-        if video_file_path and os.path.exists(video_file_path):
-            os.remove(video_file_path)
-    
-    return result
+        active_streams -= 1
+
+@app.get("/health/")
+async def health_check():
+    return {"status": "ok", "device": device, "queued": batch_scheduler.queued,
+            **worker_pool.stats(), "active_streams": active_streams, "models": model_registry.status()}
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,77 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger("whisper-flamingo-workers")
+
+
+class ServerBusyError(Exception):
+    pass
+
+
+class WorkerPool:
+    """
+    Keeps blocking work off the event loop of the API servers.
+
+    Media decoding (wavfile, OpenCV/ffmpeg, log-mel) runs on a pool of
+    `preprocess_workers` threads and inference on a dedicated single-thread
+    executor, so one GPU decode runs at a time and health checks and uploads
+    are still served meanwhile. At most `max_pending` requests are admitted at
+    once; `admit()` raises ServerBusyError beyond that, and `run()` bounds the
+    whole request by `timeout_s`.
+    """
+    def __init__(self, preprocess_workers=4, max_pending=32, timeout_s=60.0):
+        self.max_pending = max_pending
+        self.timeout_s = timeout_s
+        self.preprocess_executor = ThreadPoolExecutor(max_workers=preprocess_workers, thread_name_prefix="preprocess")
+        self.inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self.pending = 0  # admitted requests not finished yet
+        self.preprocessing = 0
+        self.in_flight = 0  # requests submitted to the inference thread, queued or running
+        self.rejected = 0
+        self.timed_out = 0
+
+    @asynccontextmanager
+    async def admit(self):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise ServerBusyError(f"{self.pending} requests pending, try again later")
+        self.pending += 1
+        try:
+            yield
+        finally:
+            self.pending -= 1
+
+    async def run(self, coro):
+        """Await `coro` under the per-request timeout, raises asyncio.TimeoutError"""
+        try:
+            return await asyncio.wait_for(coro, timeout=self.timeout_s)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise
+
+    async def preprocess(self, fn, *args):
+        self.preprocessing += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.preprocess_executor, fn, *args)
+        finally:
+            self.preprocessing -= 1
+
+    async def infer(self, fn, *args, n_requests=1):
+        """Run `fn` on the inference thread, `n_requests` is the number of requests batched in the call"""
+        self.in_flight += n_requests
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.inference_executor, fn, *args)
+        finally:
+            self.in_flight -= n_requests
+
+    def stats(self):
+        return {
+            "pending": self.pending,
+            "preprocessing": self.preprocessing,
+            "in_flight": self.in_flight,
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }